@@ -0,0 +1,136 @@
+"""
+Benchmark suite timing every SkinToneAnalyzer entry point on synthetic faces (no Mask RCNN model needed) across image
+sizes. Results are written as JSON together with the commit they were measured on, and can be compared against the
+results of another commit to spot regressions.
+
+Run from the repository root:
+    PYTHONPATH=src:benchmarks python benchmarks/analyzer_suite.py --sizes 1 4 12 24 48 --output analyzer.json
+    PYTHONPATH=src:benchmarks python benchmarks/analyzer_suite.py --baseline analyzer.json --output new.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import multiprocessing as mp
+
+from facemagik.common import ExecutionMode
+from facemagik.skintone import SkinToneAnalyzer
+from facemagik.utils import ImageUtils
+from synthetic import synthetic_face, synthetic_config, megapixels_to_shape, SHADOW_SIDES
+
+# Relative slowdown of the median latency compared to the baseline that is reported as a regression.
+REGRESSION_THRESHOLD = 0.1
+
+"""
+Each entry point is called on a freshly constructed analyzer so that results memoized in the analyzer's session by an
+earlier call are not reused.
+"""
+ENTRY_POINTS = {
+    "get_light_direction_result": lambda analyzer: analyzer.get_light_direction_result(),
+    "determine_scene_brightness": lambda analyzer: analyzer.determine_scene_brightness(),
+    "get_skin_tones": lambda analyzer: analyzer.get_skin_tones(),
+    "smaller_cluster_skin_tones": lambda analyzer: ImageUtils.smaller_cluster_skin_tones(
+        analyzer.image, analyzer.face_mask_to_process),
+    "analyze": lambda analyzer: analyzer.analyze(),
+}
+
+"""
+git_commit returns the current commit hash of the repository, or an empty string if it is not available.
+"""
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+"""
+time_entry_point returns the latencies (in seconds) of calling given entry point on a new analyzer of given image.
+"""
+
+
+def time_entry_point(image, face_mask_info, entry_point: str, mode: ExecutionMode, repeats: int) -> list:
+    latencies = []
+    for _ in range(repeats):
+        skin_config = synthetic_config(image)
+        skin_config.EXECUTION_MODE = mode
+        analyzer = SkinToneAnalyzer(None, skin_config, face_mask_info)
+        start_time = time.perf_counter()
+        ENTRY_POINTS[entry_point](analyzer)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+"""
+compare prints the change in median latency of every result that is also present in given baseline results and
+returns the results that regressed by more than REGRESSION_THRESHOLD.
+"""
+
+
+def compare(results: list, baseline: dict) -> list:
+    def key(r):
+        return r["entry_point"], r["megapixels"], r["shadow_side"], r["teeth_visible"], r["mode"]
+
+    baseline_results = {key(r): r for r in baseline["results"]}
+    regressions = []
+    print("\nComparison with baseline commit: ", baseline.get("commit", ""))
+    for result in results:
+        if key(result) not in baseline_results:
+            continue
+        before = baseline_results[key(result)]["median_seconds"]
+        change = (result["median_seconds"] - before) / before
+        print("{0:<28} {1:>5} MP  {2:.3f}s -> {3:.3f}s  ({4:+.1%})".format(result["entry_point"], result["megapixels"],
+                                                                          before, result["median_seconds"], change))
+        if change > REGRESSION_THRESHOLD:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark SkinToneAnalyzer entry points on synthetic faces')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12, 24, 48], help="image sizes in megapixels")
+    parser.add_argument('--entry-points', nargs='+', default=list(ENTRY_POINTS.keys()), choices=ENTRY_POINTS.keys())
+    parser.add_argument('--light-gradient', type=float, default=0.55)
+    parser.add_argument('--shadow-side', default="right", choices=SHADOW_SIDES)
+    parser.add_argument('--no-teeth', action='store_true', help="render closed lips instead of teeth")
+    parser.add_argument('--mode', default=ExecutionMode.INLINE.name, choices=[m.name for m in ExecutionMode])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', required=True, help="path of JSON file to write results to")
+    parser.add_argument('--baseline', required=False, help="path of JSON results of an earlier commit to compare to")
+    args = parser.parse_args()
+
+    # Multiprocessing library should use fork mode.
+    mp.set_start_method('fork')
+
+    mode = ExecutionMode[args.mode]
+    results = []
+    for megapixels in args.sizes:
+        height, width = megapixels_to_shape(megapixels)
+        image, face_mask_info = synthetic_face(height, width, light_gradient=args.light_gradient,
+                                               shadow_side=args.shadow_side, teeth_visible=not args.no_teeth)
+        for entry_point in args.entry_points:
+            latencies = time_entry_point(image, face_mask_info, entry_point, mode, args.repeats)
+            result = {"entry_point": entry_point, "megapixels": megapixels, "shape": [height, width],
+                      "light_gradient": args.light_gradient, "shadow_side": args.shadow_side,
+                      "teeth_visible": not args.no_teeth, "mode": mode.name, "latencies": latencies,
+                      "median_seconds": statistics.median(latencies), "min_seconds": min(latencies)}
+            results.append(result)
+            print("{entry_point:<28} size: {megapixels:>5} MP  median: {median_seconds:.3f}s  "
+                  "min: {min_seconds:.3f}s".format(**result))
+        del image, face_mask_info
+
+    output = {"commit": git_commit(), "timestamp": time.time(), "machine": platform.platform(),
+              "python": platform.python_version(), "cpu_count": os.cpu_count(), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        if len(regressions) > 0:
+            print("\n", len(regressions), " results regressed by more than ", REGRESSION_THRESHOLD * 100, "%")
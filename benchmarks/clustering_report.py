@@ -0,0 +1,204 @@
+"""
+Clustering shootout: runs every face clustering variant over a corpus of cached masks and reports the cost of each
+variant against how much its output differs from a baseline variant. A variant is a registered clustering strategy
+(see the clustering module, like recursive Kmeans or brightness bands) combined with the ITERATE_FACE_CLUSTERS and
+COMBINE_MASKS refinements. For every variant the report tabulates latency, number of clusters and skin tones,
+agreement of the primary light direction with the baseline and the CIEDE2000 difference of its skin tones from the
+baseline's.
+
+The corpus is made of recorded images whose Mask RCNN predictions are cached in .hdf5 files next to them (no model is
+loaded) and/or synthetic faces lit from each side.
+
+COMBINE_MASKS only produces debug output in the analyzer today; here the combined masks are used as the skin tone
+masks so that the effect of enabling it can be measured. ITERATE_TEETH_CLUSTERS does not change scene brightness (it
+is computed from the unrefined clusters) and is not a variant.
+
+Run from the repository root:
+    PYTHONPATH=src:benchmarks python benchmarks/clustering_report.py --sizes 1 --output clustering.json
+    PYTHONPATH=src:benchmarks python benchmarks/clustering_report.py --images corpus/*.png --sizes --baseline kmeans
+"""
+import argparse
+import itertools
+import json
+import statistics
+import time
+import colour
+import numpy as np
+
+from dataclasses import dataclass
+from facemagik.clustering import clustering_strategy_names
+from facemagik.common import ExecutionMode
+from facemagik.face import Face
+from facemagik.foundation import srgb_to_lab
+from facemagik.skintone import SkinToneAnalyzer, SkinDetectionConfig, FaceMaskInfo, NoseMiddlePoint
+from synthetic import synthetic_face, megapixels_to_shape, SHADOW_SIDES
+
+"""
+Variant is one clustering configuration. The name is the algorithm followed by "+iterate" and/or "+combine" if
+ITERATE_FACE_CLUSTERS or COMBINE_MASKS are set.
+"""
+
+
+@dataclass
+class Variant:
+    algorithm: str
+    iterate_face_clusters: bool
+    combine_masks: bool
+
+    @property
+    def name(self) -> str:
+        return self.algorithm + ("+iterate" if self.iterate_face_clusters else "") + (
+            "+combine" if self.combine_masks else "")
+
+    def skin_config(self, image: np.ndarray) -> SkinDetectionConfig:
+        skin_config = SkinDetectionConfig()
+        skin_config.IMAGE = image
+        skin_config.CLUSTERING_ALGORITHM = self.algorithm
+        skin_config.ITERATE_FACE_CLUSTERS = self.iterate_face_clusters
+        skin_config.COMBINE_MASKS = self.combine_masks
+        skin_config.EXECUTION_MODE = ExecutionMode.INLINE
+        return skin_config
+
+
+VARIANTS = [Variant(algorithm, iterate, combine) for algorithm, iterate, combine in
+            itertools.product(clustering_strategy_names(), [False, True], [False, True])]
+
+"""
+load_corpus returns (name, image, FaceMaskInfo) for every recorded image (predictions cached next to it) and every
+synthetic face of given sizes and shadow sides.
+"""
+
+
+def load_corpus(image_paths: list, sizes: list, shadow_sides: list) -> list:
+    corpus = []
+    for image_path in image_paths:
+        face = Face(image_path=image_path)
+        nose_middle_point = face.noseMiddlePoint
+        left_eye_mask, right_eye_mask = face.get_eye_masks()
+        face_mask_info = FaceMaskInfo(face_mask_to_process=face.get_face_until_nose_end_without_area_around_eyes(),
+                                      mouth_mask_to_process=face.get_mouth_points(),
+                                      nose_middle_point=NoseMiddlePoint(x=int(nose_middle_point[1]),
+                                                                        y=int(nose_middle_point[0])),
+                                      left_eye_mask=left_eye_mask, right_eye_mask=right_eye_mask)
+        corpus.append((image_path, face.image, face_mask_info))
+    for megapixels in sizes:
+        height, width = megapixels_to_shape(megapixels)
+        for shadow_side in shadow_sides:
+            image, face_mask_info = synthetic_face(height, width, shadow_side=shadow_side)
+            corpus.append(("synthetic " + str(megapixels) + " MP shadow " + shadow_side, image, face_mask_info))
+    return corpus
+
+
+"""
+run_variant runs given variant on an image of the corpus and returns its latencies, light direction and skin tones.
+Each run uses a new analyzer so that no clusters are shared between variants.
+"""
+
+
+def run_variant(variant: Variant, image: np.ndarray, face_mask_info: FaceMaskInfo) -> dict:
+    analyzer = SkinToneAnalyzer(None, variant.skin_config(image), face_mask_info)
+    analyzer.ycrcb_image()
+
+    start_time = time.perf_counter()
+    all_cluster_masks, effective_color_map = analyzer.face_clusters(use_process_pool=False)
+    clustering_seconds = time.perf_counter() - start_time
+
+    primary_light_direction, _ = SkinToneAnalyzer.light_direction_from_clusters(
+        all_cluster_masks, analyzer.face_mask_to_process, analyzer.nose_middle_point, analyzer.rotation_matrix,
+        analyzer.skin_config)
+    if variant.iterate_face_clusters:
+        effective_color_map = Face.iterate_effective_color_map(analyzer.image, effective_color_map, all_cluster_masks)
+    if variant.combine_masks:
+        effective_color_map = {i: m for i, m in
+                               enumerate(Face.combine_masks_close_to_each_other(analyzer.image, effective_color_map))}
+    analyzer.face_mask_effective_color_map = effective_color_map
+    skin_tones = analyzer.get_skin_tones()
+
+    return {"seconds": time.perf_counter() - start_time, "clustering_seconds": clustering_seconds,
+            "num_clusters": len(all_cluster_masks), "num_effective_colors": len(effective_color_map),
+            "light_direction": str(primary_light_direction),
+            "skin_tones": [{"rgb": s.rgb, "percent": s.percent_of_face_mask} for s in skin_tones]}
+
+
+"""
+skin_tone_delta_e returns the difference between two lists of skin tones: for each skin tone of the baseline, the
+CIEDE2000 difference to the closest skin tone of the other list, averaged with the baseline's mask percents as
+weights. Returns None if either list is empty.
+"""
+
+
+def skin_tone_delta_e(baseline: list, other: list):
+    if len(baseline) == 0 or len(other) == 0:
+        return None
+    baseline_lab = srgb_to_lab(np.array([s["rgb"] for s in baseline]))
+    other_lab = srgb_to_lab(np.array([s["rgb"] for s in other]))
+    delta_e = colour.delta_E(baseline_lab[:, np.newaxis, :], other_lab[np.newaxis, :, :], method='CIE 2000')
+    weights = np.array([s["percent"] for s in baseline])
+    return float(np.sum(np.min(delta_e, axis=1) * weights) / np.sum(weights))
+
+
+"""
+summarize aggregates the per image results of every variant and compares them with the baseline variant.
+"""
+
+
+def summarize(results: list, baseline: str) -> list:
+    baseline_results = {r["input"]: r for r in results if r["variant"] == baseline}
+    summary = []
+    for variant in VARIANTS:
+        rows = [r for r in results if r["variant"] == variant.name]
+        if len(rows) == 0:
+            continue
+        agreements = [r["light_direction"] == baseline_results[r["input"]]["light_direction"] for r in rows]
+        delta_es = [skin_tone_delta_e(baseline_results[r["input"]]["skin_tones"], r["skin_tones"]) for r in rows]
+        delta_es = [d for d in delta_es if d is not None]
+        summary.append({"variant": variant.name, "images": len(rows),
+                        "median_seconds": statistics.median([r["seconds"] for r in rows]),
+                        "median_clustering_seconds": statistics.median([r["clustering_seconds"] for r in rows]),
+                        "mean_clusters": statistics.mean([r["num_clusters"] for r in rows]),
+                        "mean_skin_tones": statistics.mean([len(r["skin_tones"]) for r in rows]),
+                        "light_direction_agreement": sum(agreements) / len(agreements),
+                        "mean_delta_e": statistics.mean(delta_es) if len(delta_es) > 0 else None,
+                        "max_delta_e": max(delta_es) if len(delta_es) > 0 else None})
+    return summary
+
+
+def print_summary(summary: list, baseline: str):
+    print("\nCompared with baseline: ", baseline)
+    print("{0:<32} {1:>10} {2:>13} {3:>9} {4:>10} {5:>11} {6:>9} {7:>9}".format(
+        "variant", "median s", "clustering s", "clusters", "skin tones", "light agree", "mean dE", "max dE"))
+    for s in summary:
+        mean_delta_e = "n/a" if s["mean_delta_e"] is None else "{0:.2f}".format(s["mean_delta_e"])
+        max_delta_e = "n/a" if s["max_delta_e"] is None else "{0:.2f}".format(s["max_delta_e"])
+        print("{0:<32} {1:>10.3f} {2:>13.3f} {3:>9.1f} {4:>10.1f} {5:>11.0%} {6:>9} {7:>9}".format(
+            s["variant"], s["median_seconds"], s["median_clustering_seconds"], s["mean_clusters"],
+            s["mean_skin_tones"], s["light_direction_agreement"], mean_delta_e, max_delta_e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare face clustering variants over a corpus of cached masks')
+    parser.add_argument('--images', nargs='*', default=[],
+                        help="recorded images (predictions cached in .hdf5 files next to them)")
+    parser.add_argument('--sizes', type=float, nargs='*', default=[1], help="synthetic image sizes in megapixels")
+    parser.add_argument('--shadow-sides', nargs='+', default=list(SHADOW_SIDES), choices=SHADOW_SIDES)
+    parser.add_argument('--variants', nargs='+', default=[v.name for v in VARIANTS],
+                        choices=[v.name for v in VARIANTS])
+    parser.add_argument('--baseline', default=VARIANTS[0].name, choices=[v.name for v in VARIANTS])
+    parser.add_argument('--output', required=False, help="path of JSON file to write results to")
+    args = parser.parse_args()
+
+    variants = [v for v in VARIANTS if v.name in args.variants or v.name == args.baseline]
+    results = []
+    for name, image, face_mask_info in load_corpus(args.images, args.sizes, args.shadow_sides):
+        for variant in variants:
+            result = run_variant(variant, image, face_mask_info)
+            result.update({"input": name, "variant": variant.name})
+            results.append(result)
+            print("{0:<40} {1:<32} {2:.3f}s  clusters: {3}  light direction: {4}".format(
+                name[-40:], variant.name, result["seconds"], result["num_clusters"], result["light_direction"]))
+
+    summary = summarize(results, args.baseline)
+    print_summary(summary, args.baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"baseline": args.baseline, "summary": summary, "results": results}, f, indent=2)
@@ -0,0 +1,285 @@
+"""
+Micro-benchmark and accuracy suite for the competing implementations of the same color math in ImageUtils (and the
+batched versions in spectral and foundation): CIEDE2000 (pairwise and one to many), sRGB gamma decoding and encoding,
+sRGB to Lab and sRGB to Munsell. Every implementation of a family is timed at each requested number of colors and its
+output is compared against a float64 reference computed with the colour library, reporting the maximum and mean
+absolute deviation.
+
+Run from the repository root:
+    PYTHONPATH=src python benchmarks/color_science.py --sizes 1 1000 1000000 --output color_science.json
+"""
+import argparse
+import json
+import time
+import warnings
+import colour
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Callable, List
+from facemagik.utils import ImageUtils
+from facemagik.spectral import linearize_srgb, delinearize_srgb
+from facemagik.foundation import srgb_to_lab
+
+# Minimum total time spent timing an implementation at a given size. Fast calls are repeated until it is reached.
+MIN_TIMING_SECONDS = 0.2
+
+# Implementations that convert one color at a time in Python are only run up to this many colors.
+MAX_SCALAR_COLORS = 1000
+
+# Munsell conversion is an iterative search per color (a few colors per second), only run up to this many colors.
+MAX_MUNSELL_COLORS = 100
+
+D65 = colour.CCS_ILLUMINANTS['cie_2_1931']['D65']
+
+"""
+Implementation is one implementation of a color function family. fn takes the family's inputs and returns an array
+comparable to the family's reference output. Implementations are skipped for sizes above max_colors.
+"""
+
+
+@dataclass
+class Implementation:
+    name: str
+    fn: Callable
+    max_colors: int = None
+
+
+"""
+Family is a set of implementations of the same function. make_inputs returns the inputs for given number of colors
+and given random generator, reference computes the high precision output and deviation returns the per color
+absolute deviation between an output and the reference.
+"""
+
+
+@dataclass
+class Family:
+    name: str
+    make_inputs: Callable
+    reference: Callable
+    implementations: List[Implementation]
+    deviation: Callable = lambda out, ref: np.abs(np.reshape(out, np.shape(ref)) - ref)
+
+
+"""
+reference_lab returns the CIE Lab (D65) of given (n,3) sRGB (0-255) array computed in float64.
+"""
+
+
+def reference_lab(rgb: np.ndarray) -> np.ndarray:
+    return colour.XYZ_to_Lab(colour.sRGB_to_XYZ(rgb / 255.0, D65), D65)
+
+
+def random_colors(n: int, rng) -> np.ndarray:
+    return rng.integers(0, 256, (n, 3)).astype(float)
+
+
+"""
+random_color_pairs returns pairs of sRGB colors that are close to each other, like the skin tone and shade pairs the
+analysis compares.
+"""
+
+
+def random_color_pairs(n: int, rng) -> tuple:
+    a = random_colors(n, rng)
+    b = np.clip(np.round(a + rng.normal(0, 8, a.shape)), 0, 255)
+    return a, b
+
+
+"""
+munsell_value_chroma returns the (n,2) Munsell value and chroma of given Munsell notations (NaN if the conversion
+failed).
+"""
+
+
+def munsell_value_chroma(notations) -> np.ndarray:
+    result = np.full((len(notations), 2), np.nan)
+    for i, notation in enumerate(notations):
+        try:
+            specification = colour.notation.munsell.munsell_colour_to_munsell_specification(notation)
+            result[i] = [specification[1], 0.0 if np.isnan(specification[2]) else specification[2]]
+        except Exception:
+            pass
+    return result
+
+
+"""
+reference_munsell returns the Munsell notations of given (n,3) sRGB (0-255) array interpreted as sRGB under
+illuminant C (the illuminant of the Munsell renotation data). ImageUtils.sRGBtoMunsell interprets its input as
+display P3, so the deviation from this reference is the error introduced by that interpretation for sRGB inputs.
+"""
+
+
+def reference_munsell(rgb: np.ndarray) -> list:
+    C = colour.CCS_ILLUMINANTS['cie_2_1931']['C']
+    notations = []
+    for c in colour.sRGB_to_XYZ(rgb / 255.0, C):
+        try:
+            notations.append(colour.xyY_to_munsell_colour(colour.XYZ_to_xyY(c)))
+        except Exception:
+            notations.append("None")
+    return notations
+
+
+FAMILIES = [
+    Family(
+        name="delta_e_2000_pairs",
+        make_inputs=random_color_pairs,
+        reference=lambda a, b: colour.delta_E(reference_lab(a), reference_lab(b), method='CIE 2000'),
+        implementations=[
+            Implementation("ImageUtils.delta_cie2000 (colormath)",
+                           lambda a, b: np.array([ImageUtils.delta_cie2000(x, y) for x, y in zip(a, b)]),
+                           MAX_SCALAR_COLORS),
+            Implementation("ImageUtils.delta_cie2000_v2 (cv2 float Lab, colour)",
+                           lambda a, b: np.array([ImageUtils.delta_cie2000_v2(x, y) for x, y in zip(a, b)]),
+                           MAX_SCALAR_COLORS),
+            Implementation("ImageUtils.delta_e_cie2000_vectors (cv2 uint8 Lab, numpy)",
+                           lambda a, b: ImageUtils.delta_e_cie2000_vectors(a, b)),
+            Implementation("foundation.srgb_to_lab + colour.delta_E (cv2 float Lab)",
+                           lambda a, b: colour.delta_E(srgb_to_lab(a), srgb_to_lab(b), method='CIE 2000')),
+        ]),
+    Family(
+        name="delta_e_2000_one_to_many",
+        make_inputs=lambda n, rng: (random_colors(1, rng)[0], random_colors(n, rng)),
+        reference=lambda c, colors: colour.delta_E(reference_lab(c[np.newaxis, :]), reference_lab(colors),
+                                                   method='CIE 2000'),
+        implementations=[
+            Implementation("ImageUtils.delta_e_mask_matrix (cv2 uint8 Lab, colormath matrix)",
+                           lambda c, colors: ImageUtils.delta_e_mask_matrix(c, colors)),
+            Implementation("ImageUtils.delta_cie2000_matrix_v2 (cv2 float Lab, colour)",
+                           lambda c, colors: ImageUtils.delta_cie2000_matrix_v2(c[np.newaxis, :],
+                                                                                colors[np.newaxis, :, :])),
+            Implementation("ImageUtils.delta_e_cie2000_vectors (cv2 uint8 Lab, numpy)",
+                           lambda c, colors: ImageUtils.delta_e_cie2000_vectors(
+                               np.repeat(c[np.newaxis, :], len(colors), axis=0), colors)),
+        ]),
+    Family(
+        name="srgb_gamma_decode",
+        make_inputs=lambda n, rng: (random_colors(n, rng),),
+        reference=lambda rgb: colour.cctf_decoding(rgb / 255.0, function='sRGB'),
+        implementations=[
+            Implementation("ImageUtils.remove_gamma_correction (scalar)",
+                           lambda rgb: np.array([ImageUtils.remove_gamma_correction(c.copy()) for c in rgb]),
+                           MAX_SCALAR_COLORS),
+            Implementation("ImageUtils.remove_gamma_correction_matrix",
+                           lambda rgb: ImageUtils.remove_gamma_correction_matrix(rgb)),
+            Implementation("spectral.linearize_srgb", lambda rgb: linearize_srgb(rgb)),
+        ]),
+    Family(
+        name="srgb_gamma_encode",
+        make_inputs=lambda n, rng: (rng.random((n, 3)),),
+        reference=lambda linear: colour.cctf_encoding(linear, function='sRGB') * 255,
+        implementations=[
+            Implementation("ImageUtils.add_gamma_correction (scalar)",
+                           lambda linear: np.array([ImageUtils.add_gamma_correction(c.copy()) for c in linear]),
+                           MAX_SCALAR_COLORS),
+            Implementation("ImageUtils.add_gamma_correction_matrix",
+                           lambda linear: ImageUtils.add_gamma_correction_matrix(linear)),
+            Implementation("spectral.delinearize_srgb", lambda linear: delinearize_srgb(linear)),
+        ]),
+    Family(
+        name="srgb_to_lab",
+        make_inputs=lambda n, rng: (random_colors(n, rng),),
+        reference=reference_lab,
+        implementations=[
+            Implementation("ImageUtils.lab_colors (cv2 uint8)", lambda rgb: ImageUtils.lab_colors(rgb)),
+            Implementation("foundation.srgb_to_lab (cv2 float32)", lambda rgb: srgb_to_lab(rgb)),
+        ],
+        # Euclidean distance in Lab (CIE76 delta E).
+        deviation=lambda out, ref: np.linalg.norm(np.reshape(out, np.shape(ref)) - ref, axis=-1)),
+    Family(
+        name="srgb_to_munsell",
+        make_inputs=lambda n, rng: (random_colors(n, rng),),
+        reference=lambda rgb: munsell_value_chroma(reference_munsell(rgb)),
+        implementations=[
+            Implementation("ImageUtils.sRGBtoMunsell (display P3)",
+                           lambda rgb: munsell_value_chroma([ImageUtils.sRGBtoMunsell(c) for c in rgb]),
+                           MAX_MUNSELL_COLORS),
+        ],
+        # Deviation of Munsell value and chroma, colors that failed to convert in either are ignored.
+        deviation=lambda out, ref: np.linalg.norm(out - ref, axis=-1)[~np.isnan(out - ref).any(axis=-1)]),
+]
+
+"""
+time_call returns the mean latency (in seconds) of calling fn, repeating fast calls until MIN_TIMING_SECONDS is
+reached, and the output of the first call.
+"""
+
+
+def time_call(fn: Callable) -> (float, object):
+    start_time = time.perf_counter()
+    output = fn()
+    elapsed = time.perf_counter() - start_time
+    calls = 1
+    while elapsed < MIN_TIMING_SECONDS:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start_time
+    return elapsed / calls, output
+
+
+"""
+run_family times and checks every implementation of given family at given sizes and returns the result records.
+"""
+
+
+def run_family(family: Family, sizes: List[int], seed: int) -> list:
+    results = []
+    for n in sizes:
+        inputs = family.make_inputs(n, np.random.default_rng(seed))
+        # The reference is computed only if at least one implementation runs at this size (the Munsell reference is
+        # itself a per color loop).
+        reference = None
+        for impl in family.implementations:
+            result = {"family": family.name, "implementation": impl.name, "colors": n}
+            if impl.max_colors is not None and n > impl.max_colors:
+                result["skipped"] = "more than " + str(impl.max_colors) + " colors"
+            else:
+                if reference is None:
+                    reference = family.reference(*inputs)
+                try:
+                    seconds, output = time_call(lambda: impl.fn(*inputs))
+                    deviation = family.deviation(np.asarray(output, dtype=float), reference)
+                    result.update({"seconds": seconds, "colors_per_second": n / seconds,
+                                   "max_deviation": float(np.max(deviation)) if deviation.size > 0 else None,
+                                   "mean_deviation": float(np.mean(deviation)) if deviation.size > 0 else None})
+                except Exception as e:
+                    result["error"] = type(e).__name__ + ": " + str(e)
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result: dict):
+    prefix = "{0:<26} {1:<66} {2:>8}".format(result["family"], result["implementation"], result["colors"])
+    if "skipped" in result:
+        print(prefix, "  skipped: ", result["skipped"])
+    elif "error" in result:
+        print(prefix, "  error: ", result["error"].splitlines()[0])
+    else:
+        deviation = "n/a" if result["max_deviation"] is None else "{0:.4g} / {1:.4g}".format(
+            result["max_deviation"], result["mean_deviation"])
+        print(prefix, "  {0:>10.3g}s  {1:>12.4g} colors/s  max/mean deviation: {2}".format(
+            result["seconds"], result["colors_per_second"], deviation))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark color science implementations')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 1000, 1000000], help="numbers of colors")
+    parser.add_argument('--families', nargs='+', default=[f.name for f in FAMILIES],
+                        choices=[f.name for f in FAMILIES])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=False, help="path of JSON file to write results to")
+    args = parser.parse_args()
+
+    # Out of gamut colors in the Munsell conversions warn on every color.
+    warnings.filterwarnings("ignore", category=colour.utilities.ColourUsageWarning)
+
+    results = []
+    for family in FAMILIES:
+        if family.name in args.families:
+            results.extend(run_family(family, args.sizes, args.seed))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
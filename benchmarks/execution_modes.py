@@ -0,0 +1,80 @@
+"""
+Benchmark comparing the PROCESS, THREAD and INLINE execution modes of SkinToneAnalyzer for computing scene
+brightness and primary light direction across image sizes and core counts.
+
+Run from the repository root:
+    PYTHONPATH=src:benchmarks python benchmarks/execution_modes.py --sizes 1 4 12 --cores 1 2 4
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import cv2
+import multiprocessing as mp
+
+from facemagik.common import ExecutionMode
+from facemagik.skintone import SkinToneAnalyzer
+from synthetic import synthetic_face, synthetic_config, megapixels_to_shape
+
+"""
+limit_cores restricts this process (and processes forked from it) to the first num_cores CPUs.
+"""
+
+
+def limit_cores(num_cores: int):
+    available = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, available[:num_cores])
+    cv2.setNumThreads(num_cores)
+
+
+"""
+time_mode returns the latencies (in seconds) of running the analyzer in given execution mode.
+"""
+
+
+def time_mode(image, face_mask_info, mode: ExecutionMode, repeats: int) -> list:
+    latencies = []
+    for _ in range(repeats):
+        skin_config = synthetic_config(image)
+        skin_config.EXECUTION_MODE = mode
+        analyzer = SkinToneAnalyzer(None, skin_config, face_mask_info)
+        start_time = time.perf_counter()
+        analyzer.get_primary_light_direction_and_scene_brightness()
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark analyzer execution modes')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12], help="image sizes in megapixels")
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 2, 4], help="number of cores to use")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', required=False, help="path of JSON file to write results to")
+    args = parser.parse_args()
+
+    # Multiprocessing library should use fork mode.
+    mp.set_start_method('fork')
+
+    all_cores = sorted(os.sched_getaffinity(0))
+    results = []
+    for num_cores in args.cores:
+        if num_cores > len(all_cores):
+            print("Skipping ", num_cores, " cores, only ", len(all_cores), " available")
+            continue
+        limit_cores(num_cores)
+        for megapixels in args.sizes:
+            height, width = megapixels_to_shape(megapixels)
+            image, face_mask_info = synthetic_face(height, width)
+            for mode in ExecutionMode:
+                latencies = time_mode(image, face_mask_info, mode, args.repeats)
+                result = {"cores": num_cores, "megapixels": megapixels, "mode": mode.name,
+                          "median_seconds": statistics.median(latencies), "min_seconds": min(latencies)}
+                results.append(result)
+                print("cores: {cores:>3}  size: {megapixels:>5} MP  mode: {mode:<8}  median: {median_seconds:.3f}s  "
+                      "min: {min_seconds:.3f}s".format(**result))
+        os.sched_setaffinity(0, all_cores)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,203 @@
+"""
+Per stage peak memory profile of the analyzer across image sizes. Every stage (Face init, region derivation,
+clustering and skin tones) records the peak of traced Python/numpy allocations (tracemalloc) above the allocations
+alive when the stage started, the allocations the stage leaves alive, and the peak resident set size of the process.
+Inputs are synthetic faces with synthetic Mask RCNN predictions or recorded images (with their predictions cached in
+an .hdf5 file next to the image, since no model is loaded).
+
+The analyzer runs in INLINE mode so that all allocations happen in this process. On Linux the peak RSS is reset
+before each stage (via /proc/self/clear_refs) so it is the peak of that stage; elsewhere it is the peak of the
+process so far.
+
+The run fails (exit code 1) if a stage exceeds its budget or the peak RSS exceeds --max-rss-mb.
+
+Run from the repository root:
+    PYTHONPATH=src:benchmarks python benchmarks/memory_profile.py --sizes 1 4 12 24 48 --output memory.json
+    PYTHONPATH=src:benchmarks python benchmarks/memory_profile.py --images face.jpg --stage-budget clustering=2000
+"""
+import argparse
+import gc
+import json
+import resource
+import sys
+import tracemalloc
+
+from facemagik.common import ExecutionMode
+from facemagik.face import Face
+from facemagik.skintone import SkinToneAnalyzer
+from synthetic import synthetic_face, synthetic_predictions, synthetic_config, megapixels_to_shape
+
+MB = 1024.0 * 1024.0
+
+STAGES = ["face_init", "region_derivation", "clustering", "skin_tones"]
+
+"""
+reset_peak_rss resets the peak resident set size (VmHWM) of this process. Returns False if it is not supported.
+"""
+
+
+def reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+"""
+rss_mb returns the (current, peak) resident set size of this process in MB. The current size is 0 where
+/proc/self/status is not available.
+"""
+
+
+def rss_mb() -> (float, float):
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024.0, int(status["VmHWM"].split()[0]) / 1024.0
+    except (OSError, KeyError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux.
+        return 0.0, maxrss / MB if sys.platform == "darwin" else maxrss / 1024.0
+
+
+"""
+profile_stage calls fn and returns its result and the memory record of the stage.
+"""
+
+
+def profile_stage(name: str, fn) -> (object, dict):
+    gc.collect()
+    rss_reset = reset_peak_rss()
+    rss_before, _ = rss_mb()
+    traced_before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    result = fn()
+
+    traced_after, traced_peak = tracemalloc.get_traced_memory()
+    rss_after, rss_peak = rss_mb()
+    record = {"stage": name, "traced_peak_mb": (traced_peak - traced_before) / MB,
+              "retained_mb": (traced_after - traced_before) / MB, "rss_mb": rss_after, "peak_rss_mb": rss_peak,
+              "peak_rss_increase_mb": rss_peak - rss_before, "peak_rss_reset": rss_reset}
+    return result, record
+
+
+"""
+profile_face profiles the analyzer stages of one image and returns the stage records and the (height, width) of the
+image. face_fn constructs the Face.
+"""
+
+
+def profile_face(face_fn) -> (list, tuple):
+    records = []
+    face, record = profile_stage("face_init", face_fn)
+    records.append(record)
+
+    shape = face.image.shape[:2]
+    skin_config = synthetic_config(face.image)
+    skin_config.EXECUTION_MODE = ExecutionMode.INLINE
+    skin_config.CHECK_IMAGE_QUALITY = False
+    analyzer, record = profile_stage("region_derivation", lambda: SkinToneAnalyzer(None, skin_config, face=face))
+    records.append(record)
+
+    def cluster():
+        analyzer.face_clusters(use_process_pool=False)
+        if analyzer.mouth_mask_to_process is not None:
+            analyzer.mouth_clusters(use_process_pool=False)
+
+    _, record = profile_stage("clustering", cluster)
+    records.append(record)
+
+    skin_tones, record = profile_stage("skin_tones", analyzer.get_skin_tones)
+    record["skin_tone_masks_mb"] = sum(s.compact_mask.nbytes for s in skin_tones) / MB
+    records.append(record)
+    return records, shape
+
+
+"""
+parse_budgets parses STAGE=MB arguments into a dictionary.
+"""
+
+
+def parse_budgets(budgets: list) -> dict:
+    result = {}
+    for budget in budgets:
+        stage, _, mb = budget.partition("=")
+        if stage not in STAGES:
+            raise ValueError("Stage: " + stage + " is not one of: " + str(STAGES))
+        result[stage] = float(mb)
+    return result
+
+
+"""
+check_budgets returns a description of every record of given results that exceeds its budget. Stage budgets apply to
+the traced peak of the stage and max_rss_mb to the peak RSS.
+"""
+
+
+def check_budgets(results: list, stage_budgets: dict, max_rss_mb: float) -> list:
+    violations = []
+    for result in results:
+        for record in result["stages"]:
+            label = result["input"] + " " + record["stage"]
+            budget = stage_budgets.get(record["stage"])
+            if budget is not None and record["traced_peak_mb"] > budget:
+                violations.append(label + ": traced peak " + str(round(record["traced_peak_mb"], 1)) +
+                                  " MB exceeds budget of " + str(budget) + " MB")
+            if max_rss_mb is not None and record["peak_rss_mb"] > max_rss_mb:
+                violations.append(label + ": peak RSS " + str(round(record["peak_rss_mb"], 1)) +
+                                  " MB exceeds budget of " + str(max_rss_mb) + " MB")
+    return violations
+
+
+def print_table(results: list):
+    print("{0:<24} {1:>6} {2:<18} {3:>14} {4:>12} {5:>12} {6:>14}".format(
+        "input", "MP", "stage", "traced peak MB", "retained MB", "peak RSS MB", "RSS increase MB"))
+    for result in results:
+        for record in result["stages"]:
+            print("{0:<24} {1:>6.1f} {2:<18} {3:>14.1f} {4:>12.1f} {5:>12.1f} {6:>14.1f}".format(
+                result["input"][-24:], result["megapixels"], record["stage"], record["traced_peak_mb"],
+                record["retained_mb"], record["peak_rss_mb"], record["peak_rss_increase_mb"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile peak memory of analyzer stages')
+    parser.add_argument('--sizes', type=float, nargs='*', default=[1, 4, 12, 24, 48],
+                        help="synthetic image sizes in megapixels")
+    parser.add_argument('--images', nargs='*', default=[],
+                        help="recorded images to profile (predictions cached in .hdf5 files next to them)")
+    parser.add_argument('--stage-budget', nargs='*', default=[],
+                        help="traced peak budgets in MB as STAGE=MB, stages: " + ", ".join(STAGES))
+    parser.add_argument('--max-rss-mb', type=float, default=None, help="budget for the peak RSS of any stage")
+    parser.add_argument('--output', required=False, help="path of JSON file to write results to")
+    args = parser.parse_args()
+    stage_budgets = parse_budgets(args.stage_budget)
+
+    tracemalloc.start()
+    results = []
+    for megapixels in args.sizes:
+        height, width = megapixels_to_shape(megapixels)
+        image, _ = synthetic_face(height, width)
+        preds = synthetic_predictions(height, width)
+        stages, _ = profile_face(lambda: Face(image=image, preds=preds))
+        results.append({"input": "synthetic " + str(megapixels) + " MP", "megapixels": height * width / 1e6,
+                        "shape": [height, width], "stages": stages})
+        del image, preds
+    for image_path in args.images:
+        stages, (height, width) = profile_face(lambda: Face(image_path=image_path))
+        results.append({"input": image_path, "megapixels": height * width / 1e6, "shape": [height, width],
+                        "stages": stages})
+    tracemalloc.stop()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    violations = check_budgets(results, stage_budgets, args.max_rss_mb)
+    for violation in violations:
+        print("Budget exceeded: ", violation)
+    if len(violations) > 0:
+        sys.exit(1)
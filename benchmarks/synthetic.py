@@ -0,0 +1,132 @@
+"""
+synthetic generates synthetic face images and masks that can be fed to SkinToneAnalyzer without running the Mask
+RCNN model. Used by the benchmarks in this directory.
+"""
+import cv2
+import numpy as np
+
+from facemagik.common import label_id_map, FACE, EYE_OPEN, EYEBROW, NOSE, UPPER_LIP, LOWER_LIP, TEETH
+from facemagik.skintone import SkinDetectionConfig, FaceMaskInfo, NoseMiddlePoint
+
+# Number of image rows generated at a time.
+ROW_BLOCK = 512
+
+# Sides of the face that can be in shadow.
+SHADOW_SIDES = ("left", "right", "none")
+
+# Face parts as (center x, center y, semi axis x, semi axis y) ellipses relative to the image width and height.
+FACE_ELLIPSE = (0.5, 0.5, 0.3, 0.4)
+EYE_ELLIPSES = [(0.4, 0.4, 0.05, 0.02), (0.6, 0.4, 0.05, 0.02)]
+EYEBROW_ELLIPSES = [(0.4, 0.35, 0.06, 0.01), (0.6, 0.35, 0.06, 0.01)]
+NOSE_ELLIPSE = (0.5, 0.5, 0.04, 0.07)
+MOUTH_ELLIPSE = (0.5, 0.7, 0.08, 0.025)
+UPPER_LIP_ELLIPSE = (0.5, 0.67, 0.09, 0.012)
+LOWER_LIP_ELLIPSE = (0.5, 0.73, 0.09, 0.012)
+
+"""
+ellipse_mask returns a boolean (height, width) mask of given ellipse (relative to the image width and height).
+"""
+
+
+def ellipse_mask(height: int, width: int, cx: float, cy: float, ax: float, ay: float) -> np.ndarray:
+    m = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(m, (int(cx * width), int(cy * height)), (max(1, int(ax * width)), max(1, int(ay * height))), 0, 0,
+                360, 1, -1)
+    return m.astype(bool)
+
+"""
+synthetic_face returns an RGB image (height, width, 3) of a lit skin colored face on a dark background and the
+FaceMaskInfo describing it. By default the face is lit from the left (shadow on the right) so that clustering sees a
+range of brightness values. light_gradient is the drop in relative brightness from the lit to the shadow side,
+shadow_side is "left", "right" or "none" (uniformly lit) and teeth_visible selects between bright teeth and dark
+closed lips in the mouth region.
+"""
+
+
+def synthetic_face(height: int, width: int, seed: int = 0, light_gradient: float = 0.55, shadow_side: str = "right",
+                   teeth_visible: bool = True) -> (np.ndarray, FaceMaskInfo):
+    if shadow_side not in SHADOW_SIDES:
+        raise ValueError("Shadow side: " + shadow_side + " is not one of: " + str(SHADOW_SIDES))
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 30, dtype=np.uint8)
+
+    face_mask = ellipse_mask(height, width, *FACE_ELLIPSE)
+
+    # Skin color with brightness falling towards the shadow side and some noise.
+    skin = np.array([186, 141, 112], dtype=float)
+    if shadow_side == "none":
+        shading = np.full(width, 1.15 - light_gradient / 2)
+    else:
+        shading = np.linspace(1.15, 1.15 - light_gradient, width)
+        if shadow_side == "left":
+            shading = shading[::-1]
+    shading = (skin[np.newaxis, :] * shading[:, np.newaxis]).astype(np.float32)[np.newaxis, :, :]
+
+    # Computed in blocks of rows to keep memory bounded for large images.
+    for row in range(0, height, ROW_BLOCK):
+        rows = slice(row, min(row + ROW_BLOCK, height))
+        noise = 4 * rng.standard_normal((rows.stop - row, width, 1), dtype=np.float32)
+        skin_block = np.clip(shading + noise, 0, 255).astype(np.uint8)
+        block_mask = face_mask[rows]
+        image[rows][block_mask] = skin_block[block_mask]
+
+    left_eye_mask = ellipse_mask(height, width, *EYE_ELLIPSES[0])
+    right_eye_mask = ellipse_mask(height, width, *EYE_ELLIPSES[1])
+    mouth_mask = ellipse_mask(height, width, *MOUTH_ELLIPSE)
+
+    # Teeth are bright and slightly yellow, closed lips are dark red.
+    mouth_color = [235, 225, 205] if teeth_visible else [120, 60, 60]
+    teeth = np.clip(np.array(mouth_color, dtype=float) + rng.normal(0, 6, (np.count_nonzero(mouth_mask), 3)), 0, 255)
+    image[mouth_mask] = teeth.astype(np.uint8)
+    image[left_eye_mask] = 60
+    image[right_eye_mask] = 60
+
+    face_mask_to_process = np.bitwise_and(face_mask, np.bitwise_not(
+        np.bitwise_or(np.bitwise_or(left_eye_mask, right_eye_mask), mouth_mask)))
+
+    face_mask_info = FaceMaskInfo(face_mask_to_process=face_mask_to_process, mouth_mask_to_process=mouth_mask,
+                                  nose_middle_point=NoseMiddlePoint(x=width // 2, y=int(height * 0.55)),
+                                  left_eye_mask=left_eye_mask, right_eye_mask=right_eye_mask)
+    return image, face_mask_info
+
+
+"""
+synthetic_predictions returns Mask RCNN style predictions (class ids and dense (height, width, N) boolean masks) of
+the face drawn by synthetic_face with the same size, so that the Face class can be constructed without the model.
+Lips are thin bands above and below the mouth and the mouth is labeled as teeth if teeth_visible is true.
+"""
+
+
+def synthetic_predictions(height: int, width: int, teeth_visible: bool = True) -> dict:
+    parts = [(FACE, FACE_ELLIPSE), (EYE_OPEN, EYE_ELLIPSES[0]), (EYE_OPEN, EYE_ELLIPSES[1]),
+             (EYEBROW, EYEBROW_ELLIPSES[0]), (EYEBROW, EYEBROW_ELLIPSES[1]), (NOSE, NOSE_ELLIPSE),
+             (UPPER_LIP, UPPER_LIP_ELLIPSE), (LOWER_LIP, LOWER_LIP_ELLIPSE)]
+    if teeth_visible:
+        parts.append((TEETH, MOUTH_ELLIPSE))
+
+    masks = np.zeros((height, width, len(parts)), dtype=bool)
+    for i, (_, ellipse) in enumerate(parts):
+        masks[:, :, i] = ellipse_mask(height, width, *ellipse)
+    return {"class_ids": np.array([label_id_map[label] for label, _ in parts]), "masks": masks}
+
+
+"""
+synthetic_config returns a SkinDetectionConfig for given synthetic image.
+"""
+
+
+def synthetic_config(image: np.ndarray) -> SkinDetectionConfig:
+    skin_config = SkinDetectionConfig()
+    skin_config.IMAGE = image
+    skin_config.USE_NEW_CLUSTERING_ALGORITHM = True
+    return skin_config
+
+
+"""
+megapixels_to_shape returns a (height, width) with 4:3 aspect ratio for given number of megapixels.
+"""
+
+
+def megapixels_to_shape(megapixels: float) -> (int, int):
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    return int(round(width * 3 / 4)), width
@@ -0,0 +1,184 @@
+"""
+batch analyzes a directory (or manifest file) of face images on a pool of processes and streams per image results to
+a JSONL file. The Mask RCNN model is loaded once per worker process. Images that already have a successful result in
+the output file are skipped so that an interrupted run can be resumed by running the same command again.
+
+Example (from the src directory):
+    python -m facemagik.batch --input <image dir or manifest> --weights <weights path> --output results.jsonl
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+import multiprocessing as mp
+
+from .common import ExecutionMode
+from .skintone import SkinToneAnalyzer, SkinDetectionConfig
+
+# Extensions of image files picked up from an input directory.
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Model used by the analyzer in each worker process. Set by init_worker.
+_worker_model = None
+
+"""
+collect_image_paths returns the image paths in given directory, or listed in given manifest file (one path per line,
+relative paths are resolved against the manifest's directory).
+"""
+
+
+def collect_image_paths(input_path: str) -> list:
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, f) for f in os.listdir(input_path) if
+                      os.path.isfile(os.path.join(input_path, f)) and f.lower().endswith(IMAGE_EXTENSIONS))
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    paths = []
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            paths.append(line if os.path.isabs(line) else os.path.join(base_dir, line))
+    return paths
+
+
+"""
+completed_image_paths returns the set of image paths that have a successful result in given JSONL output file.
+"""
+
+
+def completed_image_paths(output_path: str) -> set:
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written last line of an interrupted run.
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["image"])
+    return completed
+
+
+"""
+init_worker loads the Mask RCNN model once in each worker process.
+"""
+
+
+def init_worker(weights_path: str):
+    global _worker_model
+    _worker_model = SkinToneAnalyzer.construct_model(weights_path)
+
+
+"""
+skin_tone_to_dict returns a JSON serializable dictionary of given skin tone (without its mask).
+"""
+
+
+def skin_tone_to_dict(skin_tone) -> dict:
+    return {"rgb": skin_tone.rgb, "hsv": skin_tone.hsv, "hls": skin_tone.hls,
+            "percent_of_face_mask": skin_tone.percent_of_face_mask, "profile": skin_tone.profile}
+
+
+"""
+analyze_image runs the analyzer on given image path and returns the result record. Runs in a worker process.
+"""
+
+
+def analyze_image(image_path: str) -> dict:
+    start_time = time.time()
+    record = {"image": image_path}
+    try:
+        skin_config = SkinDetectionConfig()
+        skin_config.IMAGE_PATH = image_path
+        # Workers are already parallel, so stages run inline in each worker.
+        skin_config.EXECUTION_MODE = ExecutionMode.INLINE
+
+        analyzer = SkinToneAnalyzer(_worker_model, skin_config)
+        segmentation_seconds = time.time() - start_time
+        result = analyzer.analyze()
+
+        brightness_and_direction = result.scene_brightness_and_direction
+        record.update({
+            "status": "ok",
+            "skin_tones": [skin_tone_to_dict(sk) for sk in result.skin_tones],
+            "primary_light_direction": brightness_and_direction.primary_light_direction.name,
+            "percent_per_direction": {d.name: p for d, p in brightness_and_direction.percent_per_direction.items()},
+            "scene_brightness_value": int(brightness_and_direction.scene_brightness_value),
+            "scene_brightness": brightness_and_direction.scene_brightness().name,
+            "timings": dict(result.stage_timings, segmentation=segmentation_seconds),
+        })
+    except Exception as e:
+        record.update({"status": "error", "error": type(e).__name__ + ": " + str(e)})
+
+    record["seconds"] = time.time() - start_time
+    return record
+
+
+"""
+run_batch analyzes every image in given input that does not yet have a successful result in the output file and
+appends results to it as they complete. Prints throughput and latency percentiles at the end.
+"""
+
+
+def run_batch(input_path: str, weights_path: str, output_path: str, num_processes: int = None):
+    if num_processes is None:
+        num_processes = mp.cpu_count()
+
+    image_paths = collect_image_paths(input_path)
+    completed = completed_image_paths(output_path)
+    remaining = [p for p in image_paths if p not in completed]
+    print("Total images: ", len(image_paths), " already completed: ", len(image_paths) - len(remaining),
+          " remaining: ", len(remaining))
+    if len(remaining) == 0:
+        return
+
+    # Terminate a partially written last line of an interrupted run.
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+        if needs_newline:
+            with open(output_path, "a") as f:
+                f.write("\n")
+
+    start_time = time.time()
+    latencies = []
+    num_errors = 0
+    with open(output_path, "a") as out, mp.Pool(processes=num_processes, initializer=init_worker,
+                                                initargs=(weights_path,)) as pool:
+        for record in pool.imap_unordered(analyze_image, remaining):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if record["status"] == "ok":
+                latencies.append(record["seconds"])
+            else:
+                num_errors += 1
+                print("Failed: ", record["image"], " error: ", record["error"])
+            print("done: ", len(latencies) + num_errors, "/", len(remaining))
+
+    total_seconds = time.time() - start_time
+    print("\nProcessed ", len(remaining), " images in ", round(total_seconds, 2), " seconds (",
+          round(len(remaining) / total_seconds, 3), " images/sec) with ", num_errors, " errors")
+    if len(latencies) > 0:
+        print("Latency p50: ", round(float(np.percentile(latencies, 50)), 3), "s p95: ",
+              round(float(np.percentile(latencies, 95)), 3), "s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Batch skin tone analysis')
+    parser.add_argument('--input', required=True, metavar="directory of images or manifest file")
+    parser.add_argument('--weights', required=True, metavar="path to Mask RCNN weights")
+    parser.add_argument('--output', required=True, metavar="path to JSONL results file")
+    parser.add_argument('--processes', type=int, required=False, metavar="number of worker processes")
+    args = parser.parse_args()
+
+    # Multiprocessing library should use fork mode.
+    mp.set_start_method('fork')
+
+    run_batch(args.input, args.weights, args.output, args.processes)
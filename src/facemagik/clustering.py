@@ -0,0 +1,81 @@
+"""
+clustering is the registry of clustering strategies used to break the face and mouth masks into clusters. A strategy
+is registered under a name and selected with the CLUSTERING_ALGORITHM field of SkinDetectionConfig (which falls back
+to USE_NEW_CLUSTERING_ALGORITHM when empty), so that new clustering engines can be added and compared without
+changing the analyzer.
+
+A clusterer is called as clusterer(ycrcb_image, mask_to_process, region, skin_config, use_process_pool) and returns
+the list of cluster masks in decreasing order of brightness and the effective color map (effective color to the
+union of its cluster masks, in the same order). If use_process_pool is false the clusterer must not fork processes.
+
+The built in strategies (kmeans and brightness_bands) are registered by the skintone module.
+"""
+from dataclasses import dataclass
+from typing import Callable, List
+from .common import ClusteringRegion
+
+# Recursive Kmeans on brightness (SkinToneAnalyzer.make_clusters).
+KMEANS = "kmeans"
+
+# Fixed width brightness bands (SkinToneAnalyzer.__make_new_clusters).
+BRIGHTNESS_BANDS = "brightness_bands"
+
+"""
+ClusteringStrategy is a registered clusterer. config_fields are the SkinDetectionConfig fields (other than the
+algorithm selection) that affect its output; clusters are memoized per value of these fields.
+"""
+
+
+@dataclass
+class ClusteringStrategy:
+    name: str
+    clusterer: Callable
+    config_fields: List[str]
+
+
+_strategies = {}
+
+"""
+register_clustering_strategy registers given clusterer under given name, replacing any strategy with the same name.
+"""
+
+
+def register_clustering_strategy(name: str, clusterer: Callable, config_fields: List[str] = ()):
+    _strategies[name] = ClusteringStrategy(name=name, clusterer=clusterer, config_fields=list(config_fields))
+
+
+"""
+get_clustering_strategy returns the strategy registered under given name.
+"""
+
+
+def get_clustering_strategy(name: str) -> ClusteringStrategy:
+    if name not in _strategies:
+        raise ValueError("Clustering algorithm: " + name + " is not one of: " + str(clustering_strategy_names()))
+    return _strategies[name]
+
+
+def clustering_strategy_names() -> List[str]:
+    return list(_strategies.keys())
+
+
+"""
+clustering_algorithm returns the name of the clustering strategy selected by given skin detection config.
+"""
+
+
+def clustering_algorithm(skin_config) -> str:
+    if skin_config.CLUSTERING_ALGORITHM != "":
+        return skin_config.CLUSTERING_ALGORITHM
+    return BRIGHTNESS_BANDS if skin_config.USE_NEW_CLUSTERING_ALGORITHM else KMEANS
+
+
+"""
+cluster breaks given mask of given region into clusters with the strategy selected by given skin detection config.
+"""
+
+
+def cluster(ycrcb_image, mask_to_process, region: ClusteringRegion, skin_config, use_process_pool: bool = True) -> (
+        list, dict):
+    strategy = get_clustering_strategy(clustering_algorithm(skin_config))
+    return strategy.clusterer(ycrcb_image, mask_to_process, region, skin_config, use_process_pool)
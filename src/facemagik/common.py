@@ -73,22 +73,111 @@ class LightDirection(Enum):
 
 
 """
-Container class for skin tone.
+How independent analysis stages (like scene brightness and light direction) are executed.
+"""
+
+
+class ExecutionMode(Enum):
+    PROCESS = 1  # Run stages in a separate process. Images are passed through shared memory.
+    THREAD = 2  # Run stages on a thread pool. Works well since the heavy work is in OpenCV/NumPy which release the GIL.
+    INLINE = 3  # Run stages one after another in the calling thread.
+
+
+"""
+Region of the face that a clustering strategy is asked to cluster.
+"""
+
+
+class ClusteringRegion(Enum):
+    FACE = 1
+    MOUTH = 2
+
+
+"""
+Compact storage for a boolean image mask: the bounding box of the mask and the packed bits of the mask within it.
+A mask covering a small part of a large image takes a small fraction of the memory of the full boolean array.
+"""
+
+
+@dataclass(frozen=True)
+class CompactMask:
+    # (height, width) of the full mask.
+    shape: tuple
+    # (top, left, height, width) of the bounding box of the mask.
+    bbox: tuple
+    # Packed bits of the mask within the bounding box.
+    bits: np.ndarray
+
+    """
+    from_mask returns the compact form of given boolean mask.
+    """
+
+    @staticmethod
+    def from_mask(mask: np.ndarray):
+        rows = np.flatnonzero(np.any(mask, axis=1))
+        if len(rows) == 0:
+            return CompactMask(shape=tuple(mask.shape), bbox=(0, 0, 0, 0), bits=np.zeros(0, dtype=np.uint8))
+        cols = np.flatnonzero(np.any(mask[rows[0]:rows[-1] + 1], axis=0))
+        top, left = int(rows[0]), int(cols[0])
+        height, width = int(rows[-1]) - top + 1, int(cols[-1]) - left + 1
+        return CompactMask(shape=tuple(mask.shape), bbox=(top, left, height, width),
+                           bits=np.packbits(mask[top:top + height, left:left + width]))
+
+    """
+    to_mask returns the full boolean mask.
+    """
+
+    def to_mask(self) -> np.ndarray:
+        mask = np.zeros(self.shape, dtype=bool)
+        top, left, height, width = self.bbox
+        if height > 0:
+            mask[top:top + height, left:left + width] = np.unpackbits(self.bits, count=height * width).reshape(
+                (height, width)).astype(bool)
+        return mask
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+"""
+Container class for skin tone. The face mask of the skin tone is stored as a CompactMask and the full boolean mask
+is only materialized when the face_mask attribute is read.
 """
 
 
-@dataclass
 class SkinTone:
     DISPLAY_P3 = "displayP3"
 
-    rgb: []
-    hsv: []
-    hls: []
-    gray: float
-    ycrcb: []
-    percent_of_face_mask: float
-    face_mask: np.ndarray
-    profile: str
+    __slots__ = ("rgb", "hsv", "hls", "gray", "ycrcb", "percent_of_face_mask", "compact_mask", "profile")
+
+    def __init__(self, rgb: list, hsv: list, hls: list, gray: float, ycrcb: list, percent_of_face_mask: float,
+                 face_mask, profile: str):
+        self.rgb = rgb
+        self.hsv = hsv
+        self.hls = hls
+        self.gray = gray
+        self.ycrcb = ycrcb
+        self.percent_of_face_mask = percent_of_face_mask
+        self.face_mask = face_mask
+        self.profile = profile
+
+    @property
+    def face_mask(self) -> np.ndarray:
+        if self.compact_mask is None:
+            return None
+        return self.compact_mask.to_mask()
+
+    @face_mask.setter
+    def face_mask(self, mask):
+        if mask is None or isinstance(mask, CompactMask):
+            self.compact_mask = mask
+        else:
+            self.compact_mask = CompactMask.from_mask(mask)
+
+    def __repr__(self):
+        return "SkinTone(rgb={0}, hsv={1}, hls={2}, gray={3}, ycrcb={4}, percent_of_face_mask={5}, profile={6})".format(
+            self.rgb, self.hsv, self.hls, self.gray, self.ycrcb, self.percent_of_face_mask, self.profile)
 
 
 """
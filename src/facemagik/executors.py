@@ -0,0 +1,25 @@
+"""
+executors has the thread pool shared by analysis stages that run in ExecutionMode.THREAD.
+"""
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of threads in the shared thread pool.
+MAX_THREADS = min(8, os.cpu_count() or 1)
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+"""
+get_thread_pool returns the thread pool shared by all analyzers in this process. The pool is created on first use.
+"""
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=MAX_THREADS, thread_name_prefix="facemagik")
+        return _thread_pool
@@ -5,17 +5,19 @@ and albedo estimation of a given image.
 """
 import os
 import numpy as np
-import time
 import cv2
 import h5py
 import argparse
-import json
 import tensorflow as tf
 import math
 from scipy import ndimage
 from scipy.optimize import minimize
 from sklearn.cluster import KMeans
 from .utils import ImageUtils
+from .rasterizer import rasterize_triangles
+from .irradiance import irradiance_maps, estimate_lighting, m_matrix
+from .mesh_bundle import load_face_mesh
+from .tracing import span, traced
 from .common import (
     EYE_OPEN,
     EYEBALL,
@@ -44,7 +46,10 @@ class Face:
     ID_LABEL_MAP = {v: k for k, v in label_id_map.items()}
     WINDOW_SIZE = 900
 
-    def __init__(self, image_path="", maskrcnn_model=None, image=None):
+    # Margin (as a fraction of the face size) added around a face when cropping it out of a multi face image.
+    FACE_CROP_MARGIN = 0.1
+
+    def __init__(self, image_path="", maskrcnn_model=None, image=None, preds=None):
         if image is None:
             self.image = ImageUtils.read_rgb_image(image_path)
         else:
@@ -60,29 +65,36 @@ class Face:
 
         self.brightImage = ImageUtils.to_brightImage(self.image)
 
-        if image is None:
+        if preds is not None:
+            self.preds = preds
+        elif image is None:
             self.preds = self.detect_face(image_path, maskrcnn_model)
         else:
             self.preds = self.make_predictions(maskrcnn_model)
 
+        # Predictions of every face in the image. Each face is a list of prediction indices (the face followed by its
+        # parts) and faces are in decreasing order of size. This object represents the first (largest) face, use
+        # get_face to get the others.
+        self.all_preds = self.preds
+        self.face_instances = Face.split_face_instances(self.all_preds)
+        if len(self.face_instances) > 1:
+            self.preds = self.face_predictions(0)
+
+        # (top, bottom, left, right) of this face in the original image if it was cropped out of it.
+        self.roi = None
+
         self.faceMask = self.get_face_mask()
         self.noseMiddlePoint = ImageUtils.mean_coordinate(self.get_nose_keypoints())
 
         if image_path.startswith("server/data") or image_path.startswith("server/video"):
-            # Load lighting, normals and face vertices from JSON file located at image path.
+            # Load lighting, normals and face vertices of the directory of the image path (cached per directory).
             dirPath, _ = os.path.split(image_path)
-            with open(os.path.join(dirPath, "face_vertices.json"), "r") as f:
-                self.faceVertices = np.array(json.load(f))
-            with open(os.path.join(dirPath, "lighting.json"), "r") as f:
-                self.lighting = json.load(f)
-            with open(os.path.join(dirPath, "triangle_indices.json"), "r") as f:
-                self.triangleIndices = np.array(json.load(f))
-            with open(os.path.join(dirPath, "vertex_normals.json"), "r") as f:
-                self.vertexNormals = np.array(json.load(f))
-                self.compute_vertex_normals()
-
-            # Constants array from Ramamoorthi's paper.
-            self.c = np.array([0.429043, 0.511664, 0.743125, 0.886227, 0.247708])
+            mesh = load_face_mesh(dirPath)
+            self.faceVertices = mesh.face_vertices
+            self.lighting = mesh.lighting
+            self.triangleIndices = mesh.triangle_indices
+            self.vertexNormals = mesh.vertex_normals
+            self.compute_vertex_normals()
 
         if image_path != "":
             self.windowName = image_path
@@ -159,14 +171,11 @@ class Face:
         self.show_masks([self.background_mask()], [skinTone])
 
     """
-    show_irrad_mask shows given irradiance mask.
+    show_irrad_mask shows given irradiance map (H x W x 3).
     """
 
-    def show_irrad_mask(self, vertices, E):
-        clone = self.image.copy()
-        clone[:, :] = [0, 0, 0]
-        clone[vertices[:, 0], vertices[:, 1]] = np.clip(E * 100, None, 255).astype(np.uint8)
-        return ImageUtils.show(clone)
+    def show_irrad_mask(self, E_map):
+        return ImageUtils.show(np.clip(E_map * 100, 0, 255).astype(np.uint8))
 
     """
     detect_face will detect face in the given image and segment out eyes,
@@ -179,14 +188,12 @@ class Face:
         hdf5_file_name = os.path.splitext(image_name)[0] + ".hdf5"
         hdf5_full_path = os.path.join(face_mask_dir_path, hdf5_file_name)
         if os.path.exists(hdf5_full_path):
-            start_time = time.time()
             preds = {Face.CLASS_IDS_KEY: []}
-            with h5py.File(hdf5_full_path, 'r') as f:
+            with span("read_hdf5_predictions", path=hdf5_full_path), h5py.File(hdf5_full_path, 'r') as f:
                 preds[Face.MASKS_KEY] = np.zeros((self.image.shape[0], self.image.shape[1], len(f.keys())), dtype=bool)
                 for i, class_id in enumerate(f.keys()):
                     preds[Face.CLASS_IDS_KEY].append(int(class_id.split("-")[0]))
                     preds[Face.MASKS_KEY][:, :, i] = f[class_id][:]
-            print("\nReading from Hdf5 file: ", time.time() - start_time, " seconds \n")
             return preds
 
         print("Running on {}".format(image_path))
@@ -209,11 +216,9 @@ class Face:
     Makes predictions using given Mask RCNN model on image.
     """
 
+    @traced("mask_rcnn_detect")
     def make_predictions(self, maskrcnn_model) -> list:
-        start_time = time.time()
-        preds = maskrcnn_model.detect([self.image], verbose=1)[0]
-        print("\nModel detection time: ", time.time() - start_time, " seconds\n")
-        return preds
+        return maskrcnn_model.detect([self.image], verbose=1)[0]
 
     """
     specularity returns the 2D specularity array as shown in Shen et. al. 2009.
@@ -232,7 +237,7 @@ class Face:
     """
     compute_specular_masks computes and stores all specular regions on the face  as the dominant
     specular region (based on maximum mean specularity).
-    It is 3D array of shape (IMG_WIDTH, IMG_HEIGHT, num regions).
+    The regions are stored as a label image (specularLabels) and the labels of the regions (specularIndices).
     """
 
     def compute_specular_masks(self):
@@ -241,26 +246,22 @@ class Face:
 
         # Label all specular clusters.
         label_im, nb_labels = ndimage.label(bImg)
-        sizes = ndimage.sum(bImg, label_im, range(nb_labels + 1))
-        indices = np.transpose(np.argwhere(sizes > int(len(np.nonzero(self.faceMask)[0]) / 1000.0)))
+        sizes = ImageUtils.label_sizes(label_im, nb_labels)
+        indices = np.flatnonzero(sizes > int(len(np.nonzero(self.faceMask)[0]) / 1000.0))
 
-        self.allMasks = np.repeat(label_im[:, :, np.newaxis], len(indices), axis=2) == indices
-        if self.allMasks.shape[2] == 0:
+        self.specularLabels = label_im
+        self.specularIndices = indices
+        if len(indices) == 0:
             # No masks found.
             print("NO Specular Masks found")
             return
 
-        domMask = self.allMasks[:, :, np.argmax(
-            np.sum(np.where(self.allMasks, np.repeat(beta[:, :, np.newaxis], len(indices), axis=2), 0), axis=(0, 1)) /
-            sizes[indices])]
+        # Dominant mask has the largest mean specularity.
+        domLabel = ImageUtils.dominant_label(label_im, indices, beta)
+        domMask = label_im == domLabel
 
         # Find surrounding region of given dominant mask.
-        contours, _ = cv2.findContours(cv2.threshold((200 * domMask).astype(np.uint8), 127, 255, 0)[1], cv2.RETR_TREE,
-                                       cv2.CHAIN_APPROX_SIMPLE)
-        cimg = np.zeros(self.image.shape[:2])
-        cv2.drawContours(cimg, contours, 0, color=255, thickness=3)
-
-        self.surrMask = cimg == 255
+        self.surrMask = ImageUtils.label_boundary_mask(label_im, domLabel, ndimage.find_objects(label_im)[domLabel - 1])
         self.domMask = np.bitwise_and(np.bitwise_xor(domMask, self.surrMask), domMask)
 
     """
@@ -407,10 +408,7 @@ class Face:
         beta = self.specularity()
         self.diffuse = (self.image.copy() - k * np.repeat(beta[:, :, np.newaxis], 3, axis=2)).astype(np.uint8)
 
-        specularMask = np.zeros(self.image.shape[:2], dtype=bool)
-        for i in range(self.allMasks.shape[2]):
-            # domdomMask, _ = self.biclustering_Kmeans(self.allMasks[:, :, i])
-            specularMask = np.bitwise_or(specularMask, self.allMasks[:, :, i])
+        specularMask = np.isin(self.specularLabels, self.specularIndices)
 
         self.specularMask = specularMask
         return specularMask
@@ -440,6 +438,42 @@ class Face:
 
         return np.array(colors)
 
+    """
+    irradiance_maps returns the irradiance (E) and the linear RGB diffuse albedo of the face as H x W x 3 float32 maps
+    over the pixels covered by the face mesh (normalMask), using the spherical harmonic coefficients of the lighting
+    as they are (see adjust_SH_coeffs). If use_m_matrix is false the irradiance is computed with the SH basis instead
+    of Ramamoorthi's M matrix. Returns None if the face has no lighting.
+    """
+
+    def irradiance_maps(self, use_m_matrix: bool = True) -> (np.ndarray, np.ndarray):
+        if self.lighting is None:
+            return None
+        return irradiance_maps(self.image, self.normalMap, self.normalMask, self.lighting, use_m_matrix)
+
+    """
+    estimate_lighting fits the spherical harmonic coefficients of the lighting to the normals and colors of the pixels
+    of given mask covered by the face mesh (all of normalMask by default) instead of using the coefficients provided
+    by ARKit, see irradiance.estimate_lighting. The estimate replaces the lighting of the face (no sign adjustment is
+    needed) and is returned.
+    """
+
+    def estimate_lighting(self, mask=None, use_m_matrix: bool = True, robust_iterations: int = 5) -> dict:
+        pixels = self.normalMask if mask is None else np.bitwise_and(self.normalMask, mask)
+        self.lighting = estimate_lighting(self.normalMap[pixels], self.image[pixels], use_m_matrix=use_m_matrix,
+                                          robust_iterations=robust_iterations)
+        return self.lighting
+
+    """
+    show_diffuse shows given irradiance and albedo maps, the albedo is gamma corrected on a white background.
+    """
+
+    def show_diffuse(self, E_map, albedo_map):
+        self.show_irrad_mask(E_map)
+
+        clone = np.full(self.image.shape, 255, dtype=np.uint8)
+        clone[self.normalMask] = np.clip(ImageUtils.add_gamma_correction_matrix(albedo_map[self.normalMask]), 0, 255)
+        ImageUtils.show(clone)
+
     """
     compute_diffuse will compute the irradiance(E) and diffuse color using the
     normals of the face and spherical harmonic coefficients.
@@ -449,30 +483,8 @@ class Face:
         if self.lighting == None:
             return
 
-        tVertices = self.allVerts.astype(int)
         self.adjust_SH_coeffs()
-
-        Mred = self.compute_M_matrix(self.lighting["red"])
-        Mgreen = self.compute_M_matrix(self.lighting["green"])
-        Mblue = self.compute_M_matrix(self.lighting["blue"])
-
-        # Convert to n by 4 array.
-        normals = np.append(self.allVertNorms, np.ones((self.allVertNorms.shape[0], 1)), 1)
-        Ered = np.einsum('ij,ij->i', normals @ Mred, normals)
-        Egreen = np.einsum('ij,ij->i', normals @ Mgreen, normals)
-        Eblue = np.einsum('ij,ij->i', normals @ Mblue, normals)
-        E = np.column_stack((Ered, Egreen, Eblue))
-        self.show_irrad_mask(tVertices, E)
-
-        # Calculate intensity at each vertex point and show.
-        clone = self.image.copy()
-        intensity = ImageUtils.add_gamma_correction_matrix(
-            ImageUtils.remove_gamma_correction_matrix(clone[tVertices[:, 0], tVertices[:, 1]]) * ((1.0) / E))
-        clone[:, :] = [255, 255, 255]
-        for i in range(intensity.shape[0]):
-            cv2.circle(clone, (tVertices[i, 1], tVertices[i, 0]), 1,
-                       [int(intensity[i][0]), int(intensity[i][1]), int(intensity[i][2])], 1)
-        ImageUtils.show(clone)
+        self.show_diffuse(*self.irradiance_maps(use_m_matrix=True))
 
     """
     compute_diffuse_new will compute the irradiance(E) and diffuse color using the
@@ -484,32 +496,8 @@ class Face:
         if self.lighting == None:
             return
 
-        tVertices = self.allVerts.astype(int)
         self.adjust_SH_coeffs()
-
-        # Compute harmonic functions.
-        normals = self.allVertNorms
-        normMatrix = np.column_stack((np.ones((normals.shape[0], 1)), normals[:, 1], normals[:, 2], normals[:, 0],
-                                      normals[:, 1] * normals[:, 0], normals[:, 1] * normals[:, 2],
-                                      (3 * normals[:, 2] * normals[:, 2]) - 1, normals[:, 2] * normals[:, 0],
-                                      (normals[:, 0] * normals[:, 0]) - (normals[:, 1] * normals[:, 1])))
-
-        Ered = normMatrix @ self.lighting["red"]
-        Egreen = normMatrix @ self.lighting["green"]
-        Eblue = normMatrix @ self.lighting["blue"]
-        E = np.column_stack((Ered, Egreen, Eblue))
-        self.show_irrad_mask(tVertices, E)
-
-        # Calculate intensity at each vertex point and show.
-        print("E, verts: ", E.shape[0], tVertices.shape[0])
-        clone = self.image.copy()
-        intensity = ImageUtils.add_gamma_correction_matrix(
-            ImageUtils.remove_gamma_correction_matrix(clone[tVertices[:, 0], tVertices[:, 1]]) * ((1.0) / E))
-        clone[:, :] = [255, 255, 255]
-        for i in range(intensity.shape[0]):
-            cv2.circle(clone, (tVertices[i, 1], tVertices[i, 0]), 1,
-                       [int(intensity[i][0]), int(intensity[i][1]), int(intensity[i][2])], 1)
-        ImageUtils.show(clone)
+        self.show_diffuse(*self.irradiance_maps(use_m_matrix=False))
 
     """
     adjust_SH_coeffs adjusts the signs of SH coefficients provided by ARKit depending
@@ -602,62 +590,19 @@ class Face:
     """
 
     def compute_M_matrix(self, L):
-        c = self.c
-        return np.array([
-            [c[0] * L[8], c[0] * L[4], c[0] * L[7], c[1] * L[3]], [c[0] * L[4], -c[0] * L[8], c[0] * L[5], c[1] * L[1]],
-            [c[0] * L[7], c[0] * L[5], c[2] * L[6], c[1] * L[2]],
-            [c[1] * L[3], c[1] * L[1], c[1] * L[2], c[3] * L[0] - c[4] * L[6]],
-        ])
+        return m_matrix(L)
 
     """
-    compute_vertex_normals computes all vertices and their normals
-    from given mesh vertices (and corresponding normals).
+    compute_vertex_normals computes all vertices (pixels covered by the face mesh) and their normals interpolated
+    from given mesh vertices (and corresponding normals). All triangles are rasterized in batches and the normals are
+    also written to a per pixel normal map (normalMap) with the pixels covered by the mesh in normalMask.
     """
 
     def compute_vertex_normals(self):
-        faceVertices = self.faceVertices
-        triangleIndices = np.reshape(self.triangleIndices, (-1, 3))
-        triangle2DArr = faceVertices[triangleIndices]
-        vertexNormals = self.vertexNormals[triangleIndices]
-        allAreas = self.compute_areas(triangle2DArr)
-
-        minxarr = np.min(triangle2DArr[:, :, 0], axis=1)
-        maxxarr = np.max(triangle2DArr[:, :, 0], axis=1)
-        minyarr = np.min(triangle2DArr[:, :, 1], axis=1)
-        maxyarr = np.max(triangle2DArr[:, :, 1], axis=1)
-
-        self.allVerts = np.zeros((0, 2))
-        self.allVertNorms = np.zeros((0, 3))
-        for i in range(triangle2DArr.shape[0]):
-            bbox = np.mgrid[minxarr[i]:maxxarr[i], minyarr[i]:maxyarr[i]].reshape(2, -1).T
-            v0, v1, v2 = triangle2DArr[i][0], triangle2DArr[i][1], triangle2DArr[i][2]
-
-            bLen = bbox.shape[0]
-            areas0 = self.compute_areas(
-                np.stack((np.repeat(v1[np.newaxis, :], bLen, axis=0), np.repeat(v2[np.newaxis, :], bLen, axis=0), bbox),
-                         axis=1))
-            areas1 = self.compute_areas(
-                np.stack((np.repeat(v2[np.newaxis, :], bLen, axis=0), np.repeat(v0[np.newaxis, :], bLen, axis=0), bbox),
-                         axis=1))
-            areas2 = self.compute_areas(
-                np.stack((np.repeat(v0[np.newaxis, :], bLen, axis=0), np.repeat(v1[np.newaxis, :], bLen, axis=0), bbox),
-                         axis=1))
-
-            areas = np.stack((areas0, areas1, areas2), axis=1)
-            tol = 0.001
-            masks = np.stack((areas0 >= tol, areas1 >= tol, areas2 >= tol), axis=1)
-
-            idxArr = np.where(masks.all(axis=1))[0]
-            w = areas[idxArr] / allAreas[i]
-
-            # n by 3 where n is len(idxArr)
-            vNorms = w @ vertexNormals[i]
-            verts = bbox[idxArr]
-            if verts.shape[0] == 0:
-                continue
-
-            self.allVerts = np.concatenate((self.allVerts, verts), axis=0)
-            self.allVertNorms = np.concatenate((self.allVertNorms, vNorms), axis=0)
+        self.normalMap = np.zeros(self.image.shape[:2] + (3,), dtype=np.float32)
+        self.normalMask = np.zeros(self.image.shape[:2], dtype=bool)
+        self.allVerts, self.allVertNorms = rasterize_triangles(self.faceVertices, self.triangleIndices,
+                                                               self.vertexNormals, self.normalMap, self.normalMask)
 
     """
     compute_areas will compute deteminants of given array of triangle(each triangle is represented by 3 vertices).
@@ -678,6 +623,95 @@ class Face:
         raise Exception("Face not found in image")
 
 
+    """
+    split_face_instances groups predictions by face. It returns one list of prediction indices per FACE instance,
+    with the FACE index first, in decreasing order of face size. Every other part (eyes, nose, lips etc.) is assigned
+    to the face whose mask contains most of it, and parts outside every face mask (like hair or ears) to the face with
+    the closest center. With less than two faces, all predictions form a single group.
+    """
+
+    @staticmethod
+    def split_face_instances(preds) -> list:
+        class_ids = list(preds[Face.CLASS_IDS_KEY])
+        masks = preds[Face.MASKS_KEY]
+        face_indices = [i for i, class_id in enumerate(class_ids) if Face.ID_LABEL_MAP[class_id] == FACE]
+        if len(face_indices) <= 1:
+            return [list(range(len(class_ids)))]
+
+        face_indices.sort(key=lambda i: -np.count_nonzero(masks[:, :, i]))
+        face_boxes = [ImageUtils.bbox(masks[:, :, i]) for i in face_indices]
+        instances = [[i] for i in face_indices]
+        for i, class_id in enumerate(class_ids):
+            if Face.ID_LABEL_MAP[class_id] == FACE or not np.any(masks[:, :, i]):
+                continue
+
+            rmin, cmin, w, h = ImageUtils.bbox(masks[:, :, i])
+            part = masks[rmin:rmin + h, cmin:cmin + w, i]
+            overlaps = [np.count_nonzero(np.bitwise_and(part, masks[rmin:rmin + h, cmin:cmin + w, f])) for f in
+                        face_indices]
+            if max(overlaps) > 0:
+                instances[int(np.argmax(overlaps))].append(i)
+                continue
+
+            # Distance to face centers relative to face size.
+            distances = [math.hypot(rmin + h / 2.0 - (fr + fh / 2.0), cmin + w / 2.0 - (fc + fw / 2.0)) / max(fw, fh)
+                         for fr, fc, fw, fh in face_boxes]
+            instances[int(np.argmin(distances))].append(i)
+
+        return instances
+
+    """
+    num_faces returns the number of faces detected in the image.
+    """
+
+    def num_faces(self) -> int:
+        return len(self.face_instances)
+
+    """
+    face_predictions returns the predictions dictionary of face at given index (in decreasing order of size),
+    optionally cropped to given (top, bottom, left, right) region.
+    """
+
+    def face_predictions(self, index: int, roi: tuple = None) -> dict:
+        indices = self.face_instances[index]
+        masks = self.all_preds[Face.MASKS_KEY]
+        if roi is not None:
+            masks = masks[roi[0]:roi[1], roi[2]:roi[3]]
+        return {Face.CLASS_IDS_KEY: [self.all_preds[Face.CLASS_IDS_KEY][i] for i in indices],
+                Face.MASKS_KEY: masks[:, :, indices]}
+
+    """
+    face_roi returns the (top, bottom, left, right) region of the image that contains the face at given index and
+    all of its parts, expanded by FACE_CROP_MARGIN.
+    """
+
+    def face_roi(self, index: int) -> tuple:
+        masks = self.all_preds[Face.MASKS_KEY]
+        combined = np.any(masks[:, :, self.face_instances[index]], axis=2)
+        rmin, cmin, w, h = ImageUtils.bbox(combined)
+        margin_r, margin_c = int(h * Face.FACE_CROP_MARGIN), int(w * Face.FACE_CROP_MARGIN)
+        return max(rmin - margin_r, 0), min(rmin + h + margin_r, combined.shape[0]), max(cmin - margin_c, 0), min(
+            cmin + w + margin_c, combined.shape[1])
+
+    """
+    get_face returns a Face for the face at given index (in decreasing order of size) cropped out of this image. The
+    predictions are reused so the model is not run again.
+    """
+
+    def get_face(self, index: int):
+        roi = self.face_roi(index)
+        face = Face(image=np.ascontiguousarray(self.image[roi[0]:roi[1], roi[2]:roi[3]]),
+                    preds=self.face_predictions(index, roi))
+        face.roi = roi
+        return face
+
+    """
+    get_faces returns a cropped Face for each face in the image, largest first.
+    """
+
+    def get_faces(self) -> list:
+        return [self.get_face(i) for i in range(self.num_faces())]
+
     """
     get_face_mask returns face mask numpy array from stored dictionary of face predictions.
     """
@@ -1272,8 +1306,8 @@ class Face:
     """
 
     @staticmethod
+    @traced()
     def iterate_effective_color_map(srgb_image: np.ndarray, effective_color_map: dict, all_cluster_masks: list):
-        start_time = time.time()
         ycrcb_image = ImageUtils.to_YCrCb(srgb_image)
         result_color_map = effective_color_map.copy()
         for i in range(5):
@@ -1295,7 +1329,6 @@ class Face:
                     temp_color_map[best_hue] = np.bitwise_or(temp_color_map[best_hue], m)
             result_color_map = temp_color_map.copy()
 
-        print("\ncolor map iteration time: ", time.time() - start_time, " seconds\n")
         return result_color_map
 
     """
@@ -1304,8 +1337,8 @@ class Face:
     """
 
     @staticmethod
+    @traced()
     def combine_masks_close_to_each_other(srgb_image, effective_color_map):
-        start_time = time.time()
         still_rem = True
         temp_close_masks = sorted([effective_color_map[e] for e in effective_color_map],
                                   key=lambda m: 255.0 - np.mean(ImageUtils.to_brightImage(srgb_image)[m], axis=0)[2])
@@ -1333,7 +1366,6 @@ class Face:
                 still_rem = True
                 break
 
-        print("\n combining masks time: ", time.time() - start_time, " seconds\n")
         return temp_close_masks
 
     """
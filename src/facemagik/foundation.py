@@ -0,0 +1,131 @@
+"""
+foundation simulates a layer of foundation applied over skin using Kubelka-Munk theory. All computations are
+broadcast over (skins, foundations, depths, wavelengths) tensors so that many foundations and depths can be evaluated
+against a user's skin tones in one batched computation.
+"""
+import cv2
+import colour
+import numpy as np
+
+from dataclasses import dataclass
+from .spectral import SpectralContext, get_spectral_context
+
+# Assume 2 mm is the maximum depth of the foundation.
+MAX_DEPTH = 2
+
+# Fraction of incident light reflected at the surface of the foundation layer.
+SURFACE_REFLECTANCE = 0.1
+
+"""
+FoundationSimulation contains the results of a batched foundation simulation over S skins, F foundations and D
+depths. reflectance is (S,F,D,36), rgb is (S,F,D,3) sRGB (float 0-255), lab is (S,F,D,3) and delta_e is (S,F,D)
+CIEDE2000 difference against the target colors or None if no targets were given.
+"""
+
+
+@dataclass
+class FoundationSimulation:
+    reflectance: np.ndarray
+    rgb: np.ndarray
+    lab: np.ndarray
+    delta_e: np.ndarray = None
+
+    """
+    best_match returns the (foundation index, depth index) pair with the smallest delta_e for each skin as a (S,2)
+    numpy array.
+    """
+
+    def best_match(self) -> np.ndarray:
+        if self.delta_e is None:
+            raise ValueError("Simulation has no target colors to match against")
+        num_skins = self.delta_e.shape[0]
+        flat_idx = np.argmin(np.reshape(self.delta_e, (num_skins, -1)), axis=1)
+        return np.stack(np.unravel_index(flat_idx, self.delta_e.shape[1:]), axis=1)
+
+
+"""
+foundation_layer returns the reflectance and transmittance (F,D,36) of given foundation reflectances (F,36) at given
+depths (D,) expressed as percent (between 0-1 inclusive) of the maximum depth. The given foundation reflectance is
+assumed to be at infinite optical depth.
+"""
+
+
+def foundation_layer(R_foundation: np.ndarray, depths: np.ndarray):
+    R_foundation = np.asarray(R_foundation, dtype=float)
+    R_foundation = np.reshape(R_foundation, (-1, R_foundation.shape[-1]))[:, np.newaxis, :]
+    x = np.reshape(np.asarray(depths, dtype=float), (1, -1, 1)) * MAX_DEPTH
+
+    a = 0.5 * ((1 / R_foundation) + R_foundation)
+    b = np.sqrt((a ** 2) - 1)
+
+    rho = R_foundation * 0.99
+    S = (np.arctanh(b / (a - rho)) - np.arctanh(b / a)) / (b * MAX_DEPTH)
+
+    # Reflectance and transmittance at given depths.
+    denom = a * np.sinh(b * S * x) + b * np.cosh(b * S * x)
+    return np.sinh(b * S * x) / denom, b / denom
+
+
+"""
+layer_over_skin returns the reflectance (S,F,D,36) of foundation layers with reflectance and transmittance (F,D,36)
+applied over given skin reflectances (S,36).
+"""
+
+
+def layer_over_skin(R_skin: np.ndarray, R_layer: np.ndarray, T_layer: np.ndarray,
+                    surface_reflectance: float = SURFACE_REFLECTANCE) -> np.ndarray:
+    R_skin = np.reshape(np.asarray(R_skin, dtype=float), (-1, 1, 1, R_layer.shape[-1]))
+    R_layer = R_layer[np.newaxis]
+    T_layer = T_layer[np.newaxis]
+    return (1 - surface_reflectance) * (R_layer + ((T_layer ** 2) * R_skin) / (1 - (R_skin * R_layer))) + \
+           surface_reflectance
+
+
+"""
+srgb_to_lab converts given sRGB array (...,3) with float values between 0-255 to CIE Lab (...,3) the same way as
+ImageUtils.delta_cie2000_v2. An empty array gives an empty (0,3) array.
+"""
+
+
+def srgb_to_lab(rgb_arr: np.ndarray) -> np.ndarray:
+    rgb_arr = np.asarray(rgb_arr, dtype=float)
+    if rgb_arr.size == 0:
+        # OpenCV rejects empty images.
+        return np.zeros(rgb_arr.shape if rgb_arr.ndim > 1 else (0, 3))
+    flat = np.reshape(rgb_arr, (-1, 3))[np.newaxis, :, :].astype(np.float32) / 255
+    return np.reshape(cv2.cvtColor(flat, cv2.COLOR_RGB2LAB), rgb_arr.shape).astype(float)
+
+
+"""
+render returns the sRGB array (...,3) with float values between 0-255 of given reflectance array (...,36).
+"""
+
+
+def render(reflectance: np.ndarray, ctx: SpectralContext = None) -> np.ndarray:
+    if ctx is None:
+        ctx = get_spectral_context()
+    rgb = np.clip(ctx.sd_to_linear_rgb(reflectance), 0, 1)
+    return 255 * np.where(rgb < 0.0031308, 12.92 * rgb, 1.055 * np.power(rgb, 1 / 2.4) - 0.055)
+
+
+"""
+simulate_foundation applies every foundation (F,36) at every depth (D,) over every skin (S,36) and renders the
+results. If target_rgb (S,3) is given, CIEDE2000 difference of each rendered color against the target of its skin is
+also returned.
+"""
+
+
+def simulate_foundation(R_skin: np.ndarray, R_foundation: np.ndarray, depths: np.ndarray,
+                        target_rgb: np.ndarray = None, surface_reflectance: float = SURFACE_REFLECTANCE,
+                        ctx: SpectralContext = None) -> FoundationSimulation:
+    R_layer, T_layer = foundation_layer(R_foundation, depths)
+    reflectance = layer_over_skin(R_skin, R_layer, T_layer, surface_reflectance)
+    rgb = render(reflectance, ctx)
+    lab = srgb_to_lab(rgb)
+
+    delta_e = None
+    if target_rgb is not None:
+        target_lab = srgb_to_lab(np.reshape(np.asarray(target_rgb, dtype=float), (-1, 1, 1, 3)))
+        delta_e = colour.delta_E(lab, np.broadcast_to(target_lab, lab.shape), method='CIE 2000')
+
+    return FoundationSimulation(reflectance=reflectance, rgb=rgb, lab=lab, delta_e=delta_e)
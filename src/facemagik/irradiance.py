@@ -0,0 +1,151 @@
+"""
+irradiance computes the irradiance (E) at surface normals lit by 9 spherical harmonic (SH) lighting coefficients per
+color channel (like the ones ARKit provides) and the diffuse albedo obtained by removing that shading from an image.
+Everything is computed in batched numpy operations over all normals at once, and the per pixel versions write
+H x W x 3 float32 maps over the pixels covered by a rasterized normal map so that they can be used without a display.
+The coefficients can also be estimated from the normals and observed colors of an image (estimate_lighting).
+
+Lighting is a dictionary with "red", "green" and "blue" keys, each with 9 SH coefficients in ARKit order:
+L00, L1-1, L10, L11, L2-2, L2-1, L20, L21, L22.
+"""
+import numpy as np
+
+from .spectral import linearize_srgb
+
+# Constants from Ramamoorthi and Hanrahan's irradiance environment map paper.
+RAMAMOORTHI_CONSTANTS = np.array([0.429043, 0.511664, 0.743125, 0.886227, 0.247708])
+
+CHANNELS = ["red", "green", "blue"]
+
+"""
+sh_basis returns the (n,9) SH basis functions (without normalization constants) of given (n,3) normals, in the
+order of the lighting coefficients.
+"""
+
+
+def sh_basis(normals: np.ndarray) -> np.ndarray:
+    x, y, z = normals[:, 0], normals[:, 1], normals[:, 2]
+    return np.column_stack((np.ones(normals.shape[0]), y, z, x, x * y, y * z, 3 * z * z - 1, z * x, x * x - y * y))
+
+
+"""
+lighting_matrix returns the (9,3) matrix of SH coefficients of given lighting, one column per channel.
+"""
+
+
+def lighting_matrix(lighting: dict) -> np.ndarray:
+    return np.column_stack([np.asarray(lighting[channel], dtype=float) for channel in CHANNELS])
+
+
+"""
+m_matrix returns the 4x4 matrix M of Ramamoorthi's paper for given 9 SH coefficients of a channel. The irradiance at
+a unit normal n is [n 1] M [n 1]^T.
+"""
+
+
+def m_matrix(L) -> np.ndarray:
+    c = RAMAMOORTHI_CONSTANTS
+    return np.array([
+        [c[0] * L[8], c[0] * L[4], c[0] * L[7], c[1] * L[3]], [c[0] * L[4], -c[0] * L[8], c[0] * L[5], c[1] * L[1]],
+        [c[0] * L[7], c[0] * L[5], c[2] * L[6], c[1] * L[2]],
+        [c[1] * L[3], c[1] * L[1], c[1] * L[2], c[3] * L[0] - c[4] * L[6]],
+    ])
+
+
+"""
+irradiance_basis returns the (n,9) matrix B of given (n,3) normals such that B @ L is the irradiance under the 9 SH
+coefficients L of a channel. If use_m_matrix is true B is [n 1] M [n 1]^T of Ramamoorthi's M matrix expanded per
+coefficient, otherwise it is the SH basis.
+"""
+
+
+def irradiance_basis(normals: np.ndarray, use_m_matrix: bool = True) -> np.ndarray:
+    normals = np.asarray(normals, dtype=float)
+    if not use_m_matrix:
+        return sh_basis(normals)
+
+    c = RAMAMOORTHI_CONSTANTS
+    x, y, z = normals[:, 0], normals[:, 1], normals[:, 2]
+    return np.column_stack((np.full(normals.shape[0], c[3]), 2 * c[1] * y, 2 * c[1] * z, 2 * c[1] * x,
+                            2 * c[0] * x * y, 2 * c[0] * y * z, c[2] * z * z - c[4], 2 * c[0] * z * x,
+                            c[0] * (x * x - y * y)))
+
+
+"""
+irradiance returns the (n,3) irradiance of given (n,3) normals under given lighting. If use_m_matrix is true the
+irradiance is computed with Ramamoorthi's M matrix, otherwise it is the SH basis multiplied by the coefficients.
+"""
+
+
+def irradiance(normals: np.ndarray, lighting: dict, use_m_matrix: bool = True) -> np.ndarray:
+    return irradiance_basis(normals, use_m_matrix) @ lighting_matrix(lighting)
+
+
+"""
+estimate_lighting fits the 9 SH coefficients of each channel to given (n,3) normals and their observed (n,3) sRGB
+(0-255) colors, so that the irradiance (see irradiance with the same use_m_matrix) times albedo matches the linear
+colors. albedo is a scalar, a (3,) color or a (n,3) array in linear RGB; with the default of 1 the fitted lighting
+also absorbs the color of the surface. All channels are solved with a single least squares solve.
+
+If robust_iterations is positive, the fit is refined with that many iterations of iteratively reweighted least
+squares using Huber weights (residuals above huber_k times the robust standard deviation of the residuals of a
+channel are down weighted), so that specular highlights, eyes and hair have little influence. Iterations stop early
+once the coefficients change by less than tol. Returns the lighting dictionary.
+"""
+
+
+def estimate_lighting(normals: np.ndarray, rgb: np.ndarray, albedo=1.0, use_m_matrix: bool = True,
+                      robust_iterations: int = 0, huber_k: float = 1.345, tol: float = 1e-6) -> dict:
+    if len(normals) < 9:
+        raise ValueError("Need at least 9 pixels to estimate lighting, got: " + str(len(normals)))
+
+    B = irradiance_basis(normals, use_m_matrix)
+    target = linearize_srgb(rgb) / albedo
+
+    L, _, _, _ = np.linalg.lstsq(B, target, rcond=None)
+    for _ in range(robust_iterations):
+        residuals = target - B @ L
+        # Median absolute deviation scaled to the standard deviation of normally distributed residuals.
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals, axis=0)), axis=0)
+        threshold = huber_k * np.maximum(scale, np.finfo(float).eps)
+        weights = np.minimum(1.0, threshold / np.maximum(np.abs(residuals), np.finfo(float).eps))
+
+        # Weighted normal equations of all channels, (3,9,9) and (3,9,1).
+        BtW = np.transpose(weights.T[:, :, np.newaxis] * B, (0, 2, 1))
+        new_L = np.linalg.solve(BtW @ B, BtW @ target.T[:, :, np.newaxis])[:, :, 0].T
+        converged = np.max(np.abs(new_L - L)) < tol
+        L = new_L
+        if converged:
+            break
+
+    return {channel: L[:, i] for i, channel in enumerate(CHANNELS)}
+
+
+"""
+diffuse_albedo returns the (n,3) linear RGB albedo of given (n,3) sRGB (0-255) colors shaded by given (n,3)
+irradiance. Albedo is 0 wherever the irradiance is not positive.
+"""
+
+
+def diffuse_albedo(rgb: np.ndarray, E: np.ndarray) -> np.ndarray:
+    linear = linearize_srgb(rgb)
+    lit = E > 0
+    return np.divide(linear, E, out=np.zeros(linear.shape), where=lit)
+
+
+"""
+irradiance_maps returns the irradiance and the linear RGB diffuse albedo of given image as H x W x 3 float32 maps,
+computed at the pixels of normal_mask from the per pixel normals of normal_map (see
+rasterizer.rasterize_triangles). Both maps are 0 outside normal_mask.
+"""
+
+
+def irradiance_maps(image: np.ndarray, normal_map: np.ndarray, normal_mask: np.ndarray, lighting: dict,
+                    use_m_matrix: bool = True) -> (np.ndarray, np.ndarray):
+    E_map = np.zeros(normal_mask.shape + (3,), dtype=np.float32)
+    albedo_map = np.zeros(normal_mask.shape + (3,), dtype=np.float32)
+
+    E = irradiance(normal_map[normal_mask], lighting, use_m_matrix)
+    E_map[normal_mask] = E
+    albedo_map[normal_mask] = diffuse_albedo(image[normal_mask], E)
+    return E_map, albedo_map
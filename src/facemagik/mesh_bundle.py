@@ -0,0 +1,139 @@
+"""
+mesh_bundle stores the face mesh and lighting recorded with server/data and server/video images (face_vertices.json,
+triangle_indices.json, vertex_normals.json and lighting.json) as a set of .npy files in the same directory, so that
+the arrays are memory mapped instead of parsed from JSON for every image or video frame. Loaded meshes are cached per
+directory until its files change; directories without a bundle, or whose JSON files are newer than the bundle, fall
+back to (and cache) the JSON files.
+
+Convert existing directories with:
+    python -m facemagik.mesh_bundle server/data/<name> server/video/<name>
+"""
+import argparse
+import json
+import os
+import numpy as np
+
+from dataclasses import dataclass
+from .irradiance import CHANNELS
+
+# JSON file and .npy file of every mesh array.
+MESH_FILES = {
+    "face_vertices": ("face_vertices.json", "face_vertices.npy"),
+    "triangle_indices": ("triangle_indices.json", "triangle_indices.npy"),
+    "vertex_normals": ("vertex_normals.json", "vertex_normals.npy"),
+}
+
+LIGHTING_JSON = "lighting.json"
+
+# Spherical harmonic coefficients (3,9), one row per channel in irradiance.CHANNELS order.
+LIGHTING_NPY = "lighting.npy"
+
+# Cache of loaded meshes keyed by directory, with the modification times of the files they were loaded from.
+_MESH_CACHE = {}
+
+"""
+FaceMesh is the mesh and lighting of a directory. The mesh arrays are read only (memory mapped if loaded from a
+bundle) and shared by every caller, lighting is the dictionary of SH coefficients per channel.
+"""
+
+
+@dataclass
+class FaceMesh:
+    face_vertices: np.ndarray
+    triangle_indices: np.ndarray
+    vertex_normals: np.ndarray
+    lighting: dict
+
+
+"""
+file_mtimes returns the modification time of every JSON and .npy file of given directory (None for missing files).
+"""
+
+
+def file_mtimes(dir_path: str) -> dict:
+    names = [name for files in MESH_FILES.values() for name in files] + [LIGHTING_JSON, LIGHTING_NPY]
+    mtimes = {}
+    for name in names:
+        path = os.path.join(dir_path, name)
+        mtimes[name] = os.path.getmtime(path) if os.path.exists(path) else None
+    return mtimes
+
+
+"""
+bundle_exists returns True if given directory has a complete bundle that is not older than any of its JSON files
+(for example after the directory is recorded again).
+"""
+
+
+def bundle_exists(dir_path: str, mtimes: dict = None) -> bool:
+    mtimes = file_mtimes(dir_path) if mtimes is None else mtimes
+    for json_name, npy_name in list(MESH_FILES.values()) + [(LIGHTING_JSON, LIGHTING_NPY)]:
+        if mtimes[npy_name] is None:
+            return False
+        if mtimes[json_name] is not None and mtimes[json_name] > mtimes[npy_name]:
+            return False
+    return True
+
+
+"""
+convert_json_to_bundle writes the .npy bundle of the JSON mesh and lighting files in given directory.
+"""
+
+
+def convert_json_to_bundle(dir_path: str):
+    for json_name, npy_name in MESH_FILES.values():
+        with open(os.path.join(dir_path, json_name), "r") as f:
+            np.save(os.path.join(dir_path, npy_name), np.array(json.load(f)))
+    with open(os.path.join(dir_path, LIGHTING_JSON), "r") as f:
+        lighting = json.load(f)
+    np.save(os.path.join(dir_path, LIGHTING_NPY), np.array([lighting[channel] for channel in CHANNELS], dtype=float))
+
+
+def read_bundle(dir_path: str) -> FaceMesh:
+    arrays = {name: np.load(os.path.join(dir_path, npy), mmap_mode="r") for name, (_, npy) in MESH_FILES.items()}
+    lighting = np.load(os.path.join(dir_path, LIGHTING_NPY))
+    return FaceMesh(lighting={channel: lighting[i] for i, channel in enumerate(CHANNELS)}, **arrays)
+
+
+def read_json(dir_path: str) -> FaceMesh:
+    arrays = {}
+    for name, (json_name, _) in MESH_FILES.items():
+        with open(os.path.join(dir_path, json_name), "r") as f:
+            arrays[name] = np.array(json.load(f))
+            arrays[name].flags.writeable = False
+    with open(os.path.join(dir_path, LIGHTING_JSON), "r") as f:
+        lighting = json.load(f)
+    return FaceMesh(lighting={channel: np.array(lighting[channel], dtype=float) for channel in CHANNELS}, **arrays)
+
+
+"""
+load_face_mesh returns the mesh and lighting of given directory, from its bundle if it is up to date and from its
+JSON files otherwise. A cached mesh is reloaded when the modification time of any of the files of the directory
+changes. Every call returns a new copy of the lighting (callers like Face.adjust_SH_coeffs change the coefficients in
+place) while the mesh arrays are shared.
+"""
+
+
+def load_face_mesh(dir_path: str) -> FaceMesh:
+    mtimes = file_mtimes(dir_path)
+    if dir_path not in _MESH_CACHE or _MESH_CACHE[dir_path][0] != mtimes:
+        mesh = read_bundle(dir_path) if bundle_exists(dir_path, mtimes) else read_json(dir_path)
+        _MESH_CACHE[dir_path] = (mtimes, mesh)
+    _, mesh = _MESH_CACHE[dir_path]
+    return FaceMesh(face_vertices=mesh.face_vertices, triangle_indices=mesh.triangle_indices,
+                    vertex_normals=mesh.vertex_normals,
+                    lighting={channel: np.copy(L) for channel, L in mesh.lighting.items()})
+
+
+def clear_mesh_cache():
+    _MESH_CACHE.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert JSON face mesh and lighting files to .npy bundles')
+    parser.add_argument('directories', nargs='+', help="directories with face_vertices.json, lighting.json etc.")
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        convert_json_to_bundle(directory)
+        print("Converted: ", directory)
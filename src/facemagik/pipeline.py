@@ -0,0 +1,133 @@
+"""
+pipeline is a small executor for a DAG of analysis stages. Each stage declares the named values it needs as inputs
+and the named values it produces as outputs. Stages whose inputs are available run concurrently on the given executor,
+every value is computed exactly once per run and the time taken by each stage is recorded.
+"""
+import time
+
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+from .tracing import span, current_span
+
+"""
+Stage is a single node of the DAG. fn is called with the stage inputs as positional arguments (in the declared
+order) and must return a tuple of outputs (in the declared order), or a single value if the stage has one output.
+"""
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable
+    inputs: List[str]
+    outputs: List[str]
+
+
+"""
+PipelineResult contains every value known at the end of a run (including the initial values) and the latency in
+seconds of each stage that ran.
+"""
+
+
+@dataclass
+class PipelineResult:
+    values: Dict[str, object] = field(default_factory=dict)
+    stage_timings: Dict[str, float] = field(default_factory=dict)
+
+    def __getitem__(self, name: str):
+        return self.values[name]
+
+
+class StageDAG:
+    def __init__(self):
+        self.stages: List[Stage] = []
+        self.producers: Dict[str, Stage] = {}
+
+    """
+    add_stage adds a stage to the DAG. Every output must be produced by exactly one stage.
+    """
+
+    def add_stage(self, name: str, fn: Callable, inputs: List[str], outputs: List[str]):
+        stage = Stage(name=name, fn=fn, inputs=list(inputs), outputs=list(outputs))
+        for output in stage.outputs:
+            if output in self.producers:
+                raise ValueError("Output: " + output + " of stage: " + name + " is already produced by stage: " +
+                                 self.producers[output].name)
+            self.producers[output] = stage
+        self.stages.append(stage)
+        return self
+
+    """
+    required_stages returns the stages needed to compute given targets from given initial values.
+    """
+
+    def required_stages(self, targets: List[str], initial: Dict[str, object]) -> List[Stage]:
+        required = []
+        visiting = set()
+
+        def visit(value: str):
+            if value in initial:
+                return
+            if value not in self.producers:
+                raise ValueError("No stage produces value: " + value)
+            stage = self.producers[value]
+            if stage in required:
+                return
+            if stage.name in visiting:
+                raise ValueError("Cycle detected at stage: " + stage.name)
+            visiting.add(stage.name)
+            for inp in stage.inputs:
+                visit(inp)
+            visiting.remove(stage.name)
+            required.append(stage)
+
+        for target in targets:
+            visit(target)
+        return required
+
+    """
+    run computes given targets starting from given initial values. If executor is None, stages run one after
+    another in the calling thread, otherwise stages whose inputs are ready are submitted to the executor
+    concurrently. The executor must not be one whose threads are blocked waiting on this run.
+    """
+
+    def run(self, initial: Dict[str, object], targets: List[str], executor: Executor = None) -> PipelineResult:
+        result = PipelineResult(values=dict(initial))
+        pending = self.required_stages(targets, initial)
+        # Stages may run on executor threads, so their spans are attached to the span of the caller explicitly.
+        parent_span = current_span()
+
+        def run_stage(stage: Stage):
+            start_time = time.time()
+            with span(stage.name, parent=parent_span):
+                out = stage.fn(*[result.values[inp] for inp in stage.inputs])
+            return out, time.time() - start_time
+
+        def store(stage: Stage, out, latency: float):
+            if len(stage.outputs) == 1:
+                out = (out,)
+            for name, value in zip(stage.outputs, out):
+                result.values[name] = value
+            result.stage_timings[stage.name] = latency
+
+        if executor is None:
+            for stage in pending:
+                store(stage, *run_stage(stage))
+            return result
+
+        running = {}
+        while pending or running:
+            ready = [s for s in pending if all(inp in result.values for inp in s.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                running[executor.submit(run_stage, stage)] = stage
+            if not running:
+                raise ValueError("Stages: " + str([s.name for s in pending]) + " can never run")
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                store(stage, *future.result())
+
+        return result
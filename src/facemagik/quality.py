@@ -0,0 +1,140 @@
+"""
+quality is a fast pre-screen of input images that runs before face segmentation. It measures exposure (from the
+brightness histogram), the fraction of clipped highlights, colorfulness and blur on a heavily downsampled copy of the
+image so that images that are too dark, over exposed, washed out or blurry are flagged (or rejected) in a few
+milliseconds instead of after Mask RCNN and clustering have run.
+"""
+import time
+import cv2
+import numpy as np
+
+from dataclasses import dataclass, field
+from typing import List
+from .utils import ImageUtils
+
+
+class PoorImageQualityException(ValueError):
+    pass
+
+
+"""
+Container class for the image quality measurements. Percentages are relative to all pixels of the downsampled image
+and brightness values are in the range [0, 100].
+"""
+
+
+@dataclass
+class ImageQuality:
+    median_brightness: float
+    underexposed_percent: float
+    overexposed_percent: float
+    clipped_percent: float
+    colorfulness: float
+    sharpness: float
+    # Reasons the image failed the quality gate. Empty if the image is acceptable.
+    issues: List[str] = field(default_factory=list)
+    # Time taken to assess the image.
+    seconds: float = 0.0
+
+    def is_acceptable(self) -> bool:
+        return len(self.issues) == 0
+
+
+"""
+downsample returns given image resized (preserving aspect ratio) so that its longest side is at most max_side. Large
+images are first subsampled (nearest neighbor) to 4 times max_side since area interpolation over the full image
+would dominate the cost of the quality check.
+"""
+
+
+def downsample(image: np.ndarray, max_side: int) -> np.ndarray:
+    scale = max_side * 4.0 / max(image.shape[:2])
+    if scale < 1:
+        size = (max(int(image.shape[1] * scale), 1), max(int(image.shape[0] * scale), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_NEAREST)
+    scale = max_side / max(image.shape[:2])
+    if scale >= 1:
+        return image
+    size = (max(int(image.shape[1] * scale), 1), max(int(image.shape[0] * scale), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+"""
+read_downsampled_image reads the RGB image at given path decoded at a reduced resolution (an eighth of the size in
+each dimension for JPEG images, which is much cheaper than a full decode) and downsamples it to max_side.
+"""
+
+
+def read_downsampled_image(image_path: str, max_side: int) -> np.ndarray:
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_8)
+    if image is None:
+        raise ValueError("Failed to read image: " + image_path)
+    return downsample(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), max_side)
+
+
+"""
+assess_image_quality measures the quality of given RGB image (already downsampled) and checks the measurements
+against the thresholds in given skin detection config.
+"""
+
+
+def assess_image_quality(image: np.ndarray, skin_config) -> ImageQuality:
+    start_time = time.time()
+    total_points = image.shape[0] * image.shape[1]
+
+    # Exposure from the histogram of per pixel brightness (max of RGB).
+    hist = np.bincount(np.max(image, axis=2).ravel(), minlength=256)
+    cumulative = np.cumsum(hist)
+    median_brightness = int(np.searchsorted(cumulative, total_points / 2.0)) * (100.0 / 255.0)
+    brightness = np.arange(256) * (100.0 / 255.0)
+    underexposed_percent = np.sum(hist[brightness <= 8]) * 100.0 / total_points
+    overexposed_percent = np.sum(hist[brightness >= 94]) * 100.0 / total_points
+
+    clipped_percent = np.count_nonzero(np.any(image == 255, axis=2)) * 100.0 / total_points
+    colorfulness = ImageUtils.image_colorfulness(image)
+    sharpness = cv2.Laplacian(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), cv2.CV_64F).var()
+
+    issues = []
+    if median_brightness < skin_config.QUALITY_MIN_MEDIAN_BRIGHTNESS:
+        issues.append("too dark (median brightness: " + str(round(median_brightness, 2)) + ")")
+    if underexposed_percent > skin_config.QUALITY_MAX_UNDEREXPOSED_PERCENT:
+        issues.append("underexposed (percent: " + str(round(underexposed_percent, 2)) + ")")
+    if overexposed_percent > skin_config.QUALITY_MAX_OVEREXPOSED_PERCENT:
+        issues.append("overexposed (percent: " + str(round(overexposed_percent, 2)) + ")")
+    if clipped_percent > skin_config.QUALITY_MAX_CLIPPED_PERCENT:
+        issues.append("clipped highlights (percent: " + str(round(clipped_percent, 2)) + ")")
+    if colorfulness < skin_config.QUALITY_MIN_COLORFULNESS:
+        issues.append("washed out colors (colorfulness: " + str(round(colorfulness, 2)) + ")")
+    if sharpness < skin_config.QUALITY_MIN_SHARPNESS:
+        issues.append("blurry (sharpness: " + str(round(sharpness, 2)) + ")")
+
+    return ImageQuality(median_brightness=median_brightness, underexposed_percent=underexposed_percent,
+                        overexposed_percent=overexposed_percent, clipped_percent=clipped_percent,
+                        colorfulness=colorfulness, sharpness=sharpness, issues=issues,
+                        seconds=time.time() - start_time)
+
+
+"""
+check_image_quality assesses the image of given skin detection config (IMAGE_PATH or IMAGE) on a downsampled copy.
+Poor quality images are reported and, if the config's QUALITY_REJECT_POOR_IMAGES is true, rejected with a
+PoorImageQualityException.
+"""
+
+
+def check_image_quality(skin_config) -> ImageQuality:
+    start_time = time.time()
+    if skin_config.IMAGE_PATH != "":
+        image = read_downsampled_image(skin_config.IMAGE_PATH, skin_config.QUALITY_MAX_SIDE)
+    else:
+        image = downsample(skin_config.IMAGE, skin_config.QUALITY_MAX_SIDE)
+
+    quality = assess_image_quality(image, skin_config)
+    quality.seconds = time.time() - start_time
+    if quality.is_acceptable():
+        return quality
+
+    message = "Poor image quality for config: " + str(skin_config) + ": " + ", ".join(quality.issues)
+    if skin_config.QUALITY_REJECT_POOR_IMAGES:
+        raise PoorImageQualityException(message)
+    print(message)
+    return quality
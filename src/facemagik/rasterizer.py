@@ -0,0 +1,93 @@
+"""
+rasterizer interpolates per vertex attributes (like normals) of a 2D projected triangle mesh over the pixels covered
+by each triangle using barycentric coordinates. All triangles are rasterized in batched numpy operations over chunks
+of pixels instead of one triangle at a time.
+
+Pixels are sampled exactly as Face.compute_vertex_normals always did: the bounding box of a triangle is sampled at
+unit steps starting from its minimum corner (np.mgrid order, first coordinate major) and a sample is inside the
+triangle if all three sub triangle areas are at least AREA_TOLERANCE. Samples are returned in triangle order, so a
+pixel covered by two overlapping triangles appears twice.
+"""
+import numpy as np
+
+# Minimum area of each of the three sub triangles formed with a sample for the sample to be inside the triangle.
+AREA_TOLERANCE = 0.001
+
+# Maximum number of bounding box samples processed at once.
+CHUNK_SAMPLES = 1 << 20
+
+"""
+signed_areas returns the determinants of [b - a, p - a] for given (n,2) arrays of points, twice the signed area of
+triangles (a, b, p).
+"""
+
+
+def signed_areas(a: np.ndarray, b: np.ndarray, p: np.ndarray) -> np.ndarray:
+    return (b[:, 0] - a[:, 0]) * (p[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (p[:, 0] - a[:, 0])
+
+
+"""
+rasterize_triangles rasterizes the triangles (m,3) of given projected vertices (k,2) and interpolates given per
+vertex attributes (k,d) over them. Returns the inside samples (n,2) and their interpolated attributes (n,d).
+
+If attribute_map (an array with the image shape followed by d) is given, the interpolated attributes are also
+written into it at the (truncated) sample positions that fall inside it, with later triangles overwriting earlier
+ones, and coverage_mask (a boolean array with the image shape), if given, is set at those positions.
+"""
+
+
+def rasterize_triangles(vertices: np.ndarray, triangle_indices: np.ndarray, vertex_attributes: np.ndarray,
+                        attribute_map: np.ndarray = None, coverage_mask: np.ndarray = None) -> (np.ndarray,
+                                                                                               np.ndarray):
+    triangles = vertices[np.reshape(triangle_indices, (-1, 3))]
+    attributes = vertex_attributes[np.reshape(triangle_indices, (-1, 3))]
+    v0, v1, v2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    total_areas = signed_areas(v0, v1, v2)
+
+    mins = np.min(triangles, axis=1)
+    counts = np.maximum(np.ceil(np.max(triangles, axis=1) - mins), 0).astype(np.int64)
+    samples_per_triangle = counts[:, 0] * counts[:, 1]
+
+    all_points = []
+    all_attributes = []
+    start = 0
+    while start < len(triangles):
+        # Consecutive triangles whose bounding boxes add up to at most CHUNK_SAMPLES (at least one triangle).
+        cumulative = np.cumsum(samples_per_triangle[start:])
+        end = start + max(1, int(np.searchsorted(cumulative, CHUNK_SAMPLES, side="right")))
+        chunk = np.arange(start, end)
+        chunk_counts = samples_per_triangle[chunk]
+        start = end
+        if np.sum(chunk_counts) == 0:
+            continue
+
+        # Triangle and position within its bounding box of every sample.
+        tri = np.repeat(chunk, chunk_counts)
+        offsets = np.cumsum(chunk_counts) - chunk_counts
+        k = np.arange(len(tri)) - np.repeat(offsets, chunk_counts)
+        points = np.column_stack((mins[tri, 0] + k // counts[tri, 1], mins[tri, 1] + k % counts[tri, 1]))
+
+        areas = np.column_stack((signed_areas(v1[tri], v2[tri], points), signed_areas(v2[tri], v0[tri], points),
+                                 signed_areas(v0[tri], v1[tri], points)))
+        inside = np.all(areas >= AREA_TOLERANCE, axis=1)
+        tri = tri[inside]
+        weights = areas[inside] / total_areas[tri][:, np.newaxis]
+
+        all_points.append(points[inside])
+        all_attributes.append(np.einsum('nj,njd->nd', weights, attributes[tri]))
+
+    if len(all_points) == 0:
+        return np.zeros((0, 2)), np.zeros((0, vertex_attributes.shape[1]))
+    points = np.concatenate(all_points, axis=0)
+    interpolated = np.concatenate(all_attributes, axis=0)
+
+    if attribute_map is not None or coverage_mask is not None:
+        shape = attribute_map.shape[:2] if attribute_map is not None else coverage_mask.shape
+        pixels = points.astype(int)
+        valid = np.all((pixels >= 0) & (pixels < np.array(shape)), axis=1)
+        if attribute_map is not None:
+            attribute_map[pixels[valid, 0], pixels[valid, 1]] = interpolated[valid]
+        if coverage_mask is not None:
+            coverage_mask[pixels[valid, 0], pixels[valid, 1]] = True
+
+    return points, interpolated
@@ -0,0 +1,196 @@
+"""
+reflectance_table builds and reads a lookup table of LHTSS reflectance curves for every 8 bit sRGB color. The table
+is a (256*256*256, 36) float16 numpy array saved in .npy format and indexed by ImageUtils.flatten_rgb(rgb) - 1. It is
+built in chunks on a process pool and progress is checkpointed to a JSON file next to the table so that an interrupted
+build can be resumed.
+"""
+import json
+import os
+import numpy as np
+import multiprocessing as mp
+
+from multiprocessing import Pool
+from .spectral import read_T_matrix, rspectrum_lhtss_batch
+from .tracing import traced
+
+# Default location of the reflectance table.
+REFLECTANCE_TABLE_PATH = "reflectance.npy"
+
+# Total number of 8 bit sRGB colors.
+NUM_COLORS = 256 * 256 * 256
+
+# Number of wavelength intervals in each reflectance curve.
+NUM_INTERVALS = 36
+
+# Number of colors in each chunk of work handed to a worker process (one red plane of the RGB cube).
+CHUNK_SIZE = 256 * 256
+
+# Number of colors solved together in one batched Newton iteration inside a chunk.
+BATCH_SIZE = 4096
+
+# Cache of opened tables keyed by path so that each table is memory mapped only once per process.
+_TABLE_CACHE = {}
+
+"""
+progress_path returns the path of the JSON file that records the completed chunks of the table at given path.
+"""
+
+
+def progress_path(path: str) -> str:
+    return path + ".progress.json"
+
+
+"""
+index_to_rgb returns the (n,3) sRGB colors for the given array of 0 based table indices.
+"""
+
+
+def index_to_rgb(indices: np.ndarray) -> np.ndarray:
+    indices = np.asarray(indices, dtype=np.int64)
+    return np.stack((indices // (256 * 256), (indices // 256) % 256, indices % 256), axis=1)
+
+
+"""
+rgb_to_index returns the 0 based table indices for the given (n,3) sRGB array. This is the vectorized version of
+ImageUtils.flatten_rgb(rgb) - 1.
+"""
+
+
+def rgb_to_index(rgb_arr: np.ndarray) -> np.ndarray:
+    rgb_arr = np.reshape(np.asarray(rgb_arr, dtype=np.int64), (-1, 3))
+    return rgb_arr[:, 0] * 256 * 256 + rgb_arr[:, 1] * 256 + rgb_arr[:, 2]
+
+
+"""
+compute_reflectances returns the (n,36) LHTSS reflectance curves for given (n,3) sRGB array. Colors are solved in
+batches and if a batch fails to converge, its colors are solved one at a time. Colors for which no solution is found
+are returned as NaN.
+"""
+
+
+def compute_reflectances(rgb_arr: np.ndarray, T: np.ndarray) -> np.ndarray:
+    rho = np.full((rgb_arr.shape[0], NUM_INTERVALS), np.nan)
+    for start in range(0, rgb_arr.shape[0], BATCH_SIZE):
+        end = min(start + BATCH_SIZE, rgb_arr.shape[0])
+        try:
+            rho[start:end] = rspectrum_lhtss_batch(rgb_arr[start:end], T=T)
+        except Exception:
+            for i in range(start, end):
+                try:
+                    rho[i] = rspectrum_lhtss_batch(rgb_arr[i:i + 1], T=T)[0]
+                except Exception:
+                    continue
+
+    num_failed = np.count_nonzero(np.isnan(rho[:, 0]))
+    if num_failed > 0:
+        print("No reflectance found for ", num_failed, " colors starting at: ", rgb_arr[0])
+    return rho
+
+
+"""
+build_chunk computes the reflectance curves of the given chunk and writes them into the table at given path. Runs in
+a worker process and returns the chunk number once the chunk has been flushed to disk.
+"""
+
+
+def build_chunk(path: str, t_matrix_path: str, chunk: int, chunk_size: int) -> int:
+    start = chunk * chunk_size
+    end = min(start + chunk_size, NUM_COLORS)
+    rho = compute_reflectances(index_to_rgb(np.arange(start, end)), read_T_matrix(t_matrix_path))
+
+    table = np.load(path, mmap_mode="r+")
+    table[start:end] = rho.astype(np.float16)
+    table.flush()
+    del table
+    return chunk
+
+
+"""
+build_reflectance_table computes the reflectance curve of every sRGB color and writes it to a float16 memory mapped
+table at given path. Chunks are computed on a pool of processes and every completed chunk is recorded in the
+progress file so that calling this function again on the same path only computes the remaining chunks.
+"""
+
+
+@traced()
+def build_reflectance_table(path: str = REFLECTANCE_TABLE_PATH, t_matrix_path: str = "T_matrix.csv",
+                            num_processes: int = None, chunk_size: int = CHUNK_SIZE):
+    if num_processes is None:
+        num_processes = mp.cpu_count()
+
+    # Read the T matrix up front so that a missing CSV fails before any work is scheduled.
+    read_T_matrix(t_matrix_path)
+
+    completed = set()
+    ppath = progress_path(path)
+    if os.path.exists(path) and os.path.exists(ppath):
+        with open(ppath) as f:
+            progress = json.load(f)
+        if progress["chunk_size"] != chunk_size:
+            raise ValueError("Chunk size: " + str(chunk_size) + " does not match chunk size: " +
+                             str(progress["chunk_size"]) + " of existing table: " + path)
+        completed = set(progress["completed"])
+    else:
+        table = np.lib.format.open_memmap(path, mode="w+", dtype=np.float16, shape=(NUM_COLORS, NUM_INTERVALS))
+        table.flush()
+        del table
+
+    num_chunks = (NUM_COLORS + chunk_size - 1) // chunk_size
+    remaining = [c for c in range(num_chunks) if c not in completed]
+    print("Total chunks: ", num_chunks, " remaining: ", len(remaining))
+
+    with Pool(processes=num_processes) as pool:
+        results = [pool.apply_async(build_chunk, (path, t_matrix_path, c, chunk_size)) for c in remaining]
+        for result in results:
+            completed.add(result.get())
+            # Write to a temporary file and rename it so that an interruption never leaves a truncated progress file.
+            with open(ppath + ".tmp", "w") as f:
+                json.dump({"chunk_size": chunk_size, "completed": sorted(completed)}, f)
+            os.replace(ppath + ".tmp", ppath)
+            print(str(round(len(completed) * 100.0 / num_chunks, 2)) + "% complete")
+
+
+"""
+ReflectanceTable is a read only view of a reflectance table that has been memory mapped from disk. Only the pages
+of the table that are looked up are read into memory.
+"""
+
+
+class ReflectanceTable:
+    def __init__(self, path: str = REFLECTANCE_TABLE_PATH):
+        ppath = progress_path(path)
+        if os.path.exists(ppath):
+            with open(ppath) as f:
+                progress = json.load(f)
+            num_chunks = (NUM_COLORS + progress["chunk_size"] - 1) // progress["chunk_size"]
+            if len(progress["completed"]) < num_chunks:
+                print("Warning: reflectance table: ", path, " is incomplete")
+        self.table = np.load(path, mmap_mode="r")
+        if self.table.shape != (NUM_COLORS, NUM_INTERVALS):
+            raise ValueError("Unexpected reflectance table shape: " + str(self.table.shape))
+
+    """
+    lookup returns the (n,36) float reflectance curves for given (n,3) sRGB array.
+    """
+
+    def lookup(self, rgb_arr: np.ndarray) -> np.ndarray:
+        return self.table[rgb_to_index(rgb_arr)].astype(float)
+
+    """
+    reflectance returns the (36,) float reflectance curve for given sRGB tuple.
+    """
+
+    def reflectance(self, rgb) -> np.ndarray:
+        return self.lookup(np.array([rgb[0], rgb[1], rgb[2]]))[0]
+
+
+"""
+load_reflectance_table returns the memory mapped reflectance table at given path. The table is opened once per
+process and shared by all later calls.
+"""
+
+
+def load_reflectance_table(path: str = REFLECTANCE_TABLE_PATH) -> ReflectanceTable:
+    if path not in _TABLE_CACHE:
+        _TABLE_CACHE[path] = ReflectanceTable(path)
+    return _TABLE_CACHE[path]
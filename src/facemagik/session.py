@@ -0,0 +1,117 @@
+"""
+session memoizes expensive intermediate results (YCrCb planes, mask clusters and effective color maps) of analyzing
+an image so that any sequence of analyzer calls computes each of them once. Results are keyed by the digest of the
+image, the digest of the mask they were computed on and the config fields that affect them. A session only holds
+results of the image it was created with; SkinToneAnalyzer rejects a session created for a different image.
+"""
+import hashlib
+import threading
+import numpy as np
+
+from concurrent.futures import Future
+from typing import Callable, List
+
+"""
+array_digest returns a blake2b hex digest of the shape, type and contents of given numpy array.
+"""
+
+
+def array_digest(arr: np.ndarray) -> str:
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(arr.shape).encode())
+    h.update(arr.dtype.str.encode())
+    h.update(arr.data)
+    return h.hexdigest()
+
+
+"""
+AnalysisSession holds memoized results for a single image. It can be shared by several analyzers working on the
+same image and is safe to use from multiple threads.
+"""
+
+
+class AnalysisSession:
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.cache = {}
+        # Futures of results being computed by another thread, keyed like cache.
+        self.in_flight = {}
+        self.digests = {}
+        self.lock = threading.Lock()
+        # Number of cache hits and misses, useful to verify that work is not repeated.
+        self.hits = 0
+        self.misses = 0
+
+    """
+    digest returns the digest of given array. Digests are cached by array identity so that masks owned by the
+    analyzer are only hashed once.
+    """
+
+    def digest(self, arr: np.ndarray) -> str:
+        if arr is None:
+            return ""
+        with self.lock:
+            if id(arr) in self.digests and self.digests[id(arr)][0] is arr:
+                return self.digests[id(arr)][1]
+        d = array_digest(arr)
+        with self.lock:
+            # Keep a reference to the array so that its id is not reused while it is cached.
+            self.digests[id(arr)] = (arr, d)
+        return d
+
+    """
+    key returns the memoization key for given computation name, mask and config field values.
+    """
+
+    def key(self, name: str, mask: np.ndarray = None, skin_config=None, config_fields: List[str] = ()) -> tuple:
+        fields = tuple((f, getattr(skin_config, f)) for f in config_fields)
+        return name, self.digest(self.image), self.digest(mask), fields
+
+    """
+    memoize returns the cached result for given computation or computes it using compute_fn and caches it. Only the
+    first caller of a missing result runs compute_fn; other threads asking for the same result meanwhile wait for it
+    (and get the exception if compute_fn raised, in which case the result is not cached).
+    """
+
+    def memoize(self, name: str, compute_fn: Callable, mask: np.ndarray = None, skin_config=None,
+                config_fields: List[str] = ()):
+        key = self.key(name, mask, skin_config, config_fields)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+            if key in self.in_flight:
+                self.hits += 1
+                future = self.in_flight[key]
+                owner = False
+            else:
+                self.misses += 1
+                future = Future()
+                self.in_flight[key] = future
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute_fn()
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.cache[key] = value
+            del self.in_flight[key]
+        future.set_result(value)
+        return value
+
+    """
+    clear removes all memoized results.
+    """
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.digests.clear()
@@ -0,0 +1,127 @@
+"""
+shades stores a catalog of foundation shades in CIE Lab with a KD-tree index so that the closest shades to many skin
+tones can be found in one call. Candidates are prefiltered by Euclidean distance in Lab and then reranked using the
+exact CIEDE2000 difference.
+"""
+import json
+import colour
+import numpy as np
+
+from dataclasses import dataclass
+from typing import List
+from scipy.spatial import cKDTree
+from .common import SkinTone
+from .foundation import srgb_to_lab
+
+"""
+ShadeMatch is a single catalog shade matched against a skin tone.
+"""
+
+
+@dataclass
+class ShadeMatch:
+    index: int
+    name: str
+    rgb: np.ndarray
+    delta_e: float
+
+
+"""
+ShadeCatalog is an indexed catalog of foundation shades.
+"""
+
+
+class ShadeCatalog:
+    # Number of Euclidean nearest neighbors considered per requested match before reranking with CIEDE2000.
+    CANDIDATE_FACTOR = 8
+
+    # Minimum number of Euclidean nearest neighbors considered before reranking with CIEDE2000.
+    MIN_CANDIDATES = 64
+
+    def __init__(self, names: List[str], rgb: np.ndarray):
+        self.names = list(names)
+        self.rgb = np.reshape(np.asarray(rgb, dtype=float), (-1, 3))
+        if len(self.names) != self.rgb.shape[0]:
+            raise ValueError("Number of shade names: " + str(len(self.names)) + " does not match number of colors: " +
+                             str(self.rgb.shape[0]))
+        self.lab = srgb_to_lab(self.rgb)
+        self.tree = cKDTree(self.lab)
+
+    """
+    from_json creates a catalog from a JSON file containing a list of shades. Each shade is a dictionary with a
+    "name" and either an "rgb" list or a "hex" color string.
+    """
+
+    @staticmethod
+    def from_json(path: str):
+        with open(path) as f:
+            shades = json.load(f)
+
+        names, rgb = [], []
+        for shade in shades:
+            names.append(shade["name"])
+            if "rgb" in shade:
+                rgb.append(shade["rgb"])
+            else:
+                h = shade["hex"].lstrip('#')
+                rgb.append([int(h[i:i + 2], 16) for i in (0, 2, 4)])
+        return ShadeCatalog(names, np.array(rgb))
+
+    def __len__(self):
+        return len(self.names)
+
+    """
+    to_rgb_array returns the (n,3) sRGB array of given list of skin tones or sRGB array.
+    """
+
+    @staticmethod
+    def to_rgb_array(skin_tones) -> np.ndarray:
+        if len(skin_tones) > 0 and isinstance(skin_tones[0], SkinTone):
+            return np.array([sk.rgb for sk in skin_tones], dtype=float)
+        return np.reshape(np.asarray(skin_tones, dtype=float), (-1, 3))
+
+    """
+    delta_e returns the (n, len(catalog)) CIEDE2000 difference between every given skin tone and every shade in the
+    catalog (an empty (0, len(catalog)) array if there are no skin tones). Use this for small catalogs where every
+    difference is needed.
+    """
+
+    def delta_e(self, skin_tones) -> np.ndarray:
+        lab = srgb_to_lab(ShadeCatalog.to_rgb_array(skin_tones))
+        if lab.shape[0] == 0:
+            return np.zeros((0, len(self)))
+        shape = (lab.shape[0], len(self), 3)
+        return np.reshape(colour.delta_E(np.broadcast_to(lab[:, np.newaxis, :], shape),
+                                         np.broadcast_to(self.lab[np.newaxis, :, :], shape), method='CIE 2000'),
+                          shape[:2])
+
+    """
+    query returns the k closest shades (by CIEDE2000) for each of the given skin tones (list of SkinTone or (n,3)
+    sRGB array). Shades are prefiltered using the KD-tree and the result for each skin tone is sorted by increasing
+    delta_e. Since CIEDE2000 is not a monotonic function of Euclidean Lab distance, a shade outside the prefiltered
+    candidates can occasionally be missed; increase num_candidates if exact results are needed. Returns an empty list
+    if there are no skin tones.
+    """
+
+    def query(self, skin_tones, k: int = 5, num_candidates: int = None) -> List[List[ShadeMatch]]:
+        k = min(k, len(self))
+        if num_candidates is None:
+            num_candidates = max(k * ShadeCatalog.CANDIDATE_FACTOR, ShadeCatalog.MIN_CANDIDATES)
+        num_candidates = max(k, min(num_candidates, len(self)))
+
+        lab = srgb_to_lab(ShadeCatalog.to_rgb_array(skin_tones))
+        if lab.shape[0] == 0:
+            return []
+        _, candidates = self.tree.query(lab, k=num_candidates)
+        candidates = np.reshape(candidates, (lab.shape[0], num_candidates))
+
+        delta = np.reshape(colour.delta_E(np.broadcast_to(lab[:, np.newaxis, :], (lab.shape[0], num_candidates, 3)),
+                                          self.lab[candidates], method='CIE 2000'), candidates.shape)
+        order = np.argsort(delta, axis=1)[:, :k]
+
+        results = []
+        for i in range(lab.shape[0]):
+            results.append([ShadeMatch(index=int(candidates[i, j]), name=self.names[candidates[i, j]],
+                                       rgb=self.rgb[candidates[i, j]], delta_e=float(delta[i, j])) for j in
+                            order[i]])
+        return results
@@ -0,0 +1,112 @@
+"""
+shared_array wraps multiprocessing.shared_memory segments as numpy arrays so that images and masks can be handed to
+other processes as small picklable handles instead of being copied. The process that creates a SharedArray owns the
+segment and is responsible for unlinking it; other processes attach to it using its handle and only close it.
+"""
+import numpy as np
+
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+"""
+SharedArrayHandle is a picklable reference to a shared array that can be sent to another process.
+"""
+
+
+@dataclass(frozen=True)
+class SharedArrayHandle:
+    name: str
+    shape: tuple
+    dtype: str
+
+    """
+    attach returns a SharedArray backed by the shared memory segment of this handle. The returned array does not own
+    the segment and must be closed (not unlinked) when no longer needed.
+    """
+
+    def attach(self):
+        return SharedArray(shared_memory.SharedMemory(name=self.name), self.shape, self.dtype, owner=False)
+
+
+"""
+SharedArray is a numpy array backed by a shared memory segment. Use it as a context manager to make sure the segment
+is closed (and unlinked by the owner) once the work that needs it is done.
+"""
+
+
+class SharedArray:
+    def __init__(self, shm: shared_memory.SharedMemory, shape: tuple, dtype, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    """
+    create allocates a new shared array of given shape and type. Contents are uninitialized.
+    """
+
+    @staticmethod
+    def create(shape: tuple, dtype):
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return SharedArray(shared_memory.SharedMemory(create=True, size=size), tuple(shape), dtype, owner=True)
+
+    """
+    from_array allocates a new shared array and copies given numpy array into it.
+    """
+
+    @staticmethod
+    def from_array(arr: np.ndarray):
+        shared = SharedArray.create(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    """
+    handle returns the picklable handle to be sent to other processes.
+    """
+
+    @property
+    def handle(self) -> SharedArrayHandle:
+        return SharedArrayHandle(self.shm.name, tuple(self.array.shape), self.array.dtype.str)
+
+    """
+    close releases this process's mapping of the segment. The array must not be used after close.
+    """
+
+    def close(self):
+        if self.array is None:
+            return
+        self.array = None
+        self.shm.close()
+
+    """
+    unlink destroys the shared memory segment. Only the owner of the segment should call unlink.
+    """
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+
+"""
+attach_all attaches to every handle in given list and returns the list of SharedArrays.
+"""
+
+
+def attach_all(handles):
+    return [h.attach() for h in handles]
+
+
+"""
+close_all closes every SharedArray in given list.
+"""
+
+
+def close_all(shared_arrays):
+    for s in shared_arrays:
+        s.close()
@@ -3,16 +3,26 @@ import os
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-import time
 import multiprocessing as mp
+import copy
 
 from mrcnn import model as model_lib
 from dataclasses import dataclass
 from multiprocessing import Queue, Pool
+from concurrent.futures import ThreadPoolExecutor
 from .utils import ImageUtils
 from .mesh import face_mask_with_direct_light
 from .face import Face
-from .common import InferenceConfig, SceneBrightness, LightDirection, SkinTone
+from .shades import ShadeCatalog
+from .executors import get_thread_pool, MAX_THREADS
+from .pipeline import StageDAG
+from .session import AnalysisSession
+from .tracing import traced, span, current_span
+from .quality import ImageQuality, check_image_quality
+from .shared_array import SharedArray, SharedArrayHandle, attach_all, close_all
+from .clustering import cluster, clustering_algorithm, get_clustering_strategy, register_clustering_strategy, \
+    KMEANS, BRIGHTNESS_BANDS
+from .common import InferenceConfig, SceneBrightness, LightDirection, SkinTone, ExecutionMode, ClusteringRegion
 
 """
 Configuration details associated with skin detection algorithm.
@@ -29,6 +39,10 @@ class SkinDetectionConfig:
     # If true, use new clustering algorithm else use older algorithm.
     USE_NEW_CLUSTERING_ALGORITHM: bool = False
 
+    # Name of the registered clustering strategy (see clustering module). If empty, USE_NEW_CLUSTERING_ALGORITHM
+    # selects between brightness_bands (true) and kmeans (false).
+    CLUSTERING_ALGORITHM: str = ""
+
     # Minimum Kmeans difference value until repeated Kmeans clustering is performed.
     KMEANS_TOLERANCE: float = 2.0
 
@@ -56,6 +70,36 @@ class SkinDetectionConfig:
     # If true, runs analysis in debug mode. Used during development.
     DEBUG_MODE: bool = False
 
+    # How scene brightness and light direction are run in parallel: separate process, thread pool or inline.
+    EXECUTION_MODE: ExecutionMode = ExecutionMode.PROCESS
+
+    # If true, check the quality (exposure, clipped highlights, colorfulness and blur) of the image before segmentation.
+    CHECK_IMAGE_QUALITY: bool = True
+
+    # If true, images that fail the quality check are rejected with PoorImageQualityException, otherwise only reported.
+    QUALITY_REJECT_POOR_IMAGES: bool = False
+
+    # Longest side in pixels of the downsampled image used for the quality check.
+    QUALITY_MAX_SIDE: int = 256
+
+    # Minimum median brightness (0-100) of the image.
+    QUALITY_MIN_MEDIAN_BRIGHTNESS: float = 20.0
+
+    # Maximum percent of the image with brightness (0-100) at or below 8.
+    QUALITY_MAX_UNDEREXPOSED_PERCENT: float = 50.0
+
+    # Maximum percent of the image with brightness (0-100) at or above 94.
+    QUALITY_MAX_OVEREXPOSED_PERCENT: float = 30.0
+
+    # Maximum percent of the image with at least one clipped (255) channel.
+    QUALITY_MAX_CLIPPED_PERCENT: float = 10.0
+
+    # Minimum colorfulness (ImageUtils.image_colorfulness) of the image.
+    QUALITY_MIN_COLORFULNESS: float = 5.0
+
+    # Minimum variance of the Laplacian of the downsampled gray image. Lower values indicate a blurry image.
+    QUALITY_MIN_SHARPNESS: float = 10.0
+
     def __init__(self):
         pass
 
@@ -93,6 +137,36 @@ class SceneBrightnessAndDirection:
 
         return SceneBrightness.NEUTRAL_LIGHTING
 
+"""
+Container class for the results of SkinToneAnalyzer.analyze.
+"""
+
+
+@dataclass
+class AnalysisResult:
+    scene_brightness_and_direction: SceneBrightnessAndDirection
+    skin_tones: list
+    # Latency in seconds of each analysis stage.
+    stage_timings: dict
+    # Result of the pre-segmentation image quality check, None if it was not run.
+    image_quality: ImageQuality = None
+
+
+"""
+Container class for the analysis of one face in a multi face image. roi is the (top, bottom, left, right) region of the
+image that was analyzed. Exactly one of result and error is set, image_quality is shared by all faces of the image.
+"""
+
+
+@dataclass
+class FaceAnalysisResult:
+    roi: tuple
+    result: AnalysisResult = None
+    error: Exception = None
+    # Result of the image quality check of the whole image, None if it was not run.
+    image_quality: ImageQuality = None
+
+
 @dataclass
 class NoseMiddlePoint:
     x: int
@@ -139,12 +213,25 @@ class SkinToneAnalyzer:
     blue = "Blue"
     none = "None"
 
-    def __init__(self, maskrcnn_model, skin_config: object, face_mask_info: FaceMaskInfo = None):
+    # Config fields that select the clustering strategy. Together with the strategy's own config fields they affect
+    # the clusters.
+    CLUSTERING_SELECTION_CONFIG_FIELDS = ["CLUSTERING_ALGORITHM", "USE_NEW_CLUSTERING_ALGORITHM"]
+
+    # Config fields that affect Kmeans clustering.
+    KMEANS_CONFIG_FIELDS = ["KMEANS_TOLERANCE", "KMEANS_TEETH_MASK_PERCENT_CUTOFF", "KMEANS_FACE_MASK_PERCENT_CUTOFF"]
+
+    def __init__(self, maskrcnn_model, skin_config: object, face_mask_info: FaceMaskInfo = None,
+                 session: AnalysisSession = None, face: Face = None):
+        # Check image quality before paying for segmentation.
+        self.image_quality = None
+        if face_mask_info is None and face is None and skin_config.CHECK_IMAGE_QUALITY:
+            self.image_quality = check_image_quality(skin_config)
+
         if face_mask_info is None:
-            # Detect face.
-            if skin_config.IMAGE_PATH != "":
+            # Detect face unless an already segmented face is given.
+            if face is None and skin_config.IMAGE_PATH != "":
                 face = Face(image_path=skin_config.IMAGE_PATH, maskrcnn_model=maskrcnn_model)
-            else:
+            elif face is None:
                 face = Face(image=skin_config.IMAGE, maskrcnn_model=maskrcnn_model)
 
             if skin_config.BRIGHTNESS_UPDATE_FACTOR != 1.0 or skin_config.SATURATION_UPDATE_FACTOR != 1.0:
@@ -174,6 +261,12 @@ class SkinToneAnalyzer:
         self.face_mask_effective_color_map = {}
         self.skin_config = skin_config
 
+        # Memoized intermediate results. Pass the same session to analyzers of the same image to share them.
+        if session is not None and session.image is not self.image and session.digest(
+                session.image) != session.digest(self.image):
+            raise ValueError("Analysis session was created for a different image than the one being analyzed")
+        self.session = session if session is not None else AnalysisSession(self.image)
+
     """
     Plots a figure with each cluster's color and Munsell value. Primary use for analysis of similar colors.
     """
@@ -295,9 +388,8 @@ class SkinToneAnalyzer:
     """
 
     @staticmethod
+    @traced()
     def construct_model(weights_relative_path):
-        start_time = time.time()
-
         # Create model
         model = model_lib.MaskRCNN(mode="inference", config=InferenceConfig(), model_dir="")
 
@@ -310,7 +402,6 @@ class SkinToneAnalyzer:
         print("Loading weights from: ", weights_path)
         model.load_weights(weights_path, by_name=True)
 
-        print("\nModel construction time: ", time.time() - start_time, " seconds\n")
         return model
 
     """
@@ -344,10 +435,10 @@ class SkinToneAnalyzer:
     """
 
     @staticmethod
+    @traced()
     def make_clusters(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, kmeans_tolerance: float, cutoff_percent:
     float, debug_mode: bool) \
             -> [int, dict]:
-        start_time = time.time()
         diff_img = (ycrcb_image[:, :, 0]).astype(float)
         curr_mask = mask_to_process.copy()
         total_points = np.count_nonzero(mask_to_process)
@@ -388,19 +479,20 @@ class SkinToneAnalyzer:
             if ImageUtils.percentPoints(curr_mask, total_points) < 1:
                 break
 
-        print("\nClustering latency: ", time.time() - start_time, " seconds\n")
-
         return all_cluster_masks, effective_color_map
 
     """
     Break given mask into smaller clusters for given YCrCb image. The Y value (brightness) of the image is used to
     create these clusters. Additionally, these clusters are further combined into a effective color map and returned 
-    along with the clusters.
+    along with the clusters. If use_process_pool is false, Munsell colors are computed in the calling thread instead
+    of forking a process pool (not safe when other threads are running). The pool is also skipped inside daemon
+    processes (like batch workers) since they are not allowed to have children.
     """
 
     @staticmethod
-    def __make_new_clusters(ycrcb_image: np.ndarray, mask_to_process: np.ndarray) -> (list, dict):
-        start_time = time.time()
+    @traced()
+    def __make_new_clusters(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, use_process_pool: bool = True) -> (
+            list, dict):
         diff_img = (ycrcb_image[:, :, 0]).astype(float)
 
         # Break mask into smaller clusters.
@@ -420,13 +512,16 @@ class SkinToneAnalyzer:
             mask_clusters.append(curr_mask)
 
         # Compute effective color of each cluster mask and group them.
-        num_processes = min(4, mp.cpu_count())
-        with Pool(processes=num_processes) as pool:
-            results = [pool.apply_async(ImageUtils.sRGBtoMunsell, (np.mean(ycrcb_image[m], axis=0),)) for m in
-                       mask_clusters]
-            munsell_color_list = [result.get() for result in results]
-            effective_color_list = [SkinToneAnalyzer.effective_color(munsell_color) for munsell_color in
-                                    munsell_color_list]
+        if use_process_pool and not mp.current_process().daemon:
+            num_processes = min(4, mp.cpu_count())
+            with Pool(processes=num_processes) as pool:
+                results = [pool.apply_async(ImageUtils.sRGBtoMunsell, (np.mean(ycrcb_image[m], axis=0),)) for m in
+                           mask_clusters]
+                munsell_color_list = [result.get() for result in results]
+        else:
+            munsell_color_list = [ImageUtils.sRGBtoMunsell(np.mean(ycrcb_image[m], axis=0)) for m in mask_clusters]
+        effective_color_list = [SkinToneAnalyzer.effective_color(munsell_color) for munsell_color in
+                                munsell_color_list]
 
         effective_color_map = {}
         for effective_color, mask in zip(effective_color_list, mask_clusters):
@@ -435,30 +530,74 @@ class SkinToneAnalyzer:
             else:
                 effective_color_map[effective_color] = np.bitwise_or(effective_color_map[effective_color], mask)
 
-        print("New Clustering latency: ", time.time() - start_time)
-
         return mask_clusters, effective_color_map
 
     """
-    Static method that computes brightness of scene. Used in parallel execution.
+    Clustering strategy (registered as kmeans) that clusters given mask with recursive Kmeans. The mask percent
+    cutoff depends on the region.
     """
 
     @staticmethod
-    def get_brightness(rgb_image: np.ndarray, ycrcb_image: np.ndarray, mask_to_process: np.ndarray, skin_config:
-    SkinDetectionConfig, brightness_queue: multiprocessing.Queue):
-        total_points = np.count_nonzero(mask_to_process)
+    def kmeans_clusters(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, region: ClusteringRegion,
+                        skin_config: SkinDetectionConfig, use_process_pool: bool = True) -> (list, dict):
+        cutoff_percent = skin_config.KMEANS_TEETH_MASK_PERCENT_CUTOFF if region == ClusteringRegion.MOUTH else \
+            skin_config.KMEANS_FACE_MASK_PERCENT_CUTOFF
+        return SkinToneAnalyzer.make_clusters(ycrcb_image, mask_to_process, skin_config.KMEANS_TOLERANCE,
+                                              cutoff_percent, skin_config.DEBUG_MODE)
 
-        # Make clusters.
-        if skin_config.USE_NEW_CLUSTERING_ALGORITHM:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image, mask_to_process)
+    """
+    Clustering strategy (registered as brightness_bands) that clusters given mask into brightness bands. For the
+    mouth, only effective colors that cover at least 5% of the mask are kept.
+    """
+
+    @staticmethod
+    def brightness_bands_clusters(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, region: ClusteringRegion,
+                                  skin_config: SkinDetectionConfig, use_process_pool: bool = True) -> (list, dict):
+        all_cluster_masks, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image, mask_to_process,
+                                                                                      use_process_pool)
+        if region == ClusteringRegion.MOUTH:
             # Filter masks that are larger than 5% in size.
+            total_points = np.count_nonzero(mask_to_process)
             effective_color_map = dict(filter(lambda elem: ImageUtils.percentPoints(elem[1], total_points) >= 5,
                                               effective_color_map.items()))
-        else:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.make_clusters(ycrcb_image, mask_to_process,
-                                                                                    skin_config.KMEANS_TOLERANCE,
-                                                                                    skin_config.KMEANS_TEETH_MASK_PERCENT_CUTOFF,
-                                                                                    skin_config.DEBUG_MODE)
+        return all_cluster_masks, effective_color_map
+
+    """
+    Static method that clusters the mouth (teeth) mask with the clustering strategy selected by the config.
+    """
+
+    @staticmethod
+    def cluster_mouth_mask(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, skin_config: SkinDetectionConfig,
+                           use_process_pool: bool = True) -> (list, dict):
+        return cluster(ycrcb_image, mask_to_process, ClusteringRegion.MOUTH, skin_config, use_process_pool)
+
+    """
+    Static method that clusters the face mask with the clustering strategy selected by the config.
+    """
+
+    @staticmethod
+    def cluster_face_mask(ycrcb_image: np.ndarray, mask_to_process: np.ndarray, skin_config: SkinDetectionConfig,
+                          use_process_pool: bool = True) -> (list, dict):
+        return cluster(ycrcb_image, mask_to_process, ClusteringRegion.FACE, skin_config, use_process_pool)
+
+    """
+    Returns the config fields that affect the clusters of the clustering strategy selected by given config.
+    """
+
+    @staticmethod
+    def clustering_config_fields(skin_config: SkinDetectionConfig) -> list:
+        return SkinToneAnalyzer.CLUSTERING_SELECTION_CONFIG_FIELDS + get_clustering_strategy(
+            clustering_algorithm(skin_config)).config_fields
+
+    """
+    Static method that computes brightness of scene from the effective color map of the mouth mask. The mean
+    brightness of the first two effective colors (in decreasing order of brightness) is returned.
+    """
+
+    @staticmethod
+    def brightness_from_clusters(rgb_image: np.ndarray, mask_to_process: np.ndarray, effective_color_map: dict,
+                                 skin_config: SkinDetectionConfig) -> int:
+        total_points = np.count_nonzero(mask_to_process)
 
         # Check mean brightness minimum coverage of the teeth.
         final_mask = np.zeros(mask_to_process.shape, dtype=bool)
@@ -475,12 +614,63 @@ class SkinToneAnalyzer:
         if skin_config.DEBUG_MODE:
             print("\nMean brightness value: ", mean_brightness, " with percent: ", ImageUtils.percentPoints(
                 final_mask, total_points), "\n")
+        return mean_brightness
+
+    """
+    Static method that computes primary light direction and percent of face mask per direction from face mask
+    clusters.
+    """
+
+    @staticmethod
+    def light_direction_from_clusters(all_cluster_masks: list, mask_to_process: np.ndarray,
+                                      nose_middle_point: np.ndarray, rotation_matrix: np.ndarray,
+                                      skin_config: SkinDetectionConfig):
+        total_points = np.count_nonzero(mask_to_process)
+
+        # Get light direction from face mask clusters.
+        mask_directions_list = [ImageUtils.get_mask_direction(b_mask, nose_middle_point, rotation_matrix,
+                                                              skin_config.DEBUG_MODE)
+                                for
+                                b_mask in
+                                all_cluster_masks]
+        mask_percent_list = [ImageUtils.percentPoints(b_mask, total_points) for b_mask in all_cluster_masks]
+
+        return Face.process_mask_directions(mask_directions_list, mask_percent_list)
+
+    """
+    Static method that computes brightness of scene. Used in parallel execution.
+    """
+
+    @staticmethod
+    def get_brightness(rgb_image: np.ndarray, ycrcb_image: np.ndarray, mask_to_process: np.ndarray, skin_config:
+    SkinDetectionConfig, brightness_queue: multiprocessing.Queue):
+        _, effective_color_map = SkinToneAnalyzer.cluster_mouth_mask(
+            ycrcb_image, mask_to_process, skin_config, skin_config.EXECUTION_MODE != ExecutionMode.THREAD)
+
+        mean_brightness = SkinToneAnalyzer.brightness_from_clusters(rgb_image, mask_to_process, effective_color_map,
+                                                                    skin_config)
 
         if brightness_queue is not None:
             brightness_queue.put(mean_brightness)
 
         return mean_brightness
 
+    """
+    Static method that computes brightness of scene from images in shared memory. Used in parallel execution so that
+    the child process receives handles instead of copies of the images.
+    """
+
+    @staticmethod
+    def get_brightness_shared(rgb_handle: SharedArrayHandle, ycrcb_handle: SharedArrayHandle,
+                              mask_handle: SharedArrayHandle, skin_config: SkinDetectionConfig,
+                              brightness_queue: multiprocessing.Queue):
+        shared = attach_all([rgb_handle, ycrcb_handle, mask_handle])
+        try:
+            SkinToneAnalyzer.get_brightness(shared[0].array, shared[1].array, shared[2].array, skin_config,
+                                            brightness_queue)
+        finally:
+            close_all(shared)
+
     """
     Returns true if teeth are visible in image, false otherwise.
     """
@@ -500,19 +690,10 @@ class SkinToneAnalyzer:
 
         mask_to_process = self.mouth_mask_to_process
         total_points = np.count_nonzero(mask_to_process)
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
 
         # Make clusters.
-        if self.skin_config.USE_NEW_CLUSTERING_ALGORITHM:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image, mask_to_process)
-            # Filter masks that are larger than 5% in size.
-            effective_color_map = dict(filter(lambda elem: ImageUtils.percentPoints(elem[1], total_points) >= 5,
-                                              effective_color_map.items()))
-        else:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.make_clusters(ycrcb_image, mask_to_process,
-                                                                                    self.skin_config.KMEANS_TOLERANCE,
-                                                                                    self.skin_config.KMEANS_TEETH_MASK_PERCENT_CUTOFF,
-                                                                                    self.skin_config.DEBUG_MODE)
+        all_cluster_masks, effective_color_map = self.mouth_clusters(
+            self.skin_config.EXECUTION_MODE != ExecutionMode.THREAD)
 
         if self.skin_config.ITERATE_TEETH_CLUSTERS:
             # Iterate to optimize final clusters.
@@ -554,51 +735,103 @@ class SkinToneAnalyzer:
     def get_primary_light_direction(ycrcb_image: np.ndarray, mask_to_process: np.ndarray,
                                     nose_middle_point: np.ndarray, rotation_matrix: np.ndarray, skin_config:
             SkinDetectionConfig, light_direction_queue: multiprocessing.Queue) -> LightDirection:
-        total_points = np.count_nonzero(mask_to_process)
-
-        # Make clusters.
-        if skin_config.USE_NEW_CLUSTERING_ALGORITHM:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image, mask_to_process)
-        else:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.make_clusters(ycrcb_image, mask_to_process,
-                                                                                    skin_config.KMEANS_TOLERANCE,
-                                                                                    skin_config.KMEANS_FACE_MASK_PERCENT_CUTOFF,
-                                                                                    skin_config.DEBUG_MODE)
-
-        # Get light direction from face mask clusters.
-        mask_directions_list = [ImageUtils.get_mask_direction(b_mask, nose_middle_point, rotation_matrix,
-                                                              skin_config.DEBUG_MODE)
-                                for
-                                b_mask in
-                                all_cluster_masks]
-        mask_percent_list = [ImageUtils.percentPoints(b_mask, total_points) for b_mask in all_cluster_masks]
+        all_cluster_masks, effective_color_map = SkinToneAnalyzer.cluster_face_mask(
+            ycrcb_image, mask_to_process, skin_config, skin_config.EXECUTION_MODE != ExecutionMode.THREAD)
 
-        primary_light_direction, percent_per_direction = Face.process_mask_directions(mask_directions_list,
-                                                                                      mask_percent_list)
+        primary_light_direction, percent_per_direction = SkinToneAnalyzer.light_direction_from_clusters(
+            all_cluster_masks, mask_to_process, nose_middle_point, rotation_matrix, skin_config)
         if light_direction_queue is not None:
             light_direction_queue.put((primary_light_direction, percent_per_direction))
 
         return primary_light_direction, percent_per_direction, effective_color_map
 
+    """
+    Static method that returns Primary light direction from images in shared memory. Used in parallel execution so
+    that the child process receives handles instead of copies of the images.
+    """
+
+    @staticmethod
+    def get_primary_light_direction_shared(ycrcb_handle: SharedArrayHandle, mask_handle: SharedArrayHandle,
+                                           nose_middle_point: np.ndarray, rotation_matrix: np.ndarray,
+                                           skin_config: SkinDetectionConfig,
+                                           light_direction_queue: multiprocessing.Queue):
+        shared = attach_all([ycrcb_handle, mask_handle])
+        try:
+            SkinToneAnalyzer.get_primary_light_direction(shared[0].array, shared[1].array, nose_middle_point,
+                                                         rotation_matrix, skin_config, light_direction_queue)
+        finally:
+            close_all(shared)
+
+    """
+    Returns the YCrCb image. Computed once per session.
+    """
+
+    def ycrcb_image(self) -> np.ndarray:
+        return self.session.memoize("ycrcb", lambda: ImageUtils.to_YCrCb(self.image))
+
+    """
+    Returns brightness band clusters (new clustering algorithm) of given mask. Computed once per session and mask.
+    """
+
+    def brightness_band_clusters(self, mask_to_process: np.ndarray, use_process_pool: bool = True) -> (list, dict):
+        cluster_masks, effective_color_map = self.session.memoize(
+            "brightness_band_clusters",
+            lambda: SkinToneAnalyzer.__make_new_clusters(self.ycrcb_image(), mask_to_process, use_process_pool),
+            mask_to_process)
+        return list(cluster_masks), dict(effective_color_map)
+
+    """
+    Returns clusters of the mouth mask. Computed once per session, mask and clustering config.
+    """
+
+    def mouth_clusters(self, use_process_pool: bool = True) -> (list, dict):
+        cluster_masks, effective_color_map = self.session.memoize(
+            "mouth_clusters",
+            lambda: SkinToneAnalyzer.cluster_mouth_mask(self.ycrcb_image(), self.mouth_mask_to_process,
+                                                        self.skin_config, use_process_pool),
+            self.mouth_mask_to_process, self.skin_config, SkinToneAnalyzer.clustering_config_fields(self.skin_config))
+        return list(cluster_masks), dict(effective_color_map)
+
+    """
+    Returns clusters of the face mask. Computed once per session, mask and clustering config. Shares the brightness
+    band clusters used by get_skin_tones when the brightness_bands strategy is selected.
+    """
+
+    def face_clusters(self, use_process_pool: bool = True) -> (list, dict):
+        if clustering_algorithm(self.skin_config) == BRIGHTNESS_BANDS:
+            return self.brightness_band_clusters(self.face_mask_to_process, use_process_pool)
+
+        cluster_masks, effective_color_map = self.session.memoize(
+            "face_clusters",
+            lambda: SkinToneAnalyzer.cluster_face_mask(self.ycrcb_image(), self.face_mask_to_process,
+                                                       self.skin_config, use_process_pool),
+            self.face_mask_to_process, self.skin_config, SkinToneAnalyzer.clustering_config_fields(self.skin_config))
+        return list(cluster_masks), dict(effective_color_map)
+
+    """
+    Returns scene brightness value computed from mouth clusters.
+    """
+
+    def get_scene_brightness_value(self) -> int:
+        _, effective_color_map = self.mouth_clusters(self.skin_config.EXECUTION_MODE != ExecutionMode.THREAD)
+        return SkinToneAnalyzer.brightness_from_clusters(self.image, self.mouth_mask_to_process, effective_color_map,
+                                                         self.skin_config)
+
     """
     Returns light direction results in the form of primary light direction, percent per direction and effective color 
     map. Used for sequential execution.
     """
 
+    @traced()
     def get_light_direction_result(self):
-        start_time = time.time()
         self.skin_config.DEBUG_MODE = False
 
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
-        mask_to_process = self.face_mask_to_process
-        node_middle_point = self.nose_middle_point
-        rotation_matrix = self.rotation_matrix
-
-        primary_light_direction = SkinToneAnalyzer.get_primary_light_direction(ycrcb_image, mask_to_process,
-                                                                               node_middle_point, rotation_matrix,
-                                                                               self.skin_config, None)
-        print("Primary light direction computation time: ", time.time() - start_time)
-        return primary_light_direction
+        all_cluster_masks, effective_color_map = self.face_clusters(
+            self.skin_config.EXECUTION_MODE != ExecutionMode.THREAD)
+        primary_light_direction, percent_per_direction = SkinToneAnalyzer.light_direction_from_clusters(
+            all_cluster_masks, self.face_mask_to_process, self.nose_middle_point, self.rotation_matrix,
+            self.skin_config)
+        return primary_light_direction, percent_per_direction, effective_color_map
 
     """
     Returns only primary light direction from light direction result.
@@ -608,66 +841,82 @@ class SkinToneAnalyzer:
         return self.get_light_direction_result()[0]
 
     """
-    Computes Scene Brightness and Primary Light Direction. Primary light direction is executed in a separate process 
-    to parallelize compute.
+    Computes Scene Brightness and Primary Light Direction. Primary light direction is executed in parallel based on
+    the config's execution mode. In process mode, the YCrCb image and face mask are shared with the child process
+    through shared memory.
     """
 
+    @traced()
     def get_scene_brightness_and_primary_light_direction(self) -> SceneBrightnessAndDirection:
-        start_time = time.time()
         self.skin_config.DEBUG_MODE = False
 
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
-        mask_to_process = self.face_mask_to_process
         node_middle_point = self.nose_middle_point
         rotation_matrix = self.rotation_matrix
-        light_direction_queue = Queue()
-        p = mp.Process(target=SkinToneAnalyzer.get_primary_light_direction, args=(ycrcb_image, mask_to_process,
-                                                                                  node_middle_point, rotation_matrix,
-                                                                                  self.skin_config,
-                                                                                  light_direction_queue))
-        p.start()
+        if self.skin_config.EXECUTION_MODE == ExecutionMode.PROCESS:
+            light_direction_queue = Queue()
+            with SharedArray.from_array(self.ycrcb_image()) as shared_ycrcb, SharedArray.from_array(
+                    self.face_mask_to_process) as shared_mask:
+                p = mp.Process(target=SkinToneAnalyzer.get_primary_light_direction_shared,
+                               args=(shared_ycrcb.handle, shared_mask.handle, node_middle_point, rotation_matrix,
+                                     self.skin_config, light_direction_queue))
+                p.start()
 
-        scene_brightness_value = self.determine_scene_brightness()
+                scene_brightness_value = self.determine_scene_brightness()
 
-        p.join()
+                primary_light_direction, percent_per_direction = light_direction_queue.get()
+                p.join()
+        elif self.skin_config.EXECUTION_MODE == ExecutionMode.THREAD:
+            future = get_thread_pool().submit(self.get_light_direction_result)
 
-        primary_light_direction, percent_per_direction = light_direction_queue.get()
+            scene_brightness_value = self.determine_scene_brightness()
 
-        print("Scene brightness and primary light direction detection latency: ", time.time() - start_time)
+            primary_light_direction, percent_per_direction, _ = future.result()
+        else:
+            scene_brightness_value = self.determine_scene_brightness()
+            primary_light_direction, percent_per_direction, _ = self.get_light_direction_result()
 
         return SceneBrightnessAndDirection(scene_brightness_value, primary_light_direction, percent_per_direction)
 
     """
-    Computes Scene Brightness and Primary Light Direction. Scene brightness is executed in a separate process to 
-    parallelize compute. Currently used in production.
+    Computes Scene Brightness and Primary Light Direction. Scene brightness is executed in parallel based on the
+    config's execution mode. In process mode, the RGB image, YCrCb image and mouth mask are shared with the child
+    process through shared memory. Currently used in production.
     """
 
+    @traced()
     def get_primary_light_direction_and_scene_brightness(self) -> SceneBrightnessAndDirection:
         if not self.is_teeth_visible:
             raise TeethNotVisibleException("Teeth not visible for config: " +
                                            str(self.skin_config))
 
-        start_time = time.time()
         self.skin_config.DEBUG_MODE = False
 
-        rgb_image = self.image
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
-        mask_to_process = self.mouth_mask_to_process
-        brightness_queue = Queue()
-        p = mp.Process(target=SkinToneAnalyzer.get_brightness, args=(rgb_image, ycrcb_image, mask_to_process,
-                                                                     self.skin_config, brightness_queue))
-        p.start()
+        if self.skin_config.EXECUTION_MODE == ExecutionMode.PROCESS:
+            brightness_queue = Queue()
+            with SharedArray.from_array(self.image) as shared_rgb, SharedArray.from_array(self.ycrcb_image()) as \
+                    shared_ycrcb, SharedArray.from_array(self.mouth_mask_to_process) as shared_mask:
+                p = mp.Process(target=SkinToneAnalyzer.get_brightness_shared,
+                               args=(shared_rgb.handle, shared_ycrcb.handle, shared_mask.handle, self.skin_config,
+                                     brightness_queue))
+                p.start()
 
-        primary_light_direction, percent_per_direction, effective_color_map = self.get_light_direction_result()
+                primary_light_direction, percent_per_direction, effective_color_map = \
+                    self.get_light_direction_result()
 
-        p.join()
+                scene_brightness_value = brightness_queue.get()
+                p.join()
+        elif self.skin_config.EXECUTION_MODE == ExecutionMode.THREAD:
+            future = get_thread_pool().submit(self.get_scene_brightness_value)
 
-        # Store effective color map of face mask.
-        self.face_mask_effective_color_map = effective_color_map
+            primary_light_direction, percent_per_direction, effective_color_map = self.get_light_direction_result()
 
-        scene_brightness_value = brightness_queue.get()
+            scene_brightness_value = future.result()
+        else:
+            primary_light_direction, percent_per_direction, effective_color_map = self.get_light_direction_result()
+            scene_brightness_value = self.get_scene_brightness_value()
 
-        print("Primary light direction detection and Scene brightness latency: ", time.time() - start_time)
+        # Store effective color map of face mask.
+        self.face_mask_effective_color_map = effective_color_map
 
         return SceneBrightnessAndDirection(scene_brightness_value, primary_light_direction, percent_per_direction)
 
@@ -677,15 +926,116 @@ class SkinToneAnalyzer:
 
     def get_skin_tones(self):
         total_points = np.count_nonzero(self.face_mask_to_process)
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
 
         if len(self.face_mask_effective_color_map) == 0:
-            _, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image, self.face_mask_to_process)
+            _, effective_color_map = self.brightness_band_clusters(self.face_mask_to_process)
         else:
             effective_color_map = self.face_mask_effective_color_map
 
         return SkinToneAnalyzer.__get_skin_tones(self.image, effective_color_map, total_points)
 
+    """
+    Returns the stage DAG of the analyzer. Face segmentation and region derivation happen when the analyzer is
+    constructed so their outputs (image, masks, nose middle point and rotation matrix) are the initial values of the
+    DAG. The remaining stages are YCrCb conversion, mouth clustering, face clustering, light direction, scene
+    brightness and skin tones. YCrCb conversion and clustering are memoized in the analyzer's session.
+    """
+
+    def stage_dag(self, use_process_pool: bool) -> StageDAG:
+        skin_config = self.skin_config
+        dag = StageDAG()
+        dag.add_stage("ycrcb", lambda image: self.ycrcb_image(), ["image"], ["ycrcb_image"])
+        dag.add_stage("mouth_clustering", lambda ycrcb_image, mask: self.mouth_clusters(use_process_pool),
+                      ["ycrcb_image", "mouth_mask"], ["mouth_cluster_masks", "mouth_effective_color_map"])
+        dag.add_stage("face_clustering", lambda ycrcb_image, mask: self.face_clusters(use_process_pool),
+                      ["ycrcb_image", "face_mask"], ["face_cluster_masks", "face_effective_color_map"])
+        dag.add_stage("light_direction",
+                      lambda clusters, mask, nose, rotation: SkinToneAnalyzer.light_direction_from_clusters(
+                          clusters, mask, nose, rotation, skin_config),
+                      ["face_cluster_masks", "face_mask", "nose_middle_point", "rotation_matrix"],
+                      ["primary_light_direction", "percent_per_direction"])
+        dag.add_stage("scene_brightness",
+                      lambda image, mask, color_map: SkinToneAnalyzer.brightness_from_clusters(image, mask, color_map,
+                                                                                               skin_config),
+                      ["image", "mouth_mask", "mouth_effective_color_map"], ["scene_brightness_value"])
+        dag.add_stage("skin_tones",
+                      lambda image, color_map, mask: SkinToneAnalyzer.__get_skin_tones(image, color_map,
+                                                                                       np.count_nonzero(mask)),
+                      ["image", "face_effective_color_map", "face_mask"], ["skin_tones"])
+        return dag
+
+    """
+    Runs the full analysis (scene brightness, light direction and skin tones) as a DAG of stages. Independent stages
+    run concurrently on the shared thread pool unless the config's execution mode is inline. Each intermediate
+    (like the YCrCb image or the face clusters) is computed once.
+    """
+
+    @traced()
+    def analyze(self) -> AnalysisResult:
+        if not self.is_teeth_visible:
+            raise TeethNotVisibleException("Teeth not visible for config: " +
+                                           str(self.skin_config))
+
+        self.skin_config.DEBUG_MODE = False
+
+        inline = self.skin_config.EXECUTION_MODE == ExecutionMode.INLINE
+        initial = {"image": self.image, "face_mask": self.face_mask_to_process,
+                   "mouth_mask": self.mouth_mask_to_process, "nose_middle_point": self.nose_middle_point,
+                   "rotation_matrix": self.rotation_matrix}
+        result = self.stage_dag(use_process_pool=inline).run(
+            initial, ["scene_brightness_value", "primary_light_direction", "skin_tones"],
+            executor=None if inline else get_thread_pool())
+
+        # Store effective color map of face mask.
+        self.face_mask_effective_color_map = result["face_effective_color_map"]
+
+        return AnalysisResult(SceneBrightnessAndDirection(result["scene_brightness_value"],
+                                                          result["primary_light_direction"],
+                                                          result["percent_per_direction"]), result["skin_tones"],
+                              result.stage_timings, self.image_quality)
+
+    """
+    Analyzes every face in the image of given config with a single segmentation pass. Each face is cropped out of the
+    image and analyzed on its own thread of a dedicated pool (the per face stages run on the shared thread pool, so
+    the faces must not wait on it). Returns a FaceAnalysisResult per face, largest face first. The analysis of one
+    face failing (for example because its teeth are not visible) does not fail the others.
+    """
+
+    @staticmethod
+    @traced()
+    def analyze_faces(maskrcnn_model, skin_config: SkinDetectionConfig, max_workers: int = None) -> list:
+        image_quality = check_image_quality(skin_config) if skin_config.CHECK_IMAGE_QUALITY else None
+        if skin_config.IMAGE_PATH != "":
+            image_face = Face(image_path=skin_config.IMAGE_PATH, maskrcnn_model=maskrcnn_model)
+        else:
+            image_face = Face(image=skin_config.IMAGE, maskrcnn_model=maskrcnn_model)
+        faces = image_face.get_faces() if image_face.num_faces() > 1 else [image_face]
+
+        parent_span = current_span()
+
+        def analyze_face(face: Face) -> FaceAnalysisResult:
+            roi = face.roi if face.roi is not None else (0, face.image.shape[0], 0, face.image.shape[1])
+            face_config = copy.copy(skin_config)
+            face_config.IMAGE_PATH = ""
+            face_config.IMAGE = face.image
+            # Forking processes from several threads is not safe, so the stages of each face run on threads.
+            face_config.EXECUTION_MODE = ExecutionMode.THREAD
+            with span("analyze_face", parent=parent_span, roi=roi):
+                try:
+                    result = SkinToneAnalyzer(maskrcnn_model, face_config, face=face).analyze()
+                    # The image quality is checked once for the whole image, not by the per face analyzers.
+                    result.image_quality = image_quality
+                    return FaceAnalysisResult(roi=roi, result=result, image_quality=image_quality)
+                except Exception as e:
+                    return FaceAnalysisResult(roi=roi, error=e, image_quality=image_quality)
+
+        if max_workers is None:
+            max_workers = min(len(faces), MAX_THREADS)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            results = list(pool.map(analyze_face, faces))
+
+        return results
+
     """
     Computes average brightness of the RGB image for given face mask.
     """
@@ -833,18 +1183,10 @@ class SkinToneAnalyzer:
 
     def detect_skin_tone_and_light_direction(self) -> list:
         total_points = np.count_nonzero(self.face_mask_to_process)
-        ycrcb_image = ImageUtils.to_YCrCb(self.image)
+        ycrcb_image = self.ycrcb_image()
 
         # Make clusters.
-        if self.skin_config.USE_NEW_CLUSTERING_ALGORITHM:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.__make_new_clusters(ycrcb_image,
-                                                                                          self.face_mask_to_process)
-        else:
-            all_cluster_masks, effective_color_map = SkinToneAnalyzer.make_clusters(ycrcb_image,
-                                                                                    self.face_mask_to_process,
-                                                                                    self.skin_config.KMEANS_TOLERANCE,
-                                                                                    self.skin_config.KMEANS_FACE_MASK_PERCENT_CUTOFF,
-                                                                                    self.skin_config.DEBUG_MODE)
+        all_cluster_masks, effective_color_map = self.face_clusters()
 
         # Get light direction from face mask clusters.
         mask_directions_list = [ImageUtils.get_mask_direction(b_mask, self.nose_middle_point, self.rotation_matrix,
@@ -900,13 +1242,17 @@ class SkinToneAnalyzer:
 
                 skin_tone = SkinTone(rgb=mean_color_rgb.tolist(), hsv=hsv.tolist(), hls=hls.tolist(), gray=0.0,
                                      ycrcb=[],
-                                     percent_of_face_mask=round(percent_of_face_mask, 2), face_mask=mask.copy(),
+                                     percent_of_face_mask=round(percent_of_face_mask, 2), face_mask=mask,
                                      profile=SkinTone.DISPLAY_P3)
                 skin_tones.append(skin_tone)
 
         return skin_tones
 
 
+register_clustering_strategy(KMEANS, SkinToneAnalyzer.kmeans_clusters, SkinToneAnalyzer.KMEANS_CONFIG_FIELDS)
+register_clustering_strategy(BRIGHTNESS_BANDS, SkinToneAnalyzer.brightness_bands_clusters)
+
+
 """
 Helper to read test face mask info from test images. Can be removed after tested on server.
 """
@@ -945,7 +1291,7 @@ def test_detection_dir(mrcnn_model, sk_config):
         sk_config.IMAGE_PATH = p
         print("Path: ", p)
         an = SkinToneAnalyzer(mrcnn_model, sk_config, None)
-        filtered_skin_tones = ImageUtils.smaller_cluster_skin_tones(analyzer.image, analyzer.face_mask_to_process)
+        filtered_skin_tones = ImageUtils.smaller_cluster_skin_tones(an.image, an.face_mask_to_process)
         #shade_file_name = os.path.splitext(args.image)[0] + "_shade_clusters.png"
         filtered_file_name = os.path.splitext(p)[0] + "_filtered_" + str(round(abs(filtered_skin_tones[0].hls[
                                                                                           2]-filtered_skin_tones[
@@ -1063,11 +1409,13 @@ def check_brightness(final_skin_tones):
     foundation_color = np.array([186,141,112])
     # HSV = p179, 136, 107]
     #foundation_color = np.array([179, 136, 107])
+    foundation_catalog = ShadeCatalog(["foundation"], foundation_color)
+    foundation_delta = foundation_catalog.delta_e(final_skin_tones)[:, 0]
     print("\nbrightness calc")
     print("best sum: ", best_sum, " best tones len: ", len(best_tones))
-    for sk in best_tones:
+    for i, sk in enumerate(best_tones):
         print("V: ", sk.hsv[2], " chroma: ", sk.hls[2], " sat: ", sk.hsv[1], " percent: ",
-              sk.percent_of_face_mask, " delta cie: ", ImageUtils.delta_cie2000_v2(sk.rgb, foundation_color))
+              sk.percent_of_face_mask, " delta cie: ", foundation_delta[best_start_pos + i])
 
     print("\nbrighter tones with end pos: ", best_start_pos)
     for i in range(0, best_start_pos):
@@ -1075,7 +1423,7 @@ def check_brightness(final_skin_tones):
         if round(sk.percent_of_face_mask) >= 1:
             print("V: ", sk.hsv[2], " chroma: ", sk.hls[2], " sat: ", sk.hsv[1],
                                                      " percent: ",
-                  sk.percent_of_face_mask, " delta cie: ", ImageUtils.delta_cie2000_v2(sk.rgb, foundation_color))
+                  sk.percent_of_face_mask, " delta cie: ", foundation_delta[i])
 
     return best_tones
 
@@ -1208,6 +1556,8 @@ if __name__ == "__main__":
     #foundation_color = np.array([212, 181, 146])
     #foundation_color = np.array([220, 180, 140])
     #foundation_color = np.array([191, 144, 117])
+    foundation_catalog = ShadeCatalog(["foundation"], foundation_color)
+    foundation_delta = foundation_catalog.delta_e(final_skin_tones)[:, 0] if len(final_skin_tones) > 0 else []
     for i, sk in enumerate(final_skin_tones):
         if first_c == -1:
             first_c = round(sk.hls[2])
@@ -1235,7 +1585,7 @@ if __name__ == "__main__":
               sk.percent_of_face_mask,
               " cum percent: ", round(cum_percent, 2), " L: ", sk.hls[1], " delta LS: ", round(sk.hls[1] - sk.hls[
                 2]), " ratio: ", round(w_ratio, 2), " delta SS: ", delta_ss, " prevd: ", prev_d, " 50 d: ", delta_50_d,
-              " delta cie: ", round(ImageUtils.delta_cie2000_v2(sk.rgb, foundation_color), 2), " cum delta percent: "
+              " delta cie: ", round(foundation_delta[i], 2), " cum delta percent: "
                                                                                                "",
               round(cum_delta_percent,2))
         if cum_percent > cutoff_print and not cutoff_reached:
@@ -0,0 +1,278 @@
+"""
+spectral has batched helpers to recover reflectance curves from sRGB colors. The reflectance spans the wavelength
+range 380-730 nm in 10 nm increments and is recovered using the methods specified by Scott Burns on his site:
+http://scottburns.us/reflectance-curves-from-srgb/.
+"""
+import csv
+import colour
+import numpy as np
+
+from scipy.sparse import diags
+
+# Default location of the T matrix CSV (relative to the working directory).
+T_MATRIX_PATH = "T_matrix.csv"
+
+# Cache of T matrices keyed by path so that each CSV is read only once per process.
+_T_MATRIX_CACHE = {}
+
+"""
+read_T_matrix reads the T matrix CSV containing T matrix used for predicting reflectance spectrum for a given color.
+Refer to http://scottburns.us/subtractive-color-mixture/ for more details. The CSV is only read on the first call
+for a given path. Returned T is a read only (3,36) numpy array converting reflectance to D65 weighted linear rgb.
+"""
+
+
+def read_T_matrix(path: str = T_MATRIX_PATH) -> np.ndarray:
+    if path in _T_MATRIX_CACHE:
+        return _T_MATRIX_CACHE[path]
+
+    with open(path) as f:
+        csv_reader = csv.reader(f, delimiter=",")
+        rows = []
+        for i, row in enumerate(csv_reader):
+            if i == 0:
+                continue
+            rows.append(row[1:])
+
+    T = np.stack(rows, axis=0).astype(float)
+    T.setflags(write=False)
+    _T_MATRIX_CACHE[path] = T
+    return T
+
+
+"""
+linearize_srgb removes gamma correction from given sRGB array (n,3) with values between 0-255. Returned array is
+linear RGB (n,3) with values between 0-1.
+"""
+
+
+def linearize_srgb(rgb_arr: np.ndarray) -> np.ndarray:
+    rgb_arr = np.asarray(rgb_arr, dtype=float) / 255.0
+    return np.where(rgb_arr < 0.04045, rgb_arr / 12.92, np.power((rgb_arr + 0.055) / 1.055, 2.4))
+
+
+"""
+rspectrum_lhtss_batch calculates the reflectance spectrum for given array of RGB colors (n,3) in 0-255 range using
+the Least Hyperbolic Tangent Slope Squared (LHTSS) method. Newton's method is run on all colors at once: every
+iteration solves a stacked (n,39,39) linear system and colors that have converged are removed from the active set.
+Returns (n,36) numpy array of reconstructed reflectance values, all (0->1).
+"""
+
+
+def rspectrum_lhtss_batch(rgb_arr: np.ndarray, T: np.ndarray = None, ftol: float = 1e-8,
+                          max_iters: int = 100) -> np.ndarray:
+    if T is None:
+        T = read_T_matrix()
+
+    rgb_arr = np.reshape(np.asarray(rgb_arr, dtype=float), (-1, 3))
+    num_intervals = T.shape[1]
+    rho = np.zeros((rgb_arr.shape[0], num_intervals))
+
+    # Black and white input colors.
+    black = np.all(rgb_arr == 0, axis=1)
+    white = np.all(rgb_arr == 255, axis=1)
+    rho[black] = 0.0001
+    rho[white] = 1.0
+
+    # 36 by 36 Jacobian having 4 main diagonal and -2 on off diagonals, except for first and last main diagonal
+    # are 2.
+    D = diags([-2, 4, -2], [-1, 0, 1], shape=(num_intervals, num_intervals)).toarray()
+    D[0][0] = 2
+    D[num_intervals - 1, num_intervals - 1] = 2
+
+    active = np.nonzero(np.bitwise_not(np.bitwise_or(black, white)))[0]
+    rgb_lin = linearize_srgb(rgb_arr[active])
+    z = np.zeros((active.size, num_intervals))
+    lamda = np.zeros((active.size, 3))
+    diag_idx = np.arange(num_intervals)
+
+    # Newton's method iteration.
+    count = 0
+    while active.size > 0 and count <= max_iters:
+        tanh_z = np.tanh(z)
+        sech2_z = np.power(1 / np.cosh(z), 2)
+        d0 = (tanh_z + 1) / 2
+        d1 = sech2_z / 2
+        d2 = -sech2_z * tanh_z
+        T_lamda = lamda @ T
+
+        F = np.concatenate((z @ D.T + d1 * T_lamda, d0 @ T.T - rgb_lin), axis=1)
+        J = np.zeros((active.size, num_intervals + 3, num_intervals + 3))
+        J[:, :num_intervals, :num_intervals] = D
+        J[:, diag_idx, diag_idx] += d2 * T_lamda
+        J[:, :num_intervals, num_intervals:] = d1[:, :, np.newaxis] * T.T
+        J[:, num_intervals:, :num_intervals] = T[np.newaxis, :, :] * d1[:, np.newaxis, :]
+
+        delta = np.linalg.solve(J, -F[:, :, np.newaxis])[:, :, 0]
+        z = z + delta[:, :num_intervals]
+        lamda = lamda + delta[:, num_intervals:]
+
+        converged = np.all(np.absolute(F) < ftol, axis=1)
+        if np.any(converged):
+            # Found solution for these colors.
+            rho[active[converged]] = (np.tanh(z[converged]) + 1) / 2
+            keep = np.bitwise_not(converged)
+            active, z, lamda, rgb_lin = active[keep], z[keep], lamda[keep], rgb_lin[keep]
+        count += 1
+
+    if active.size > 0:
+        raise Exception("rspectrum_lhtss_batch: No solution found in iteration for " + str(active.size) + " colors")
+
+    return rho
+
+
+"""
+rspectrum_ilss_batch calculates the reflectance spectrum for given array of RGB colors (n,3) in 0-255 range using
+the Iterative Least Slope Squared (ILSS) method. The bordered matrix is inverted once and the constrained
+projection for every color is solved as a stacked (n,36,36) system in which wavelengths that are not fixed at a
+bound are padded with identity rows. Returns (n,36) numpy array of reconstructed reflectance values, all (0->1).
+"""
+
+
+def rspectrum_ilss_batch(rgb_arr: np.ndarray, T: np.ndarray = None, max_iters: int = 10) -> np.ndarray:
+    if T is None:
+        T = read_T_matrix()
+
+    rgb_arr = np.reshape(np.asarray(rgb_arr, dtype=float), (-1, 3))
+    num_intervals = T.shape[1]
+    rhomin = 0.00001
+    rhomax = 1
+
+    D = diags([-6, 20, -6], [-1, 0, 1], shape=(num_intervals, num_intervals)).toarray()
+    D[0][0] = 2
+    D[num_intervals - 1, num_intervals - 1] = 2
+
+    B = np.linalg.inv(np.concatenate(
+        (np.concatenate((D, np.transpose(T)), axis=1), np.concatenate((T, np.zeros((3, 3))), axis=1)), axis=0))
+    B11 = B[:num_intervals, :num_intervals]
+
+    # Unconstrained solution.
+    R = linearize_srgb(rgb_arr) @ B[:num_intervals, num_intervals:].T
+    rho = R.copy()
+
+    black = np.all(rgb_arr == 0, axis=1)
+    white = np.all(rgb_arr == 255, axis=1)
+    active = np.any(np.bitwise_or(rho < rhomin, rho > rhomax), axis=1)
+    active[np.bitwise_or(black, white)] = False
+    diag_idx = np.arange(num_intervals)
+
+    count = 1
+    while np.any(active) and count <= max_iters:
+        idx = np.nonzero(active)[0]
+        curr_rho = rho[idx]
+        fixed_upper = curr_rho >= rhomax
+        fixed_lower = curr_rho <= rhomin
+        fixed = np.bitwise_or(fixed_upper, fixed_lower)
+
+        # Solve (K B11 K') y = K R - bounds for each color with free wavelengths padded by identity rows.
+        A = np.where(fixed[:, :, np.newaxis] & fixed[:, np.newaxis, :], B11, 0.0)
+        A[:, diag_idx, diag_idx] += np.bitwise_not(fixed)
+        rhs = np.where(fixed, R[idx] - np.where(fixed_upper, rhomax, rhomin), 0.0)
+        y = np.linalg.solve(A, rhs[:, :, np.newaxis])[:, :, 0]
+
+        curr_rho = R[idx] - y @ B11.T
+        curr_rho[fixed_upper] = rhomax
+        curr_rho[fixed_lower] = rhomin
+        rho[idx] = curr_rho
+        active[idx] = np.any(np.bitwise_or(curr_rho < rhomin, curr_rho > rhomax), axis=1)
+        count += 1
+
+    if np.any(active):
+        raise Exception("No solution found after: ", str(max_iters), " iterations")
+
+    rho[black] = rhomin
+    rho[white] = rhomax
+    return rho
+
+
+"""
+delinearize_srgb adds gamma correction to given linear RGB array (n,3) with values between 0-1. Returned array is
+sRGB (n,3) with integer values truncated the same way as ImageUtils.add_gamma_correction.
+"""
+
+
+def delinearize_srgb(rgb_arr: np.ndarray) -> np.ndarray:
+    rgb_arr = np.absolute(np.asarray(rgb_arr, dtype=float))
+    return np.trunc(np.where(rgb_arr < 0.0031308, 12.92 * rgb_arr * 255,
+                             255 * (1.055 * np.power(rgb_arr, 1 / 2.4) - 0.055))).astype(int)
+
+
+"""
+SpectralContext holds the spectral data needed to go from reflectance curves to colors: the T matrix, the CIE 1931
+2 degree color matching functions and the D65 illuminant, all aligned to 380-730 nm in 10 nm increments. The aligned
+arrays are computed once so that a (n,36) reflectance matrix is integrated to XYZ with a single matrix multiply
+instead of building a colour.SpectralDistribution per spectrum.
+"""
+
+
+class SpectralContext:
+    # XYZ to linear sRGB (D65) matrix.
+    XYZ_TO_RGB_MATRIX = np.array([[3.2404542, -1.5371385, -0.4985314], [-0.9692660, 1.8760108, 0.0415560],
+                                  [0.0556434, -0.2040259, 1.0572252]])
+
+    def __init__(self, t_matrix_path: str = T_MATRIX_PATH):
+        self.t_matrix_path = t_matrix_path
+        self.shape = colour.SpectralShape(380, 730, 10)
+        self.wavelengths = np.arange(380, 731, 10)
+
+        self.cmfs_sd = colour.STANDARD_OBSERVERS_CMFS['CIE 1931 2 Degree Standard Observer'].copy().align(self.shape)
+        self.illuminant_sd = colour.ILLUMINANTS_SDS['D65'].copy().align(self.shape)
+        self.cmfs = np.asarray(self.cmfs_sd.values, dtype=float)
+        self.illuminant = np.asarray(self.illuminant_sd.values, dtype=float)
+
+        # (36,3) weights so that XYZ = R @ weights, normalized so that a perfect reflector has Y = 1.
+        self.xyz_weights = (self.cmfs * self.illuminant[:, np.newaxis]) / np.sum(self.cmfs[:, 1] * self.illuminant)
+        self.xyz_weights.setflags(write=False)
+
+    """
+    T returns the (3,36) T matrix. It is read lazily so that the context can be used without the T matrix CSV.
+    """
+
+    @property
+    def T(self) -> np.ndarray:
+        return read_T_matrix(self.t_matrix_path)
+
+    """
+    sd_to_XYZ integrates given reflectance array (...,36) under D65 and returns XYZ array (...,3) scaled between 0-1.
+    """
+
+    def sd_to_XYZ(self, sd_arr: np.ndarray) -> np.ndarray:
+        return np.asarray(sd_arr, dtype=float) @ self.xyz_weights
+
+    """
+    sd_to_uv returns the CIE 1976 u'v' chromaticity array (...,2) of given reflectance array (...,36).
+    """
+
+    def sd_to_uv(self, sd_arr: np.ndarray) -> np.ndarray:
+        xyz = self.sd_to_XYZ(sd_arr)
+        denom = xyz[..., 0] + 15 * xyz[..., 1] + 3 * xyz[..., 2]
+        return np.stack((4 * xyz[..., 0] / denom, 9 * xyz[..., 1] / denom), axis=-1)
+
+    """
+    sd_to_linear_rgb returns the linear sRGB array (...,3) of given reflectance array (...,36).
+    """
+
+    def sd_to_linear_rgb(self, sd_arr: np.ndarray) -> np.ndarray:
+        return self.sd_to_XYZ(sd_arr) @ SpectralContext.XYZ_TO_RGB_MATRIX.T
+
+    """
+    sd_to_sRGB returns the sRGB array (...,3) with values between 0-255 of given reflectance array (...,36).
+    """
+
+    def sd_to_sRGB(self, sd_arr: np.ndarray) -> np.ndarray:
+        return delinearize_srgb(self.sd_to_linear_rgb(sd_arr))
+
+
+# Cache of spectral contexts keyed by T matrix path.
+_SPECTRAL_CONTEXT_CACHE = {}
+
+"""
+get_spectral_context returns the spectral context for the given T matrix path. The context is created once per
+process and shared by all later calls.
+"""
+
+
+def get_spectral_context(t_matrix_path: str = T_MATRIX_PATH) -> SpectralContext:
+    if t_matrix_path not in _SPECTRAL_CONTEXT_CACHE:
+        _SPECTRAL_CONTEXT_CACHE[t_matrix_path] = SpectralContext(t_matrix_path)
+    return _SPECTRAL_CONTEXT_CACHE[t_matrix_path]
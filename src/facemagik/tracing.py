@@ -0,0 +1,227 @@
+"""
+tracing records nested timed spans of the analysis so that latencies can be aggregated instead of printed. A span is
+opened with the span context manager or the traced decorator; spans opened while another span is open on the same
+thread become its children, and every span of a request shares the trace id of its root span. Finished spans can be
+summarized or exported as JSON lines or in the Chrome trace format (open in chrome://tracing or Perfetto).
+
+Tracing is disabled by default (set the FACEMAGIK_TRACING environment variable to 1 or call enable_tracing). When
+disabled, span returns a shared no-op context manager and traced functions are called directly, so instrumented code
+pays a single flag check. Spans are only collected in the process that records them.
+"""
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, List
+
+# Maximum number of finished spans kept in memory. Oldest spans are dropped first.
+MAX_SPANS = 100000
+
+_enabled = os.environ.get("FACEMAGIK_TRACING", "0") == "1"
+_spans = deque(maxlen=MAX_SPANS)
+_span_ids = itertools.count(1)
+_local = threading.local()
+
+"""
+Span is a single timed region. start is the wall clock time (seconds since epoch) at which it was opened and duration
+is in seconds. parent_id is 0 for root spans.
+"""
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: int
+    parent_id: int
+    start: float
+    duration: float = 0.0
+    process_id: int = 0
+    thread_id: int = 0
+    attributes: Dict[str, object] = field(default_factory=dict)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _ActiveSpan:
+    def __init__(self, name: str, parent: Span, attributes: dict):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.span = None
+        self.start_counter = 0.0
+
+    def __enter__(self) -> Span:
+        stack = _span_stack()
+        parent = self.parent if self.parent is not None else (stack[-1] if len(stack) > 0 else None)
+        self.span = Span(name=self.name, trace_id=parent.trace_id if parent is not None else uuid.uuid4().hex,
+                         span_id=next(_span_ids), parent_id=parent.span_id if parent is not None else 0,
+                         start=time.time(), process_id=os.getpid(), thread_id=threading.get_ident(),
+                         attributes=self.attributes)
+        stack.append(self.span)
+        self.start_counter = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.duration = time.perf_counter() - self.start_counter
+        if exc_type is not None:
+            self.span.attributes["error"] = exc_type.__name__
+        stack = _span_stack()
+        if len(stack) > 0 and stack[-1] is self.span:
+            stack.pop()
+        _spans.append(self.span)
+        return False
+
+
+def _span_stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def enable_tracing():
+    global _enabled
+    _enabled = True
+
+
+def disable_tracing():
+    global _enabled
+    _enabled = False
+
+
+def is_tracing_enabled() -> bool:
+    return _enabled
+
+
+"""
+span returns a context manager that records a span with given name and attributes. The span is a child of given
+parent, or of the innermost open span of the calling thread if parent is None. Pass the parent explicitly when the
+work runs on another thread (like a thread pool) than the span it belongs to.
+"""
+
+
+def span(name: str, parent: Span = None, **attributes):
+    if not _enabled:
+        return _NOOP_SPAN
+    return _ActiveSpan(name, parent, attributes)
+
+
+"""
+traced is a decorator that records a span (named after the function unless a name is given) around every call of
+the decorated function.
+"""
+
+
+def traced(name: str = None) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        span_name = name if name is not None else fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _ActiveSpan(span_name, None, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+"""
+current_span returns the innermost open span of the calling thread, None if there is none or tracing is disabled.
+"""
+
+
+def current_span() -> Span:
+    if not _enabled:
+        return None
+    stack = _span_stack()
+    return stack[-1] if len(stack) > 0 else None
+
+
+"""
+get_spans returns the finished spans, optionally only those of given trace.
+"""
+
+
+def get_spans(trace_id: str = None) -> List[Span]:
+    spans = list(_spans)
+    if trace_id is None:
+        return spans
+    return [s for s in spans if s.trace_id == trace_id]
+
+
+def clear_spans():
+    _spans.clear()
+
+
+"""
+summarize returns the count, total, mean and max duration (seconds) of given spans (all finished spans if None)
+grouped by name.
+"""
+
+
+def summarize(spans: List[Span] = None) -> Dict[str, dict]:
+    if spans is None:
+        spans = get_spans()
+    summary = {}
+    for s in spans:
+        entry = summary.setdefault(s.name, {"count": 0, "total": 0.0, "max": 0.0})
+        entry["count"] += 1
+        entry["total"] += s.duration
+        entry["max"] = max(entry["max"], s.duration)
+    for entry in summary.values():
+        entry["mean"] = entry["total"] / entry["count"]
+    return summary
+
+
+"""
+export_jsonl appends given spans (all finished spans if None) to the JSON lines file at given path, one span per
+line.
+"""
+
+
+def export_jsonl(path: str, spans: List[Span] = None):
+    if spans is None:
+        spans = get_spans()
+    with open(path, "a") as f:
+        for s in spans:
+            f.write(json.dumps(asdict(s), default=str) + "\n")
+
+
+"""
+export_chrome_trace writes given spans (all finished spans if None) to given path in the Chrome trace event format.
+"""
+
+
+def export_chrome_trace(path: str, spans: List[Span] = None):
+    if spans is None:
+        spans = get_spans()
+    events = [{"name": s.name, "cat": "facemagik", "ph": "X", "ts": s.start * 1e6, "dur": s.duration * 1e6,
+               "pid": s.process_id, "tid": s.thread_id,
+               "args": dict(s.attributes, trace_id=s.trace_id, span_id=s.span_id, parent_id=s.parent_id)} for s in
+              spans]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
@@ -12,12 +12,14 @@ import colormath
 import re
 import matplotlib.pyplot as plt
 
-from scipy.sparse import diags
 from scipy.optimize import minimize
 from colormath.color_conversions import convert_color
 from colormath.color_diff import delta_e_cie2000
 from colormath import color_diff_matrix
 from .common import MaskDirection, SkinTone
+from .spectral import read_T_matrix, rspectrum_lhtss_batch, rspectrum_ilss_batch, get_spectral_context
+from .foundation import foundation_layer, simulate_foundation
+from .reflectance_table import REFLECTANCE_TABLE_PATH, build_reflectance_table
 from PIL import Image
 
 
@@ -444,69 +446,7 @@ class ImageUtils:
     """
 
     def rspectrum_lhtss(rgb):
-        T = ImageUtils.read_T_matrix()
-
-        # convert from rgb tuple to list.
-        rgb = [rgb[0], rgb[1], rgb[2]]
-
-        numIntervals = T.shape[1]
-        rho = np.zeros(numIntervals)
-
-        # Black input color.
-        if rgb == (0, 0, 0):
-            rho = 0.0001 * np.ones(numIntervals)
-            return rho
-
-        # White input color.
-        if rgb == (255, 255, 255):
-            rho = np.ones(numIntervals)
-            return rho
-
-        # 36 by 36 Jacobian having 4 main diagonal
-        # and -2 on off diagonals, except for first and
-        # last main diagonal are 2.
-        D = diags([-2, 4, -2], [-1, 0, 1], shape=(numIntervals, numIntervals)).toarray()
-        D[0][0] = 2
-        D[numIntervals - 1, numIntervals - 1] = 2
-
-        # Scale RGB values to between 0-1 and remove
-        # gamma correction.
-        for i in range(3):
-            rgb[i] = rgb[i] / 255.0
-            if rgb[i] < 0.04045:
-                rgb[i] = rgb[i] / 12.92
-            else:
-                rgb[i] = math.pow((rgb[i] + 0.055) / 1.055, 2.4)
-
-        # Initialize paramters in optimization.
-        z = np.zeros(numIntervals)
-        lamda = np.zeros(3)
-        ftol = math.pow(10, -8)
-        count = 0
-        NUM_ITERS = 100
-
-        # Newton's method iteration.
-        divider = 2
-        while count <= NUM_ITERS:
-            d0 = (np.tanh(z) + 1) / divider
-            d1 = np.diag(np.power(1 / np.cosh(z), 2) / divider)
-            d2 = np.diag(-np.power(1 / np.cosh(z), 2) * np.tanh(z) * (2 / divider))
-            F = np.concatenate(
-                (np.matmul(D, z) + np.matmul(d1, np.matmul(np.transpose(T), lamda)), np.matmul(T, d0) - rgb))
-            J1 = np.concatenate(
-                (D + np.diag(np.matmul(d2, np.matmul(np.transpose(T), lamda))), np.matmul(d1, np.transpose(T))), axis=1)
-            J2 = np.concatenate((np.matmul(T, d1), np.zeros((3, 3))), axis=1)
-            J = np.concatenate((J1, J2), axis=0)
-            delta = np.matmul(np.linalg.inv(J), -F)
-            z = z + delta[:numIntervals]
-            lamda = lamda + delta[numIntervals:]
-            if np.all(np.less(np.absolute(F) - ftol, np.zeros(numIntervals + 3))):
-                # Found solution.
-                rho = (np.tanh(z) + 1) / divider
-                return rho
-            count += 1
-
-        raise Exception("rspectrum_lhtss: No solution found in iteration")
+        return rspectrum_lhtss_batch(np.array([rgb[0], rgb[1], rgb[2]]))[0]
 
     """
     rspectrum_lhtss calculates the reflectance spectrum for the
@@ -519,77 +459,7 @@ class ImageUtils:
     """
 
     def rspectrum_ilss(rgb):
-        T = np.power(ImageUtils.read_T_matrix(), 1)
-
-        # convert from rgb tuple to list.
-        rgb = np.array([rgb[0], rgb[1], rgb[2]], dtype=np.float)
-
-        numIntervals = T.shape[1]
-        rho = np.ones(numIntervals) / 2.0
-        rhomin = 0.00001
-        rhomax = 1
-
-        if np.array_equal(rgb, [0, 0, 0]):
-            return rhomin * np.ones(numIntervals)
-
-        if np.array_equal(rgb, [1, 1, 1]):
-            return rhomax * np.ones(numIntervals)
-
-        # Scale RGB values to between 0-1 and remove
-        # gamma correction.
-        for i in range(3):
-            rgb[i] = rgb[i] / 255.0
-            if rgb[i] < 0.04045:
-                rgb[i] = rgb[i] / 12.92
-            else:
-                rgb[i] = math.pow((rgb[i] + 0.055) / 1.055, 2.4)
-
-        # 36 by 36 Jacobian having 4 main diagonal
-        # and -2 on off diagonals, except for first and
-        # last main diagonal are 2.
-        # D = diags([-2, 4, -2], [-1, 0, 1], shape=(numIntervals, numIntervals)).toarray()
-        D = diags([-6, 20, -6], [-1, 0, 1], shape=(numIntervals, numIntervals)).toarray()
-        D[0][0] = 2
-        D[numIntervals - 1, numIntervals - 1] = 2
-
-        B = np.linalg.inv(np.concatenate(
-            (np.concatenate((D, np.transpose(T)), axis=1), np.concatenate((T, np.zeros((3, 3))), axis=1)), axis=0))
-
-        R = np.matmul(B[:numIntervals, numIntervals:], rgb)
-
-        NUM_ITERS = 10
-        count = 0
-        while count == 0 or (count <= NUM_ITERS and (np.any(np.less(rho - rhomin, np.zeros(numIntervals))) or np.any(
-                np.less(rhomax - rho, np.zeros(numIntervals))))):
-            # Create K1 for fixed reflectance at rhomax.
-            fixed_upper_logical = rho >= rhomax
-            fixed_upper = np.nonzero(fixed_upper_logical)[0]
-            num_upper = len(fixed_upper)
-            K1 = np.zeros((num_upper, numIntervals))
-            K1[range(K1.shape[0]), fixed_upper] = 1
-
-            # Create K0 for fixed reflectance at rhomin.
-            fixed_lower_logical = rho <= rhomin
-            fixed_lower = np.nonzero(fixed_lower_logical)[0]
-            num_lower = len(fixed_lower)
-            K0 = np.zeros((num_lower, numIntervals))
-            K0[range(K0.shape[0]), fixed_lower] = 1
-
-            # Set up linear system.
-            K = np.concatenate((K1, K0), axis=0)
-            C = np.matmul(np.matmul(B[:numIntervals, :numIntervals], np.transpose(K)),
-                          np.linalg.inv(np.matmul(K, np.matmul(B[:numIntervals, :numIntervals], np.transpose(K)))))
-            rho = R - np.matmul(C, np.matmul(K, R) - np.concatenate(
-                (rhomax * np.ones(num_upper), rhomin * np.ones(num_lower)), axis=0))
-            rho[fixed_upper_logical] = rhomax
-            rho[fixed_lower_logical] = rhomin
-
-            count += 1
-
-        if count > NUM_ITERS:
-            raise Exception("No solution found after: ", str(NUM_ITERS), " iterations")
-
-        return rho
+        return rspectrum_ilss_batch(np.array([rgb[0], rgb[1], rgb[2]]))[0]
 
     """
     rspectrum_foundation estimates the reflectance of a given foundation color.
@@ -730,10 +600,13 @@ class ImageUtils:
         return colour.xy_to_Luv_uv(xy)
 
     """
-    to_YCrCb converts given sRGB image to YCrCb image.
+    to_YCrCb converts given sRGB image to YCrCb image. If dst is given, the result
+    is written into it (for example a shared memory buffer) instead of a new array.
     """
 
-    def to_YCrCb(srgbImage):
+    def to_YCrCb(srgbImage, dst=None):
+        if dst is not None:
+            return cv2.cvtColor(srgbImage, cv2.COLOR_RGB2YCR_CB, dst=dst)
         return cv2.cvtColor(srgbImage, cv2.COLOR_RGB2YCR_CB)
 
     """
@@ -845,34 +718,18 @@ class ImageUtils:
             [[0.4124564, 0.3575761, 0.1804375], [0.2126729, 0.7151522, 0.0721750], [0.0193339, 0.1191920, 0.9503041]])
 
         xyz = colour.RGB_to_XYZ(rgb, illuminant_RGB, illuminant_XYZ, RGB_to_XYZ_matrix, None)
-        cmfs = colour.STANDARD_OBSERVERS_CMFS['CIE 1931 2 Degree Standard Observer'].copy().align(
-            colour.SpectralShape(380, 730, 10))
-        sd = colour.recovery.XYZ_to_sd_Meng2015(xyz, cmfs, colour.ILLUMINANTS_SDS['D65'])
+        ctx = get_spectral_context()
+        sd = colour.recovery.XYZ_to_sd_Meng2015(xyz, ctx.cmfs_sd, ctx.illuminant_sd)
         return sd.values
 
     """
-    SD_to_RGB converts given spectral distribution values to sRGB using color
-    science library.
+    SD_to_RGB converts given spectral distribution values to sRGB using the
+    preloaded spectral context. sd_values can be a single (36,) spectrum or
+    a (n,36) array of spectra.
     """
 
     def SD_to_RGB(sd_values):
-        x = ImageUtils.wavelength_arr()
-        assert len(sd_values) == len(x)
-        d = {}
-        for i, l in enumerate(x):
-            d[l] = sd_values[i]
-
-        sd = colour.SpectralDistribution(d)
-        xyz = colour.sd_to_XYZ(sd, colour.CMFS['CIE 1931 2 Degree Standard Observer'],
-                               colour.ILLUMINANTS_SDS['D65']) / 100.0
-
-        # D65
-        illuminant_RGB = np.array([0.31270, 0.32900])
-        illuminant_XYZ = np.array([0.31270, 0.32900])
-        XYZ_to_RGB_matrix = np.array([[3.2404542, -1.5371385, -0.4985314], [-0.9692660, 1.8760108, 0.0415560],
-                                      [0.0556434, -0.2040259, 1.0572252]])
-        rgb = colour.XYZ_to_RGB(xyz, illuminant_XYZ, illuminant_RGB, XYZ_to_RGB_matrix, None)
-        return ImageUtils.add_gamma_correction(rgb)
+        return get_spectral_context().sd_to_sRGB(sd_values)
 
     """
     add_gamma_correction adds gamma correction to given RGB value and
@@ -893,7 +750,8 @@ class ImageUtils:
     we are interested in Spectral distribution.
     """
 
-    def wavelength_arr(self):
+    @staticmethod
+    def wavelength_arr():
         return [i for i in range(380, 731, 10)]
 
     """
@@ -958,17 +816,9 @@ class ImageUtils:
     Returned T is a (3,36) numpy array converting reflectance to D65 weighted linear rgb.
     """
 
-    def read_T_matrix(self):
-        T_matrix = []
-        with open("T_matrix.csv") as f:
-            csv_reader = csv.reader(f, delimiter=",")
-            rows = []
-            for i, row in enumerate(csv_reader):
-                if i == 0:
-                    continue
-                rows.append(row[1:])
-
-            return np.stack(rows, axis=0).astype(np.float)
+    @staticmethod
+    def read_T_matrix():
+        return read_T_matrix()
 
     """
     R_foundation_depth given the reflectance and transmittance of the given foundation matrix
@@ -976,21 +826,8 @@ class ImageUtils:
     """
 
     def R_foundation_depth(R_foundation, x_percent):
-        # Assume 2 mm is the maximum depth of the foundation.
-        D = 2
-        a = 0.5 * ((1 / R_foundation) + R_foundation)
-        b = np.sqrt((a ** 2) - 1)
-
-        rho = R_foundation * 0.99
-        S = (np.arctanh(b / (a - rho)) - np.arctanh(b / a)) / (b * D)
-        K = S * (a - 1)
-
-        # Find reflectance and transmittance at given depth.
-        x = x_percent * D
-        R = np.sinh(b * S * x) / (a * np.sinh(b * S * x) + b * np.cosh(b * S * x))
-        T = b / (a * np.sinh(b * S * x) + b * np.cosh(b * S * x))
-
-        return R, T
+        R, T = foundation_layer(R_foundation, [x_percent])
+        return R[0, 0], T[0, 0]
 
     """
     plot_reflectance is a rest function to plot the reflectance of
@@ -1027,28 +864,18 @@ class ImageUtils:
     to uv chromaticity and save it.
     """
 
-    def save_skin_spectra_uv(self):
-        skin_chrs = []
+    @staticmethod
+    def save_skin_spectra_uv():
+        rows = []
         with open("skin_spectra.csv") as f:
             csv_reader = csv.reader(f, delimiter=",")
-            x = ImageUtils.wavelength_arr()
             for i, row in enumerate(csv_reader):
                 if i == 0:
                     continue
-                rho = np.array(row[4:-1]).astype(np.float)
                 if (i > 0 * 482 and i < 4 * 482) or (i >= 7 * 482 and i <= 9 * 482):
-                    d = {}
-                    for k, l in enumerate(x):
-                        d[l] = rho[k]
-
-                    sd = colour.SpectralDistribution(d)
-                    xyz = colour.colorimetry.sd_to_XYZ_integration(sd, colour.CMFS[
-                        'CIE 1931 2 Degree Standard Observer'].copy().align(colour.SpectralShape(380, 730, 10)),
-                                                                   colour.ILLUMINANTS_SDS['D65'].copy().align(
-                                                                       colour.SpectralShape(380, 730, 10))) / 100.0
-                    xy = colour.XYZ_to_xy(xyz)
-                    uv = colour.xy_to_Luv_uv(xy)
-                    skin_chrs.append(list(uv))
+                    rows.append(row[4:-1])
+
+        skin_chrs = get_spectral_context().sd_to_uv(np.array(rows).astype(float)).tolist()
 
         plt.scatter(*zip(*skin_chrs))
         plt.show()
@@ -1066,13 +893,11 @@ class ImageUtils:
         x = ImageUtils.wavelength_arr()
         R_skin = ImageUtils.sRGB_to_SD(ImageUtils.color(skinColor))
         R_foundation = ImageUtils.sRGB_to_SD(ImageUtils.color(hexColor))
-        for x_percent in [0.01, 0.05, 0.08, 0.1, 0.2, 0.3, 0.5, 1]:
-            rho_f, T_f = ImageUtils.R_foundation_depth(R_foundation, x_percent)
-            # rho_mix = np.power(np.power(R_skin,0.85) * np.power(rho_f,0.5), 1)
-            # rho_mix = 0.0*R_skin + rho_f
-            Rs = 0.1
-            rho_mix = (1 - Rs) * (rho_f + ((T_f ** 2) * R_skin) / (1 - (R_skin * rho_f))) + Rs
-            color = ImageUtils.RGB2HEX(ImageUtils.SD_to_RGB(rho_mix))
+        depths = [0.01, 0.05, 0.08, 0.1, 0.2, 0.3, 0.5, 1]
+        sim = simulate_foundation(R_skin, R_foundation, depths)
+        for j, x_percent in enumerate(depths):
+            rho_mix = sim.reflectance[0, 0, j]
+            color = ImageUtils.RGB2HEX(sim.rgb[0, 0, j])
             plt.plot(x, rho_mix, label=color + "-" + str(x_percent), color=color, linewidth=2)
 
         plt.legend()
@@ -1097,25 +922,13 @@ class ImageUtils:
 
     """
     compute_all_reflectances will compute reflectance (infinite optical depth)
-    for all colors in the RGB space and store them in a JSON file.
+    for all colors in the RGB space and store them in a float16 memory mapped
+    table indexed by flatten_rgb(rgb) - 1. Refer to reflectance_table for details.
     """
 
-    def compute_all_reflectances(self):
-        d = {}
-        total = 256 * 256 * 256
-        print("Total: ", total)
-        next_milestone = 0
-        for i in range(256):
-            for j in range(256):
-                for k in range(256):
-                    rho_infinity = ImageUtils.rspectrum_lhtss((i, j, k))
-                    d[ImageUtils.hash_tuple((i, j, k))] = rho_infinity.tolist()
-                    if int(len(d) / total) * 100 >= next_milestone:
-                        print(str(next_milestone) + "% complete")
-                        next_milestone += 1
-
-        with open("reflectance.json", "w") as f:
-            json.dump(d, f)
+    @staticmethod
+    def compute_all_reflectances(path=REFLECTANCE_TABLE_PATH, num_processes=None):
+        build_reflectance_table(path=path, num_processes=num_processes)
 
     """
     random_color generates a random RGB color each time it is called.
@@ -1667,6 +1480,45 @@ class ImageUtils:
 
         return bestMedoids, bestMasks, bestIndices, minCost
 
+    """
+    label_sizes returns the number of points of every label (0 to numLabels) of given label image. The background
+    (label 0) has size 0.
+    """
+
+    def label_sizes(labelImage, numLabels):
+        sizes = np.bincount(labelImage.ravel(), minlength=numLabels + 1)
+        sizes[0] = 0
+        return sizes
+
+    """
+    dominant_label returns the label among given labels with the largest mean of given values (same shape as the label
+    image). The per label sums are computed with bincount, without a mask per label.
+    """
+
+    def dominant_label(labelImage, labels, values):
+        minlength = int(np.max(labels)) + 1
+        sums = np.bincount(labelImage.ravel(), weights=np.ravel(values), minlength=minlength)
+        counts = np.bincount(labelImage.ravel(), minlength=minlength)
+        return labels[np.argmax(sums[labels] / counts[labels])]
+
+    """
+    label_boundary_mask returns the mask of the (first) contour of given label of given label image, drawn with given
+    thickness. The contour is found and drawn on the bounding box of the label (labelSlice, from ndimage.find_objects)
+    padded by the thickness instead of on the whole image.
+    """
+
+    def label_boundary_mask(labelImage, label, labelSlice, thickness=3):
+        rows = slice(max(labelSlice[0].start - thickness, 0), min(labelSlice[0].stop + thickness, labelImage.shape[0]))
+        cols = slice(max(labelSlice[1].start - thickness, 0), min(labelSlice[1].stop + thickness, labelImage.shape[1]))
+        clusterMask = (labelImage[rows, cols] == label).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(clusterMask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        cImg = np.zeros(clusterMask.shape, dtype=np.uint8)
+        cv2.drawContours(cImg, contours, 0, color=255, thickness=thickness)
+
+        boundaryMask = np.zeros(labelImage.shape, dtype=bool)
+        boundaryMask[rows, cols] = cImg == 255
+        return boundaryMask
+
     """
     boundaries returns a list of masks that each represent a cluster of boundary points associated with given mask.
     """
@@ -1676,24 +1528,13 @@ class ImageUtils:
 
         # Find all distinct clusters in given mask.
         labelImage, labels = ndimage.label(mask)
-        sizes = ndimage.sum(mask, labelImage, range(labels + 1))
+        sizes = ImageUtils.label_sizes(labelImage, labels)
         clusterSizeCutOff = (0.1 / 100.0) * np.count_nonzero(mask)
-        indices = np.transpose(np.argwhere(sizes > clusterSizeCutOff))
-        allMasks = np.repeat(labelImage[:, :, np.newaxis], len(indices), axis=2) == indices
-
-        # Dominant mask, one with largest number of points.
-        # domMask = allMasks[:, :, np.argmax(np.sum(np.where(allMasks, np.repeat(self.beta[:, :, np.newaxis], len(indices), axis=2), 0), axis=(0,1))/sizes[indices])]
+        indices = np.flatnonzero(sizes > clusterSizeCutOff)
 
         # Find boundary mask of each cluster.
-        flatIndicesList = [item for sublist in indices for item in sublist]
-        allBoundaryMasks = []
-        for idx in range(len(flatIndicesList)):
-            clusterMask = allMasks[:, :, idx]
-            contours, _ = cv2.findContours(cv2.threshold((200 * clusterMask).astype(np.uint8), 127, 255, 0)[1],
-                                           cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            cImg = np.zeros(mask.shape)
-            cv2.drawContours(cImg, contours, 0, color=255, thickness=3)
-            allBoundaryMasks.append(cImg == 255)
+        slices = ndimage.find_objects(labelImage)
+        allBoundaryMasks = [ImageUtils.label_boundary_mask(labelImage, idx, slices[idx - 1]) for idx in indices]
 
         assert len(allBoundaryMasks) > 0
         return allBoundaryMasks
@@ -2046,7 +1887,7 @@ class ImageUtils:
             ycrcb = ImageUtils.sRGBtoYCrCb(mean_color_rgb)[0]
             tone = SkinTone(rgb=mean_color_rgb.tolist(), hsv=hsv.tolist(), hls=hls.tolist(), gray=gray, ycrcb=ycrcb,
                             percent_of_face_mask=round(ImageUtils.percentPoints(m, total_points), 2),
-                            face_mask=m.copy(),
+                            face_mask=m,
                             profile=SkinTone.DISPLAY_P3)
             all_skin_tones.append(tone)
 
@@ -0,0 +1,344 @@
+"""
+video analyzes a stream of video frames of a face. Mask RCNN segmentation and full clustering only run on keyframes:
+the first frame, every KEYFRAME_INTERVAL frames, and whenever the face has moved or its appearance has changed beyond
+the configured thresholds. Between keyframes the keyframe masks are translated by the face motion (estimated with
+phase correlation on a downsampled crop around the face) and the skin tone colors and scene brightness are updated
+incrementally from the current frame using an exponential moving average.
+
+Example (from the src directory):
+    python -m facemagik.video --video <video path> --weights <weights path>
+"""
+import argparse
+import copy
+import time
+import cv2
+import numpy as np
+
+from collections import deque
+from dataclasses import dataclass, replace
+from .utils import ImageUtils
+from .common import ExecutionMode, SkinTone
+from .quality import PoorImageQualityException
+from .skintone import SkinToneAnalyzer, SkinDetectionConfig, SceneBrightnessAndDirection, TeethNotVisibleException
+
+"""
+Configuration details associated with video stream analysis.
+"""
+
+
+class VideoStreamConfig:
+    # Maximum number of frames between two keyframes.
+    KEYFRAME_INTERVAL: int = 30
+
+    # Face motion (in pixels of the full resolution frame) since the last keyframe beyond which a new keyframe is used.
+    MAX_MOTION_PIXELS: float = 24.0
+
+    # Minimum phase correlation response for the estimated motion to be trusted. Lower responses trigger a keyframe.
+    MIN_TRACKING_RESPONSE: float = 0.1
+
+    # Mean absolute gray level difference (0-255) between the motion compensated keyframe and the current frame within
+    # the face mask beyond which a new keyframe is used.
+    MAX_APPEARANCE_CHANGE: float = 12.0
+
+    # Weight of the current frame in the exponential moving average of skin tone colors and scene brightness.
+    COLOR_UPDATE_FACTOR: float = 0.2
+
+    # Scale at which frames are downsampled for motion estimation.
+    TRACKING_SCALE: float = 0.5
+
+    # Margin (as a fraction of the face size) added around the face bounding box used for motion estimation.
+    TRACKING_MARGIN: float = 0.25
+
+    # Number of recent frames used to compute the frames per second rate.
+    FPS_WINDOW: int = 30
+
+    def __init__(self):
+        pass
+
+    def __repr__(self):
+        return "VideoStreamConfig(KEYFRAME_INTERVAL: {0})".format(self.KEYFRAME_INTERVAL)
+
+
+"""
+Container class for the analysis results of a single frame. shift is the (dy, dx) translation of the face since the
+last keyframe and is (0, 0) on keyframes. keyframe_error is set if the frame had to be a keyframe but its analysis
+failed; the result then comes from the last keyframe (tracked into this frame if possible, otherwise repeated as is).
+"""
+
+
+@dataclass
+class FrameResult:
+    frame_index: int
+    is_keyframe: bool
+    shift: tuple
+    scene_brightness_and_direction: SceneBrightnessAndDirection
+    skin_tones: list
+    seconds: float
+    keyframe_error: Exception = None
+
+
+"""
+shift_mask returns a copy of given boolean mask translated by given integer (dy, dx). Pixels shifted in from outside
+the frame are false.
+"""
+
+
+def shift_mask(mask: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    if mask is None:
+        return None
+    h, w = mask.shape[:2]
+    shifted = np.zeros_like(mask)
+    if abs(dy) >= h or abs(dx) >= w:
+        return shifted
+    shifted[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = mask[max(-dy, 0):h + min(-dy, 0),
+                                                                         max(-dx, 0):w + min(-dx, 0)]
+    return shifted
+
+
+"""
+skin_tone_from_color returns a skin tone with given mean sRGB color, face mask percent and mask.
+"""
+
+
+def skin_tone_from_color(mean_color_rgb: np.ndarray, percent_of_face_mask: float, mask: np.ndarray) -> SkinTone:
+    mean_color_rgb = np.round(mean_color_rgb, 2)
+    hsv = ImageUtils.toHSVPreferredRange(ImageUtils.sRGBtoHSV(mean_color_rgb)[0])
+    hls = ImageUtils.toHSVPreferredRange(ImageUtils.sRGBtoHLS(mean_color_rgb)[0])
+    return SkinTone(rgb=mean_color_rgb.tolist(), hsv=hsv.tolist(), hls=hls.tolist(), gray=0.0, ycrcb=[],
+                    percent_of_face_mask=round(percent_of_face_mask, 2), face_mask=mask, profile=SkinTone.DISPLAY_P3)
+
+
+"""
+Class to analyze skin tone and lighting from a stream of RGB video frames of a face. Call process_frame with each
+frame in order.
+"""
+
+
+class FrameStreamAnalyzer:
+    # Skin tones covering less than this percent of the face mask are not reported (same cutoff as SkinToneAnalyzer).
+    SKIN_TONE_PERCENT_CUTOFF = 10
+
+    def __init__(self, maskrcnn_model, skin_config: SkinDetectionConfig, video_config: VideoStreamConfig = None):
+        self.maskrcnn_model = maskrcnn_model
+        self.skin_config = skin_config
+        self.video_config = video_config if video_config is not None else VideoStreamConfig()
+
+        self.frame_index = -1
+        self.num_keyframes = 0
+        self.frame_times = deque(maxlen=self.video_config.FPS_WINDOW)
+
+        # State of the last keyframe.
+        self.keyframe_index = None
+        self.keyframe_result = None
+        self.face_mask = None
+        self.mouth_mask = None
+        self.face_color_map = {}
+        self.mouth_color_map = {}
+        self.tracking_box = None
+        self.tracking_reference = None
+        self.tracking_window = None
+
+        # Running estimates updated on every frame.
+        self.mean_colors = {}
+        self.scene_brightness_value = None
+        self.last_result = None
+
+    """
+    Returns true if the next frame has to be a keyframe irrespective of its motion and appearance.
+    """
+
+    def needs_keyframe(self) -> bool:
+        return self.keyframe_index is None or self.frame_index - self.keyframe_index >= \
+               self.video_config.KEYFRAME_INTERVAL
+
+    """
+    Analyzes given RGB frame and returns its FrameResult.
+
+    If the frame needs to be a keyframe and its analysis fails because the teeth are not visible or the image quality
+    is poor, the frame is tracked from the last keyframe instead (or, if tracking fails too, the last result is
+    repeated) with keyframe_error set, and the keyframe is retried on the next frame. The exception is only raised if
+    there has never been a keyframe.
+    """
+
+    def process_frame(self, frame: np.ndarray) -> FrameResult:
+        start_time = time.time()
+        self.frame_index += 1
+
+        result = None
+        if not self.needs_keyframe():
+            result = self.track_frame(frame)
+        if result is None:
+            try:
+                result = self.analyze_keyframe(frame)
+            except (TeethNotVisibleException, PoorImageQualityException) as e:
+                if self.keyframe_index is None:
+                    raise
+                print("Keyframe analysis of frame ", self.frame_index, " failed: ", e)
+                result = self.track_frame(frame)
+                if result is None:
+                    result = replace(self.last_result, frame_index=self.frame_index, is_keyframe=False)
+                result.keyframe_error = e
+
+        self.last_result = result
+        result.seconds = time.time() - start_time
+        self.frame_times.append(result.seconds)
+        return result
+
+    """
+    Runs full segmentation and analysis on given frame and resets the tracking state to it.
+    """
+
+    def analyze_keyframe(self, frame: np.ndarray) -> FrameResult:
+        skin_config = copy.copy(self.skin_config)
+        skin_config.IMAGE_PATH = ""
+        skin_config.IMAGE = frame
+
+        analyzer = SkinToneAnalyzer(self.maskrcnn_model, skin_config)
+        analysis = analyzer.analyze()
+        _, mouth_color_map = analyzer.mouth_clusters(skin_config.EXECUTION_MODE == ExecutionMode.INLINE)
+
+        self.keyframe_index = self.frame_index
+        self.num_keyframes += 1
+        self.keyframe_result = analysis.scene_brightness_and_direction
+        self.face_mask = analyzer.face_mask_to_process
+        self.mouth_mask = analyzer.mouth_mask_to_process
+        self.face_color_map = analyzer.face_mask_effective_color_map
+        self.mouth_color_map = mouth_color_map
+        self.mean_colors = {color: np.mean(frame[mask], axis=0) for color, mask in self.face_color_map.items() if
+                            np.count_nonzero(mask) > 0}
+        self.scene_brightness_value = float(self.keyframe_result.scene_brightness_value)
+
+        self.tracking_box = self.face_tracking_box(self.face_mask)
+        self.tracking_reference = self.tracking_image(frame)
+        h, w = self.tracking_reference.shape
+        self.tracking_window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+
+        return FrameResult(frame_index=self.frame_index, is_keyframe=True, shift=(0, 0),
+                           scene_brightness_and_direction=self.keyframe_result, skin_tones=analysis.skin_tones,
+                           seconds=0.0)
+
+    """
+    Returns the (y0, y1, x0, x1) bounding box of given face mask expanded by the tracking margin.
+    """
+
+    def face_tracking_box(self, face_mask: np.ndarray) -> tuple:
+        ys, xs = np.nonzero(face_mask)
+        margin_y = int((ys.max() - ys.min()) * self.video_config.TRACKING_MARGIN)
+        margin_x = int((xs.max() - xs.min()) * self.video_config.TRACKING_MARGIN)
+        h, w = face_mask.shape[:2]
+        return max(ys.min() - margin_y, 0), min(ys.max() + margin_y + 1, h), max(xs.min() - margin_x, 0), min(
+            xs.max() + margin_x + 1, w)
+
+    """
+    Returns the downsampled float32 gray crop of given frame within the tracking box.
+    """
+
+    def tracking_image(self, frame: np.ndarray) -> np.ndarray:
+        y0, y1, x0, x1 = self.tracking_box
+        gray = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_RGB2GRAY)
+        scale = self.video_config.TRACKING_SCALE
+        size = (max(int((x1 - x0) * scale), 1), max(int((y1 - y0) * scale), 1))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    """
+    Estimates the face motion since the last keyframe and, if motion and appearance change are within thresholds,
+    returns the result computed from the translated keyframe masks. Returns None if a keyframe is needed.
+    """
+
+    def track_frame(self, frame: np.ndarray) -> FrameResult:
+        if frame.shape[:2] != self.face_mask.shape[:2]:
+            return None
+
+        current = self.tracking_image(frame)
+        (dx, dy), response = cv2.phaseCorrelate(self.tracking_reference, current, self.tracking_window)
+        if response < self.video_config.MIN_TRACKING_RESPONSE:
+            return None
+
+        scale = self.video_config.TRACKING_SCALE
+        dy, dx = int(round(dy / scale)), int(round(dx / scale))
+        if np.hypot(dy, dx) > self.video_config.MAX_MOTION_PIXELS:
+            return None
+
+        face_mask = shift_mask(self.face_mask, dy, dx)
+        total_points = np.count_nonzero(face_mask)
+        if total_points == 0:
+            return None
+
+        # Compare the current frame to the keyframe moved by the estimated motion within the face mask.
+        moved_reference = cv2.warpAffine(self.tracking_reference, np.float32([[1, 0, dx * scale], [0, 1, dy * scale]]),
+                                         (current.shape[1], current.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+        y0, y1, x0, x1 = self.tracking_box
+        small_mask = cv2.resize(face_mask[y0:y1, x0:x1].astype(np.uint8), (current.shape[1], current.shape[0]),
+                                interpolation=cv2.INTER_NEAREST) > 0
+        if np.count_nonzero(small_mask) == 0 or np.mean(
+                np.abs(current - moved_reference)[small_mask]) > self.video_config.MAX_APPEARANCE_CHANGE:
+            return None
+
+        alpha = self.video_config.COLOR_UPDATE_FACTOR
+        skin_tones = []
+        for color, mask in self.face_color_map.items():
+            if color not in self.mean_colors:
+                continue
+            mask = shift_mask(mask, dy, dx)
+            if np.count_nonzero(mask) == 0:
+                continue
+            self.mean_colors[color] = (1 - alpha) * self.mean_colors[color] + alpha * np.mean(frame[mask], axis=0)
+            percent_of_face_mask = ImageUtils.percentPoints(mask, total_points)
+            if percent_of_face_mask >= FrameStreamAnalyzer.SKIN_TONE_PERCENT_CUTOFF:
+                skin_tones.append(skin_tone_from_color(self.mean_colors[color], percent_of_face_mask, mask))
+
+        if self.mouth_mask is not None and len(self.mouth_color_map) > 0:
+            mouth_mask = shift_mask(self.mouth_mask, dy, dx)
+            mouth_color_map = {color: shift_mask(mask, dy, dx) for color, mask in self.mouth_color_map.items()}
+            if any(np.count_nonzero(mask) > 0 for mask in list(mouth_color_map.values())[:2]):
+                self.scene_brightness_value = (1 - alpha) * self.scene_brightness_value + alpha * \
+                                              SkinToneAnalyzer.brightness_from_clusters(frame, mouth_mask,
+                                                                                        mouth_color_map,
+                                                                                        self.skin_config)
+
+        scene_brightness_and_direction = SceneBrightnessAndDirection(int(round(self.scene_brightness_value)),
+                                                                     self.keyframe_result.primary_light_direction,
+                                                                     self.keyframe_result.percent_per_direction)
+        return FrameResult(frame_index=self.frame_index, is_keyframe=False, shift=(dy, dx),
+                           scene_brightness_and_direction=scene_brightness_and_direction, skin_tones=skin_tones,
+                           seconds=0.0)
+
+    """
+    Returns the frames per second rate over the most recent frames.
+    """
+
+    def fps(self) -> float:
+        if len(self.frame_times) == 0 or sum(self.frame_times) == 0:
+            return 0.0
+        return len(self.frame_times) / sum(self.frame_times)
+
+    """
+    Analyzes every frame of the video at given path and yields a FrameResult per frame.
+    """
+
+    def process_video(self, video_path: str):
+        capture = cv2.VideoCapture(video_path)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield self.process_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            capture.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Skin tone analysis of a video stream')
+    parser.add_argument('--video', required=True, metavar="path to video file")
+    parser.add_argument('--weights', required=True, metavar="path to Mask RCNN weights")
+    args = parser.parse_args()
+
+    skin_config = SkinDetectionConfig()
+    skin_config.EXECUTION_MODE = ExecutionMode.THREAD
+    stream_analyzer = FrameStreamAnalyzer(SkinToneAnalyzer.construct_model(args.weights), skin_config)
+    for frame_result in stream_analyzer.process_video(args.video):
+        print("frame: ", frame_result.frame_index, " keyframe: ", frame_result.is_keyframe, " shift: ",
+              frame_result.shift, " skin tones: ", [sk.rgb for sk in frame_result.skin_tones], " fps: ",
+              round(stream_analyzer.fps(), 2))
+    print("Keyframes: ", stream_analyzer.num_keyframes, " of ", stream_analyzer.frame_index + 1, " frames")